@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Cold-start time and memory of TodoistProvider with a large Todoist cache
+
+Each measurement runs in a fresh interpreter, which builds a TodoistProvider
+and resolves a project and a section by name (what the server does for a
+hook). "eager" loads every resource file up front, as the store used to;
+"lazy" only parses the files that the lookups need.
+
+Usage: python benchmarks/bench_coldstart.py [n_items]
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bench_store import make_data  # noqa: E402
+
+
+def child(mode, basedir):
+    start = time.perf_counter()
+    from tasksync.todoist.api import TodoistSyncDataStore
+    from tasksync.todoist.provider import TodoistProvider
+
+    store = TodoistSyncDataStore(basedir=basedir)
+    if mode == "eager":
+        store.load()
+    provider = TodoistProvider(store=store)
+    TodoistProvider.find_project("Project 1", provider.store)
+    TodoistProvider.find_section("Section", "p1", provider.store)
+    elapsed = time.perf_counter() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"elapsed": elapsed, "maxrss": maxrss}))
+    return
+
+
+def main():
+    n_items = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as basedir:
+        make_data(basedir, n_items)
+        size = os.path.getsize(os.path.join(basedir, "items.json"))
+        print("{} items ({:.1f} MB items.json)".format(n_items, size / 1e6))
+        print("{:<8s} {:>12s} {:>12s}".format("load", "time (ms)", "maxrss (MB)"))
+        for mode in ("eager", "lazy"):
+            res = subprocess.run(
+                [sys.executable, __file__, "--child", mode, basedir],
+                capture_output=True,
+                check=True,
+            )
+            stats = json.loads(res.stdout)
+            print(
+                "{:<8s} {:>12.1f} {:>12.1f}".format(
+                    mode, stats["elapsed"] * 1e3, stats["maxrss"] / 1024
+                )
+            )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        child(sys.argv[2], sys.argv[3])
+    else:
+        main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Per-event cost of journaling hook events under sustained load
+
+Replays a stream of on-add/on-modify hook events through
+`TasksyncServer._process` with the command journal at several group commit
+sizes, and compares it against processing the same events with journaling
+stubbed out.
+
+Usage: python benchmarks/bench_journal.py [n_events]
+"""
+
+from os.path import dirname, join
+import logging
+import sys
+import tempfile
+import time
+
+from tasksync.server.journal import Journal
+from tasksync.server.server import TasksyncServer
+from tasksync.taskwarrior.models import TaskwarriorTask
+from tasksync.todoist.api import TodoistSyncDataStore
+from tasksync.todoist.provider import TodoistProvider
+
+DATADIR = join(dirname(__file__), "..", "tasksync", "test", "data")
+
+
+class NullJournal(Journal):
+    def append_commands(self, commands, event=None, event_seq=None):
+        return 0
+
+
+def make_events(n):
+    events = []
+    for i in range(n):
+        task = TaskwarriorTask(
+            description="Task {}".format(i),
+            uuid="00000000-0000-4000-8000-{:012d}".format(i),
+            project="Inbox",
+            timezone="America/New_York",
+        )
+        task_str = task.to_taskwarrior(exclude_id=True)
+        if i % 2 == 0:
+            events.append({"method": "on-add", "args": [task_str]})
+        else:
+            task.todoist = str(i)
+            task_old = task.to_taskwarrior(exclude_id=True)
+            task.description += " (edited)"
+            events.append(
+                {"method": "on-modify", "args": [task_old, task.to_taskwarrior(exclude_id=True)]}
+            )
+    return events
+
+
+def run(events, journal_cls, group_size):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        server = TasksyncServer(
+            socket_path=join(tmpdir, "tasksync"),
+            journal_path=join(tmpdir, "journal"),
+            loglevel=logging.ERROR,
+            provider=TodoistProvider(store=TodoistSyncDataStore(basedir=DATADIR)),
+        )
+        server.journal = journal_cls(join(tmpdir, "journal"), group_size=group_size)
+        start = time.perf_counter()
+        for event in events:
+            server._process(event)
+        server.journal.commit()
+        elapsed = time.perf_counter() - start
+        server.journal.close()
+        server.server.close()
+    return elapsed / len(events) * 1e6
+
+
+def main():
+    n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    events = make_events(n_events)
+    baseline = run(events, NullJournal, 1)
+    print("{} hook events".format(n_events))
+    print("{:<20s} {:>12s} {:>12s}".format("journal", "us/event", "overhead"))
+    print("{:<20s} {:>12.1f} {:>12s}".format("none", baseline, "-"))
+    for group_size in (1, 8, 32, 128):
+        cost = run(events, Journal, group_size)
+        print(
+            "{:<20s} {:>12.1f} {:>12.1f}".format(
+                "group_size={}".format(group_size), cost, cost - baseline
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Reading Taskwarrior state: TaskwarriorReader vs. `task export`
+
+Writes a pending.data with n tasks and times a cold parse, a cached call (no
+file changed) and a lookup by Todoist ID. With a `task` binary on PATH, the
+same data is also exported through it for comparison.
+
+Usage: python benchmarks/bench_reader.py [n_tasks ...]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from tasksync.taskwarrior.reader import TaskwarriorReader
+
+
+def make_data(basedir, n_tasks):
+    with open(os.path.join(basedir, "pending.data"), "w") as f:
+        for i in range(n_tasks):
+            f.write(
+                '[description:"Task {}" entry:"1693171770" project:"Inbox" '
+                'status:"pending" tags:"a,b" todoist:"{}" uuid:"{}"]\n'.format(
+                    i, 7000000000 + i, uuid.uuid4()
+                )
+            )
+    open(os.path.join(basedir, "completed.data"), "w").close()
+    return
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [1000, 10000]
+    for n_tasks in sizes:
+        with tempfile.TemporaryDirectory() as basedir:
+            make_data(basedir, n_tasks)
+            reader = TaskwarriorReader(basedir)
+            out = {}
+            start = time.perf_counter()
+            reader.records()
+            out["cold parse"] = time.perf_counter() - start
+            start = time.perf_counter()
+            reader.records()
+            out["cached"] = time.perf_counter() - start
+            start = time.perf_counter()
+            reader.find(str(7000000000 + n_tasks // 2))
+            out["find todoist"] = time.perf_counter() - start
+            if shutil.which("task"):
+                with open(os.path.join(basedir, "taskrc"), "w") as f:
+                    f.write(
+                        "data.location={}\nuda.todoist.type=string\n".format(basedir)
+                    )
+                start = time.perf_counter()
+                subprocess.run(
+                    ["task", "rc.hooks=off", "export"],
+                    env=dict(os.environ, TASKRC=os.path.join(basedir, "taskrc")),
+                    capture_output=True,
+                    check=True,
+                )
+                out["task export"] = time.perf_counter() - start
+        print("{} tasks".format(n_tasks))
+        for key, elapsed in out.items():
+            print("{:<16s} {:>10.2f} ms".format(key, elapsed * 1e3))
+        print()
+
+
+if __name__ == "__main__":
+    main()
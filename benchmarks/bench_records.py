@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Memory held by cached Todoist items: dicts vs. compact records
+
+Writes an items.json with full Sync API items (every TodoistSyncTask field),
+then measures with tracemalloc how much memory the loaded `store.items` list
+holds with and without `compact_items`.
+
+Usage: python benchmarks/bench_records.py [n_items ...]
+"""
+
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from tasksync.todoist.api import TodoistSyncDataStore
+
+
+def make_item(i, n_projects):
+    return {
+        "added_at": "2023-01-01T01:00:00.{:06d}Z".format(i % 1000000),
+        "added_by_uid": "12345678",
+        "assigned_by_uid": None,
+        "checked": i % 3 == 0,
+        "child_order": i,
+        "collapsed": False,
+        "completed_at": "2023-02-01T01:00:00Z" if i % 3 == 0 else None,
+        "content": "Task number {}".format(i),
+        "day_order": -1,
+        "description": "",
+        "due": None,
+        "duration": None,
+        "id": str(7000000000 + i),
+        "is_deleted": False,
+        "labels": ["label{}".format(i % 5)],
+        "parent_id": None,
+        "priority": 1 + i % 4,
+        "project_id": str(2000000000 + i % n_projects),
+        "responsible_uid": None,
+        "section_id": None,
+        "sync_id": None,
+        "user_id": "12345678",
+    }
+
+
+def measure(basedir, compact_items):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    store = TodoistSyncDataStore(basedir=basedir, compact_items=compact_items)
+    items = store.items
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(items) > 0
+    return current, peak, elapsed
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [10000, 100000]
+    for n_items in sizes:
+        with tempfile.TemporaryDirectory() as basedir:
+            items = [make_item(i, max(n_items // 100, 1)) for i in range(n_items)]
+            with open(os.path.join(basedir, "items.json"), "w") as f:
+                json.dump(items, f)
+            del items
+            print("{} items".format(n_items))
+            print(
+                "{:<10s} {:>14s} {:>14s} {:>10s}".format(
+                    "items", "held (MB)", "peak (MB)", "load (ms)"
+                )
+            )
+            for name, compact_items in (("dict", False), ("record", True)):
+                current, peak, elapsed = measure(basedir, compact_items)
+                print(
+                    "{:<10s} {:>14.1f} {:>14.1f} {:>10.1f}".format(
+                        name, current / 1e6, peak / 1e6, elapsed * 1e3
+                    )
+                )
+            print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Sync API request latency: module-level requests.post vs. a pooled session
+
+Starts a local HTTPS stand-in for the Sync API (self-signed certificate made
+with `openssl`) and times n pulls the way TodoistSyncAPI used to make them
+(`requests.post`, so a new TCP+TLS handshake each time) against
+`TodoistSyncAPI`, which reuses one kept-alive connection.
+
+Usage: python benchmarks/bench_session.py [n_requests]
+"""
+
+import http.server
+import json
+import os
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from tasksync.todoist.api import TodoistSyncAPI
+from tasksync.todoist.ratelimit import RateLimiter
+
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send headers and body together (no Nagle/delayed-ACK stall)
+    wbufsize = -1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = json.dumps({"sync_token": "abc", "items": []}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        return
+
+
+def serve(basedir):
+    cert, key = (os.path.join(basedir, x) for x in ("cert.pem", "key.pem"))
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+            "-addext",
+            "subjectAltName=DNS:localhost",
+            "-keyout",
+            key,
+            "-out",
+            cert,
+        ],
+        capture_output=True,
+        check=True,
+    )
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    server = http.server.ThreadingHTTPServer(("localhost", 0), StandIn)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "https://localhost:{}/sync".format(server.server_address[1]), cert
+
+
+def post(url, cert):
+    res = requests.post(
+        url,
+        headers={"Authorization": "Bearer {}".format(os.environ["TODOIST_API_KEY"])},
+        data={"sync_token": "*", "resource_types": '["items"]'},
+        verify=cert,
+    )
+    return res.json()
+
+
+def main():
+    n_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    os.environ.setdefault("TODOIST_API_KEY", "bench")
+    with tempfile.TemporaryDirectory() as basedir:
+        server, url, cert = serve(basedir)
+        # Keep the benchmark off the shared Todoist request budget
+        limiter = RateLimiter(capacity=n_requests, reserve=0)
+        api = TodoistSyncAPI(url=url, limiter=limiter)
+        api.session.verify = cert
+        # Otherwise REQUESTS_CA_BUNDLE takes precedence over session.verify
+        api.session.trust_env = False
+        runs = {
+            "requests.post": lambda: post(url, cert),
+            "session": lambda: api.pull(resource_types=["items"]),
+        }
+        print("{} requests".format(n_requests))
+        print("{:<16s} {:>10s} {:>10s}".format("ms/request", "median", "p95"))
+        for name, fn in runs.items():
+            elapsed = []
+            for _ in range(n_requests):
+                start = time.perf_counter()
+                fn()
+                elapsed.append(time.perf_counter() - start)
+            elapsed.sort()
+            print(
+                "{:<16s} {:>10.2f} {:>10.2f}".format(
+                    name,
+                    statistics.median(elapsed) * 1e3,
+                    elapsed[int(len(elapsed) * 0.95) - 1] * 1e3,
+                )
+            )
+        api.close()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Lookup and update cost of TodoistSyncDataStore at 10k and 100k items
+
+Compares the indexed store against the previous behaviour (a linear scan per
+`find` and per element in `update`), which is reproduced here by
+`ScanStore`. Writing the JSON files is stubbed out so only the in-memory work
+is measured; the bytes written by a one-item incremental pull are reported
+separately, against rewriting every resource file as before.
+
+Usage: python benchmarks/bench_store.py [n_items ...]
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+from tasksync.todoist.api import TodoistSyncDataStore
+from tasksync.todoist.storage import TodoistLogDataStore
+
+N_LOOKUPS = 1000
+N_UPDATES = 1000
+SAVE_BACKENDS = [("json", TodoistSyncDataStore), ("log", TodoistLogDataStore)]
+
+
+class ScanStore(TodoistSyncDataStore):
+    def save(self, resource_types=[]):
+        return
+
+    def update(self, data, resource_types=None):
+        for resource_type in resource_types:
+            for elem in data.get(resource_type, []):
+                if existing_elem := next(
+                    (x for x in getattr(self, resource_type) if x["id"] == elem["id"]),
+                    None,
+                ):
+                    existing_elem.update(elem)
+                else:
+                    getattr(self, resource_type).append(elem)
+        return
+
+    def find(self, key, **kwargs):
+        for element in getattr(self, key):
+            if all(element[k] == v for k, v in kwargs.items()):
+                return element
+        return
+
+
+class IndexedStore(TodoistSyncDataStore):
+    def save(self, resource_types=[]):
+        return
+
+
+def make_data(basedir, n_items):
+    n_projects = max(n_items // 100, 1)
+    projects = [
+        {"id": "p{}".format(i), "name": "Project {}".format(i)}
+        for i in range(n_projects)
+    ]
+    sections = [
+        {"id": "s{}".format(i), "name": "Section", "project_id": "p{}".format(i)}
+        for i in range(n_projects)
+    ]
+    items = [
+        {
+            "id": "i{}".format(i),
+            "content": "Task {}".format(i),
+            "project_id": "p{}".format(i % n_projects),
+        }
+        for i in range(n_items)
+    ]
+    for name, data in (("projects", projects), ("sections", sections), ("items", items)):
+        with open(os.path.join(basedir, "{}.json".format(name)), "w") as f:
+            json.dump(data, f)
+    return n_projects
+
+
+def run(store_cls, basedir, n_items, n_projects):
+    store = store_cls(basedir=basedir)
+    step = max(n_items // N_LOOKUPS, 1)
+    ids = ["i{}".format(i) for i in range(0, n_items, step)][:N_LOOKUPS]
+    names = ["Project {}".format(i % n_projects) for i in range(N_LOOKUPS)]
+    sections = [("Section", "p{}".format(i % n_projects)) for i in range(N_LOOKUPS)]
+    out = {}
+
+    start = time.perf_counter()
+    for id_ in ids:
+        store.find("items", id=id_)
+    out["find id"] = (time.perf_counter() - start) / len(ids)
+
+    start = time.perf_counter()
+    for name in names:
+        store.find("projects", name=name)
+    out["find project"] = (time.perf_counter() - start) / len(names)
+
+    start = time.perf_counter()
+    for name, project_id in sections:
+        store.find("sections", name=name, project_id=project_id)
+    out["find section"] = (time.perf_counter() - start) / len(sections)
+
+    # Half of the batch updates existing items, the other half is new
+    batch = [{"id": x, "content": "Updated"} for x in ids[: N_UPDATES // 2]]
+    batch += [{"id": "n{}".format(i), "content": "New"} for i in range(N_UPDATES // 2)]
+    start = time.perf_counter()
+    store.update({"sync_token": "bench", "items": batch}, resource_types=["items"])
+    out["update"] = (time.perf_counter() - start) / len(batch)
+    return out
+
+
+def run_save(store_cls, basedir):
+    store = store_cls(basedir=basedir)
+    before = sum(
+        os.path.getsize(os.path.join(basedir, "{}.json".format(x)))
+        for x in store.resource_types
+        if os.path.exists(os.path.join(basedir, "{}.json".format(x)))
+    )
+    item = dict(store.items[0], content="Changed")
+    start = time.perf_counter()
+    store.update({"sync_token": "bench", "items": [item]}, resource_types=["items"])
+    elapsed = time.perf_counter() - start
+    written = store.last_save["written"]
+    if isinstance(store, TodoistLogDataStore):
+        store.compact()
+    return before, written, elapsed
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [10000, 100000]
+    for n_items in sizes:
+        with tempfile.TemporaryDirectory() as basedir:
+            n_projects = make_data(basedir, n_items)
+            before = run(ScanStore, basedir, n_items, n_projects)
+            after = run(IndexedStore, basedir, n_items, n_projects)
+            saves = [(x, run_save(y, basedir)) for x, y in SAVE_BACKENDS]
+        print("{} items, {} projects".format(n_items, n_projects))
+        print("{:<16s} {:>12s} {:>12s} {:>10s}".format("us/op", "scan", "indexed", "speedup"))
+        for key in before:
+            print(
+                "{:<16s} {:>12.2f} {:>12.2f} {:>9.0f}x".format(
+                    key, before[key] * 1e6, after[key] * 1e6, before[key] / after[key]
+                )
+            )
+        for name, (rewrite_all, written, elapsed) in saves:
+            print(
+                "1-item pull ({}): {} bytes written ({:.1f} ms), "
+                "{} bytes rewriting every file".format(
+                    name, written, elapsed * 1e3, rewrite_all
+                )
+            )
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Writing Todoist IDs back to Taskwarrior: per-task modify vs. batched import
+
+"loop" runs `task rc.hooks=off <uuid> modify todoist=<id>` once per task, as
+`TodoistProvider.update_taskwarrior` used to; "batched" is
+`tasksync.taskwarrior.batch.modify_tasks`, which exports and imports each
+chunk of tasks in two calls.
+
+Runs against the `task` on PATH with a throwaway TASKDATA. Without one, a
+stand-in Python script is used instead, so the numbers then mostly measure
+process start-up, which is what the batching removes.
+
+Usage: python benchmarks/bench_writeback.py [n_tasks ...]
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from tasksync.taskwarrior import batch
+
+FAKE_TASK = """#!{python}
+import json, os, sys
+db = os.path.join(os.path.dirname(__file__), 'tasks.json')
+tasks = dict((x['uuid'], x) for x in json.load(open(db)))
+args = [x for x in sys.argv[1:] if not x.startswith('rc.')]
+if args[-1] == 'export':
+    print(json.dumps([tasks[x] for x in args[:-1] if x in tasks]))
+    sys.exit()
+if args[0] == 'import':
+    tasks.update((x['uuid'], x) for x in json.load(sys.stdin))
+elif args[1] == 'modify':
+    key, value = args[2].split('=', 1)
+    tasks[args[0]][key] = value
+json.dump(list(tasks.values()), open(db, 'w'))
+"""
+
+
+def setup(basedir, n_tasks):
+    tasks = [
+        {
+            "uuid": str(uuid.uuid4()),
+            "description": "Task {}".format(i),
+            "entry": "20230101T000000Z",
+            "status": "pending",
+        }
+        for i in range(n_tasks)
+    ]
+    if shutil.which("task"):
+        with open(os.path.join(basedir, "taskrc"), "w") as f:
+            f.write("data.location={}\nuda.todoist.type=string\n".format(basedir))
+        os.environ["TASKRC"] = os.path.join(basedir, "taskrc")
+        batch.TASK_BIN = "task"
+        batch.import_tasks(tasks)
+    else:
+        batch.TASK_BIN = os.path.join(basedir, "task")
+        with open(batch.TASK_BIN, "w") as f:
+            f.write(FAKE_TASK.format(python=sys.executable))
+        os.chmod(batch.TASK_BIN, 0o755)
+        with open(os.path.join(basedir, "tasks.json"), "w") as f:
+            json.dump(tasks, f)
+    return {x["uuid"]: str(7000000000 + i) for i, x in enumerate(tasks)}
+
+
+def loop(todoist_ids):
+    for taskwarrior_uuid, todoist_id in todoist_ids.items():
+        subprocess.run(
+            [
+                batch.TASK_BIN,
+                "rc.hooks=off",
+                taskwarrior_uuid,
+                "modify",
+                "todoist={}".format(todoist_id),
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    return
+
+
+def batched(todoist_ids):
+    failed = batch.modify_tasks({k: {"todoist": v} for k, v in todoist_ids.items()})
+    assert failed == {}
+    return
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [10, 100, 500]
+    print("task binary: {}".format(shutil.which("task") or "stand-in script"))
+    print(
+        "{:<8s} {:>12s} {:>12s} {:>10s}".format(
+            "tasks", "loop (s)", "batched (s)", "speedup"
+        )
+    )
+    for n_tasks in sizes:
+        elapsed = {}
+        for name, fn in (("loop", loop), ("batched", batched)):
+            with tempfile.TemporaryDirectory() as basedir:
+                todoist_ids = setup(basedir, n_tasks)
+                start = time.perf_counter()
+                fn(todoist_ids)
+                elapsed[name] = time.perf_counter() - start
+                check = batch.export_tasks(list(todoist_ids))
+                assert all(todoist_ids[x["uuid"]] == x["todoist"] for x in check)
+        print(
+            "{:<8d} {:>12.2f} {:>12.2f} {:>9.0f}x".format(
+                n_tasks,
+                elapsed["loop"],
+                elapsed["batched"],
+                elapsed["loop"] / elapsed["batched"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,9 +8,18 @@ import os
 import sys
 
 from tasksync import __version__
+from tasksync.server import (
+    ALLOW_LEGACY,
+    SERVER_MODE,
+    FLUSH_QUIET_PERIOD,
+    FLUSH_MAX_DELAY,
+    FLUSH_MAX_QUEUE,
+)
 from tasksync.server.client import TasksyncClient
 from tasksync.server.server import TasksyncServer
+from tasksync.todoist.api import RETAIN_COMPLETED_DAYS, RetentionPolicy
 from tasksync.todoist.provider import TodoistProvider
+from tasksync.todoist.storage import STORE_BACKEND, STORE_BACKENDS, open_store
 
 SOCKET_PATH = "/tmp/tasksync"
 PIDFILE = join(os.environ["HOME"], "tasksync.pid")
@@ -23,7 +32,12 @@ class TasksyncCLI:
         "stop",
         "status",
         "pull",
+        "feedback",
     ]
+    _help = {
+        "pull": "pull updates from Todoist into Taskwarrior",
+        "feedback": "show Todoist feedback for recently processed hooks",
+    }
     client: TasksyncClient
 
     def __init__(self):
@@ -41,29 +55,106 @@ class TasksyncCLI:
             help="print version",
         )
         _subparsers = self.parser.add_subparsers()
-        subparsers = []
+        self.subparsers = {}
         for cmd in self._commands:
-            subparsers.append(
-                _subparsers.add_parser(
-                    cmd,
-                    help="{} the tasksync service".format(cmd),
-                )
+            self.subparsers[cmd] = _subparsers.add_parser(
+                cmd,
+                help=self._help.get(cmd, "{} the tasksync service".format(cmd)),
+            )
+            self.subparsers[cmd].set_defaults(func=getattr(self, cmd))
+
+        # Command-specific options
+        self.subparsers["start"].add_argument(
+            "--mode",
+            choices=["asyncio", "blocking"],
+            default=SERVER_MODE,
+            help="server event loop (default: %(default)s)",
+        )
+        self.subparsers["start"].add_argument(
+            "--deferred",
+            action="store_true",
+            default=False,
+            help="acknowledge hooks immediately and process them afterwards",
+        )
+        self.subparsers["start"].add_argument(
+            "--quiet-period",
+            type=float,
+            default=FLUSH_QUIET_PERIOD,
+            help="push once no hooks have arrived for this many seconds "
+            "(default: %(default)s)",
+        )
+        self.subparsers["start"].add_argument(
+            "--max-delay",
+            type=float,
+            default=FLUSH_MAX_DELAY,
+            help="push at most this many seconds after the oldest queued change "
+            "(default: %(default)s)",
+        )
+        self.subparsers["start"].add_argument(
+            "--max-queue",
+            type=int,
+            default=FLUSH_MAX_QUEUE,
+            help="push as soon as this many changes are queued "
+            "(default: %(default)s)",
+        )
+        self.subparsers["start"].add_argument(
+            "--allow-legacy",
+            action="store_true",
+            default=ALLOW_LEGACY,
+            help="accept hooks that use the old pickle-based protocol",
+        )
+
+        for cmd in ("start", "pull"):
+            self.subparsers[cmd].add_argument(
+                "--store",
+                choices=list(STORE_BACKENDS),
+                default=STORE_BACKEND,
+                help="storage backend for the Todoist cache (default: %(default)s)",
+            )
+            self.subparsers[cmd].add_argument(
+                "--compact-items",
+                action="store_true",
+                default=False,
+                help="keep only the item fields tasksync uses in the Todoist cache",
+            )
+            self.subparsers[cmd].add_argument(
+                "--retain-completed",
+                type=int,
+                default=RETAIN_COMPLETED_DAYS,
+                metavar="DAYS",
+                help="drop completed items from the Todoist cache after this many "
+                "days (default: keep them)",
             )
-            subparsers[-1].set_defaults(func=getattr(self, cmd))
 
     def parse_args(self):
         return self.parser.parse_args()
 
     def get_server_pid(self) -> int | None:
+        if status := self.get_server_status():
+            return int(status["pid"])
+        return None
+
+    def get_server_status(self) -> dict | None:
         try:
             self.client.connect()
-            pid = self.client.status()
+            status = self.client.status()
             self.client.close()
-            return int(pid)
+            return status
         except Exception as _:
             return None
 
-    def start(self) -> int:
+    def start(
+        self,
+        mode: str = SERVER_MODE,
+        deferred: bool = False,
+        quiet_period: float = FLUSH_QUIET_PERIOD,
+        max_delay: float = FLUSH_MAX_DELAY,
+        max_queue: int = FLUSH_MAX_QUEUE,
+        store: str = STORE_BACKEND,
+        compact_items: bool = False,
+        retain_completed: int | None = RETAIN_COMPLETED_DAYS,
+        allow_legacy: bool = ALLOW_LEGACY,
+    ) -> int:
         if self.get_server_pid():
             print("tasksync is already running")
             return 1
@@ -102,7 +193,21 @@ class TasksyncCLI:
         os.dup2(se.fileno(), sys.stderr.fileno())
 
         pid = os.getpid()
-        server = TasksyncServer()
+        server = TasksyncServer(
+            server_timeout=quiet_period,
+            mode=mode,
+            deferred=deferred,
+            max_delay=max_delay,
+            max_queue=max_queue,
+            allow_legacy=allow_legacy,
+            provider=TodoistProvider(
+                store=open_store(
+                    backend=store,
+                    compact_items=compact_items,
+                    retention=RetentionPolicy(completed_days=retain_completed),
+                )
+            ),
+        )
         server.start()
         return 0
 
@@ -118,15 +223,67 @@ class TasksyncCLI:
             return 1
 
     def status(self) -> int:
-        if pid := self.get_server_pid():
-            print("tasksync is running with pid {}".format(pid))
+        if status := self.get_server_status():
+            print("tasksync is running with pid {}".format(status["pid"]))
+            scheduler = status["scheduler"]
+            print("queued: {}".format(scheduler["queued"]))
+            if scheduler["next_flush"] is not None:
+                print("next push in: {:.1f}s".format(scheduler["next_flush"]))
+            print(
+                "quiet period: {}s, max delay: {}s, max queue: {}".format(
+                    scheduler["quiet_period"],
+                    scheduler["max_delay"],
+                    scheduler["max_queue"],
+                )
+            )
+            if rate_limit := status.get("rate_limit"):
+                print(
+                    "Todoist requests left: {}/{}".format(
+                        rate_limit["remaining"], rate_limit["capacity"]
+                    )
+                )
+                if rate_limit["blocked_for"] > 0:
+                    print("rate limited for: {:.0f}s".format(rate_limit["blocked_for"]))
             return 0
         else:
             print("tasksync is not running")
             return 1
 
-    def pull(self) -> int:
-        provider = TodoistProvider()
+    def feedback(self) -> int:
+        if not self.get_server_pid():
+            print("tasksync is not running")
+            return 1
+        self.client.connect()
+        entries = self.client.feedback()
+        self.client.close()
+        for entry in entries:
+            print(
+                "{} {} ({})".format(
+                    entry["uuid"], entry["feedback"], entry["description"]
+                )
+            )
+        return 0
+
+    def pull(
+        self,
+        store: str = STORE_BACKEND,
+        compact_items: bool = False,
+        retain_completed: int | None = RETAIN_COMPLETED_DAYS,
+    ) -> int:
+        # The server owns the store while it is running
+        if self.get_server_pid():
+            self.client.connect()
+            feedback = self.client.pull(full=True)
+            self.client.close()
+            print(feedback)
+            return 0 if feedback.startswith("Todoist:") else 1
+        provider = TodoistProvider(
+            store=open_store(
+                backend=store,
+                compact_items=compact_items,
+                retention=RetentionPolicy(completed_days=retain_completed),
+            )
+        )
         provider.pull(full=True)
         return 0
 
@@ -139,7 +296,12 @@ def main():
     elif not hasattr(args, "func"):
         cli.parser.print_help()
     else:
-        sys.exit(args.func())
+        kwargs = {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("func", "version")
+        }
+        sys.exit(args.func(**kwargs))
     sys.exit(0)
 
 
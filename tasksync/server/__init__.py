@@ -1,11 +1,54 @@
+from __future__ import annotations
+
+from os.path import join
+import asyncio
+import json
+import os
 import socket
+import struct
 import pickle
 from typing import Any
 
 SOCKET_PATH = "/tmp/tasksync"
 SERVER_TIMEOUT = 10
+FLUSH_QUIET_PERIOD = SERVER_TIMEOUT
+FLUSH_MAX_DELAY = 60
+FLUSH_MAX_QUEUE = 100
+PUSH_POLL_INTERVAL = 0.1
+# Backoff between failed pushes (seconds), doubling up to PUSH_BACKOFF_MAX
+PUSH_BACKOFF = 5
+PUSH_BACKOFF_MAX = 300
+SERVER_BACKLOG = 128
+SERVER_MODE = "asyncio"
 CONNECTION_TIMEOUT = 5
+PULL_TIMEOUT = 300
+# Longest a hook waits for a running pull, leaving the rest of
+# CONNECTION_TIMEOUT to process the event and reply
+PULL_WAIT_TIMEOUT = 3
 MAX_BUFFER_SIZE = 1024
+STATE_PATH = join(os.environ["HOME"], ".tasksync")
+JOURNAL_PATH = join(STATE_PATH, "journal")
+JOURNAL_GROUP_SIZE = 32
+JOURNAL_GROUP_INTERVAL = 0.05
+FEEDBACK_HISTORY = 100
+
+# Wire protocols
+#
+# Legacy (v1): 8-byte little-endian size, ack, pickled payload, ack
+# Framed (v2): 8-byte header followed by the encoded payload, no acks
+#
+# The v2 header is magic (2s), version (B), codec (B), payload length (>I).
+# Both protocols start with 8 bytes, so the server reads those and decides:
+# the upper four bytes of a legacy size are always zero (payloads < 4 GiB),
+# whereas a v2 frame always carries a non-zero payload length there.
+PROTOCOL_LEGACY = 1
+PROTOCOL_FRAMED = 2
+PROTOCOL_VERSION = PROTOCOL_FRAMED
+# Legacy messages are pickled, so only accept them when asked to
+ALLOW_LEGACY = False
+PROTOCOL_MAGIC = b"TS"
+CODEC_JSON = 1
+FRAME_HEADER = struct.Struct(">2sBBI")
 
 
 def send_ack(connection: socket.socket):
@@ -36,6 +79,10 @@ def send_data(connection: socket.socket, data: Any):
 
 def receive_data(connection: socket.socket) -> Any:
     data_size_b = connection.recv(8)
+    return _receive_legacy(connection, data_size_b)
+
+
+def _receive_legacy(connection: socket.socket, data_size_b: bytes) -> Any:
     data_size = int.from_bytes(data_size_b, "little", signed=False)
     send_ack(connection)
 
@@ -50,3 +97,186 @@ def receive_data(connection: socket.socket) -> Any:
         recd_bytes += len(chunk)
     send_ack(connection)
     return pickle.loads(b"".join(chunks))
+
+
+def encode_frame(data: Any, codec: int = CODEC_JSON) -> bytes:
+    """Encode `data` as a single v2 frame (header + payload)"""
+    if codec != CODEC_JSON:
+        raise ValueError("Unsupported codec: {}".format(codec))
+    payload = json.dumps(data, separators=(",", ":")).encode("utf-8")
+    header = FRAME_HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_FRAMED, codec, len(payload))
+    return header + payload
+
+
+def decode_frame(codec: int, payload) -> Any:
+    """Decode a v2 frame payload (any bytes-like object)"""
+    if codec != CODEC_JSON:
+        raise ConnectionError("Unsupported codec: {}".format(codec))
+    return json.loads(str(payload, "utf-8"))
+
+
+def parse_header(header: bytes) -> tuple[int, int, int]:
+    """Negotiate the protocol from the first 8 bytes of a message
+
+    Returns
+    -------
+    version, codec, size : tuple[int, int, int]
+        Protocol version, codec (0 for legacy) and payload size in bytes
+    """
+    if len(header) != FRAME_HEADER.size:
+        raise ConnectionError("Connection closed before header was received")
+    magic, version, codec, size = FRAME_HEADER.unpack(header)
+    if header[4:] == b"\x00\x00\x00\x00":
+        return PROTOCOL_LEGACY, 0, int.from_bytes(header, "little", signed=False)
+    if magic != PROTOCOL_MAGIC or version != PROTOCOL_FRAMED:
+        raise ConnectionError("Unsupported protocol header: {!r}".format(header))
+    return version, codec, size
+
+
+def send_frame(connection: socket.socket, data: Any):
+    connection.sendall(encode_frame(data))
+    return
+
+
+def recv_frame(connection: socket.socket, buffer: bytearray | None = None) -> Any:
+    data, _ = receive_message(connection, buffer=buffer, allow_legacy=False)
+    return data
+
+
+def send_message(connection: socket.socket, data: Any, version: int):
+    """Send `data` using the protocol negotiated for this connection"""
+    if version == PROTOCOL_LEGACY:
+        send_data(connection, data)
+    else:
+        send_frame(connection, data)
+    return
+
+
+def receive_message(
+    connection: socket.socket,
+    buffer: bytearray | None = None,
+    allow_legacy: bool = ALLOW_LEGACY,
+) -> tuple[Any, int]:
+    """Receive a single message in either protocol
+
+    Parameters
+    ----------
+    connection : socket.socket
+        Connected socket
+    buffer : bytearray, optional
+        Reusable receive buffer; grown in place if a payload does not fit
+    allow_legacy : bool, optional
+        Whether to accept (pickled) legacy messages
+
+    Returns
+    -------
+    data, version : tuple[Any, int]
+        Decoded message and the protocol version it was sent with
+    """
+    if buffer is None:
+        buffer = bytearray(MAX_BUFFER_SIZE)
+    _recv_into(connection, buffer, FRAME_HEADER.size)
+    header = bytes(buffer[: FRAME_HEADER.size])
+    version, codec, size = parse_header(header)
+    if version == PROTOCOL_LEGACY:
+        if not allow_legacy:
+            raise ConnectionError("Legacy protocol is not accepted")
+        return _receive_legacy(connection, header), version
+    _recv_into(connection, buffer, size)
+    with memoryview(buffer) as view:
+        return decode_frame(codec, view[:size]), version
+
+
+def _recv_into(connection: socket.socket, buffer: bytearray, size: int):
+    if len(buffer) < size:
+        buffer.extend(bytes(size - len(buffer)))
+    received = 0
+    with memoryview(buffer) as view:
+        while received < size:
+            nbytes = connection.recv_into(view[received:size])
+            if nbytes == 0:
+                raise ConnectionError("Connection closed before message was received")
+            received += nbytes
+    return
+
+
+async def send_ack_async(writer: asyncio.StreamWriter):
+    writer.write(bool(True).to_bytes(1, "little"))
+    await writer.drain()
+    return
+
+
+async def receive_ack_async(reader: asyncio.StreamReader):
+    recv_ok = await reader.readexactly(1)
+    if not bool.from_bytes(recv_ok, "little"):
+        raise ConnectionError("Did not receive OK from tasksync.server")
+    return
+
+
+async def send_data_async(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, data: Any
+):
+    """Coroutine equivalent of `send_data` for asyncio streams"""
+    data_bytes = pickle.dumps(data)
+    data_size = len(data_bytes).to_bytes(8, "little", signed=False)
+
+    # Send message size
+    writer.write(data_size)
+    await writer.drain()
+    await receive_ack_async(reader)
+
+    # Send message
+    writer.write(data_bytes)
+    await writer.drain()
+    await receive_ack_async(reader)
+    return
+
+
+async def receive_data_async(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> Any:
+    """Coroutine equivalent of `receive_data` for asyncio streams"""
+    data_size_b = await reader.readexactly(8)
+    return await _receive_legacy_async(reader, writer, data_size_b)
+
+
+async def _receive_legacy_async(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, data_size_b: bytes
+) -> Any:
+    data_size = int.from_bytes(data_size_b, "little", signed=False)
+    await send_ack_async(writer)
+
+    # Receive data from the client
+    data_bytes = await reader.readexactly(data_size)
+    await send_ack_async(writer)
+    return pickle.loads(data_bytes)
+
+
+async def send_message_async(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    data: Any,
+    version: int,
+):
+    """Coroutine equivalent of `send_message` for asyncio streams"""
+    if version == PROTOCOL_LEGACY:
+        await send_data_async(reader, writer, data)
+    else:
+        writer.write(encode_frame(data))
+        await writer.drain()
+    return
+
+
+async def receive_message_async(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    allow_legacy: bool = ALLOW_LEGACY,
+) -> tuple[Any, int]:
+    """Coroutine equivalent of `receive_message` for asyncio streams"""
+    header = await reader.readexactly(FRAME_HEADER.size)
+    version, codec, size = parse_header(header)
+    if version == PROTOCOL_LEGACY:
+        if not allow_legacy:
+            raise ConnectionError("Legacy protocol is not accepted")
+        return await _receive_legacy_async(reader, writer, header), version
+    return decode_frame(codec, await reader.readexactly(size)), version
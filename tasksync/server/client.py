@@ -7,14 +7,22 @@ import sys
 from tasksync.server import (
     SOCKET_PATH,
     CONNECTION_TIMEOUT,
+    MAX_BUFFER_SIZE,
+    PULL_TIMEOUT,
+    PROTOCOL_LEGACY,
+    PROTOCOL_VERSION,
     send_data,
+    send_frame,
     receive_data,
+    recv_frame,
 )
 
 
 class TasksyncClient:
-    def __init__(self, socket_path=SOCKET_PATH):
+    def __init__(self, socket_path=SOCKET_PATH, protocol=PROTOCOL_VERSION):
         self.socket_path = socket_path
+        self.protocol = protocol
+        self._buffer = bytearray(MAX_BUFFER_SIZE)
 
     def connect(self):
         self.client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
@@ -41,26 +49,46 @@ class TasksyncClient:
         }
         return self._send(data)
 
-    def status(self) -> str:
+    def status(self) -> dict:
         data = {
             "method": "status",
         }
         return self._send(data)
 
+    def feedback(self) -> list:
+        data = {
+            "method": "feedback",
+        }
+        return self._send(data)
+
+    def pull(self, full: bool = True) -> str:
+        data = {
+            "method": "pull",
+            "args": [
+                full,
+            ],
+        }
+        # The server replies once the pull has finished
+        self.client.settimeout(PULL_TIMEOUT)
+        try:
+            return self._send(data)
+        finally:
+            self.client.settimeout(CONNECTION_TIMEOUT)
+
     def stop(self) -> str:
         data = {
             "method": "stop",
         }
         return self._send(data)
 
-    def _send(self, data) -> str:
-        # Send data
-        send_data(self.client, data)
-
-        # Receive feedback string
-        feedback = receive_data(self.client)
+    def _send(self, data):
+        if self.protocol == PROTOCOL_LEGACY:
+            send_data(self.client, data)
+            return receive_data(self.client)
 
-        return feedback
+        # Single frame out, single frame back
+        send_frame(self.client, data)
+        return recv_frame(self.client, self._buffer)
 
     def close(self):
         self.client.close()
@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+from collections import deque
+from os.path import dirname, exists
+import json
+import os
+import time
+
+from tasksync.server import (
+    JOURNAL_GROUP_SIZE,
+    JOURNAL_GROUP_INTERVAL,
+)
+
+
+class Journal:
+    """Write-ahead journal of hook events and the Todoist commands they produce
+
+    Records are appended to a JSON-lines file and come in three kinds:
+
+    - ``{"seq": n, "event": {...}}`` is a hook event accepted in deferred mode
+      but not processed yet. It is fsynced before the hook is acknowledged.
+    - ``{"seq": n, "commands": [...], ...}`` holds the commands generated by a
+      hook event, along with the event itself (or its ``event_seq``). These
+      are group committed: one fsync covers every record written since the
+      last one, once `group_size` records or `group_interval` seconds have
+      accumulated.
+    - ``{"seq": n, "resolved": {...}}`` maps the temp_ids confirmed by a push
+      to their real ids. Records that survive the push may still refer to
+      those temp_ids, which are only valid in the request that created them.
+
+    Records are dropped with `truncate()` once `push()` confirms the commands,
+    so anything still in the file on startup is replayed.
+    """
+
+    path: str
+    pending: deque
+    seq: int
+
+    def __init__(
+        self,
+        path: str,
+        group_size: int = JOURNAL_GROUP_SIZE,
+        group_interval: float = JOURNAL_GROUP_INTERVAL,
+    ):
+        self.path = path
+        self.group_size = group_size
+        self.group_interval = group_interval
+        self.pending = deque()
+        self.seq = 0
+        self._commands = []
+        self.resolved = {}
+        self._records = []
+        self._file = None
+        self._unsynced = 0
+        self._first_unsynced = 0.0
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    @property
+    def dirty(self) -> bool:
+        return self._unsynced > 0
+
+    def append_event(self, event: dict) -> int:
+        """Durably record an unprocessed hook event"""
+        seq = self._write({"event": event})
+        self.commit()
+        self.pending.append((seq, event))
+        return seq
+
+    def pop(self) -> tuple[int, dict] | None:
+        """Return the next unprocessed event (it remains on disk)"""
+        return self.pending.popleft() if self.pending else None
+
+    def append_commands(
+        self,
+        commands: list,
+        event: dict | None = None,
+        event_seq: int | None = None,
+    ) -> int:
+        """Record the commands generated by a hook event
+
+        Parameters
+        ----------
+        commands : list
+            Sync API commands generated for the event
+        event : dict, optional
+            Raw hook event, if it was not recorded with `append_event`
+        event_seq : int, optional
+            Sequence number returned by `append_event` for this event
+        """
+        record = {"commands": commands}
+        if event_seq is not None:
+            record["event_seq"] = event_seq
+        elif event is not None:
+            record["event"] = event
+        seq = self._write(record)
+        self.maybe_commit()
+        return seq
+
+    def append_resolved(self, resolved: dict) -> int:
+        """Record the real ids a push confirmed for temp_ids (temp_id -> id)"""
+        seq = self._write({"resolved": resolved})
+        self.maybe_commit()
+        return seq
+
+    def replay(self) -> list:
+        """Return (once) the commands recovered from disk on startup"""
+        commands, self._commands = self._commands, []
+        return commands
+
+    def maybe_commit(self):
+        if self._unsynced >= self.group_size or (
+            self._unsynced > 0
+            and time.monotonic() - self._first_unsynced >= self.group_interval
+        ):
+            self.commit()
+        return
+
+    def commit(self):
+        if self._file is not None and self._unsynced > 0:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        return
+
+    def truncate(self, upto: int | None = None):
+        """Drop records up to and including `upto` once they have been pushed
+
+        Unprocessed events are always kept, whatever their sequence number.
+        """
+        if upto is None:
+            upto = self.seq
+        self.commit()
+        keep_seqs = set(x[0] for x in self.pending)
+        keep = [x for x in self._records if x[0] > upto or x[0] in keep_seqs]
+        if len(keep) == len(self._records):
+            return
+        self.close()
+        if len(keep) == 0:
+            if exists(self.path):
+                os.truncate(self.path, 0)
+        else:
+            tmpfile = self.path + ".tmp"
+            with open(tmpfile, "w") as f:
+                f.writelines(x[1] for x in keep)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpfile, self.path)
+        self._records = keep
+        return
+
+    def close(self):
+        if self._file is not None:
+            self.commit()
+            self._file.close()
+            self._file = None
+        return
+
+    def _write(self, record: dict) -> int:
+        if self._file is None:
+            os.makedirs(dirname(self.path), exist_ok=True)
+            self._file = open(self.path, "a")
+        self.seq += 1
+        line = json.dumps({"seq": self.seq, **record}) + "\n"
+        self._file.write(line)
+        self._records.append((self.seq, line))
+        if self._unsynced == 0:
+            self._first_unsynced = time.monotonic()
+        self._unsynced += 1
+        return self.seq
+
+    def _load(self):
+        if not exists(self.path):
+            return
+        events = []
+        processed = set()
+        offset = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                # A torn final line was never acknowledged (or committed);
+                # cut it off so later appends start on a clean line
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("Incomplete record")
+                    record = json.loads(line)
+                except ValueError:
+                    os.truncate(self.path, offset)
+                    break
+                offset += len(line)
+                self.seq = record["seq"]
+                self._records.append((record["seq"], line.decode("utf-8")))
+                if "commands" in record:
+                    self._commands.extend(record["commands"])
+                    if "event_seq" in record:
+                        processed.add(record["event_seq"])
+                elif "resolved" in record:
+                    self.resolved.update(record["resolved"])
+                else:
+                    events.append((record["seq"], record["event"]))
+        self.pending = deque(x for x in events if x[0] not in processed)
+        return
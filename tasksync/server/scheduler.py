@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+from typing import Callable
+import time
+
+from tasksync.server import (
+    FLUSH_QUIET_PERIOD,
+    FLUSH_MAX_DELAY,
+    FLUSH_MAX_QUEUE,
+)
+
+
+class FlushScheduler:
+    """Decides when queued commands should be pushed to Todoist
+
+    A flush is due at the earliest of:
+
+    - `quiet_period` seconds after the most recent hook event (debounce)
+    - `max_delay` seconds after the oldest unflushed hook event
+    - immediately, once `max_queue` commands/events are waiting
+
+    so a steady trickle of edits can no longer postpone a push indefinitely.
+    After a failed push, `defer()` holds the next flush back until a retry
+    time, whatever else is due.
+    """
+
+    def __init__(
+        self,
+        quiet_period: float = FLUSH_QUIET_PERIOD,
+        max_delay: float = FLUSH_MAX_DELAY,
+        max_queue: int = FLUSH_MAX_QUEUE,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self.clock = clock
+        self.queued = 0
+        self.oldest = None
+        self.latest = None
+        self.not_before = None
+
+    def touch(self, queued: int):
+        """Record a hook event, with `queued` items now waiting to be pushed"""
+        now = self.clock()
+        self.queued = queued
+        if queued == 0:
+            self.oldest = self.latest = None
+            return
+        if self.oldest is None:
+            self.oldest = now
+        self.latest = now
+        return
+
+    def reset(self, queued: int = 0):
+        """Restart the timers after a flush (`queued` items left over)"""
+        self.oldest = self.latest = None
+        if queued > 0:
+            self.touch(queued)
+        else:
+            self.queued = 0
+        return
+
+    def defer(self, delay: float | None):
+        """Hold flushes back for `delay` seconds (None: stop holding back)"""
+        self.not_before = None if delay is None else self.clock() + delay
+        return
+
+    def deadline(self) -> float | None:
+        if self.oldest is None or self.latest is None:
+            return None
+        if self.queued >= self.max_queue:
+            deadline = self.latest
+        else:
+            deadline = min(
+                self.latest + self.quiet_period, self.oldest + self.max_delay
+            )
+        if self.not_before is not None:
+            deadline = max(deadline, self.not_before)
+        return deadline
+
+    def timeout(self) -> float | None:
+        """Seconds until the next flush is due (None if nothing is queued)"""
+        if (deadline := self.deadline()) is None:
+            return None
+        return max(0.0, deadline - self.clock())
+
+    def due(self) -> bool:
+        return (timeout := self.timeout()) is not None and timeout <= 0
+
+    def status(self) -> dict:
+        now = self.clock()
+        return {
+            "quiet_period": self.quiet_period,
+            "max_delay": self.max_delay,
+            "max_queue": self.max_queue,
+            "queued": self.queued,
+            "oldest_age": None if self.oldest is None else now - self.oldest,
+            "next_flush": self.timeout(),
+            "deferred": self.not_before is not None and self.not_before > now,
+        }
@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+from collections import deque
+from concurrent.futures import Future
+import asyncio
 import os
 import json
 import logging
@@ -10,12 +13,30 @@ import sys
 from tasksync.server import (
     SOCKET_PATH,
     SERVER_TIMEOUT,
+    FLUSH_MAX_DELAY,
+    FLUSH_MAX_QUEUE,
+    PUSH_POLL_INTERVAL,
+    PUSH_BACKOFF,
+    PUSH_BACKOFF_MAX,
+    SERVER_BACKLOG,
+    SERVER_MODE,
     CONNECTION_TIMEOUT,
+    PULL_WAIT_TIMEOUT,
     MAX_BUFFER_SIZE,
-    send_data,
-    receive_data,
+    JOURNAL_PATH,
+    FEEDBACK_HISTORY,
+    PROTOCOL_VERSION,
+    ALLOW_LEGACY,
+    send_message,
+    send_message_async,
+    receive_message,
+    receive_message_async,
 )
+from tasksync.server.journal import Journal
+from tasksync.server.scheduler import FlushScheduler
+from tasksync.server.worker import PushWorker
 from tasksync.taskwarrior import TaskwarriorTask
+from tasksync.todoist.api import TodoistPushError, backoff_delay
 from tasksync.todoist.provider import TodoistProvider
 
 
@@ -25,10 +46,39 @@ class TasksyncServer:
         socket_path: str = SOCKET_PATH,
         server_timeout: int = SERVER_TIMEOUT,
         loglevel: int = logging.DEBUG,
+        mode: str = SERVER_MODE,
+        provider: TodoistProvider | None = None,
+        allow_legacy: bool = ALLOW_LEGACY,
+        deferred: bool = False,
+        journal_path: str = JOURNAL_PATH,
+        max_delay: float = FLUSH_MAX_DELAY,
+        max_queue: int = FLUSH_MAX_QUEUE,
     ):
+        if mode not in ("asyncio", "blocking"):
+            raise ValueError("Unknown server mode '{}'".format(mode))
         self.socket_path = socket_path
         self.server_timeout = server_timeout
-        self.provider = TodoistProvider()
+        self.mode = mode
+        self.allow_legacy = allow_legacy
+        self._buffer = bytearray(MAX_BUFFER_SIZE)
+        self.provider = TodoistProvider() if provider is None else provider
+
+        # Hook events and generated commands are journaled until pushed
+        self.deferred = deferred
+        self.journal = Journal(journal_path)
+        self.feedback = deque(maxlen=FEEDBACK_HISTORY)
+        self._commit_handle = None
+
+        # Pushes are debounced by `server_timeout` but never delayed more than
+        # `max_delay` seconds or past `max_queue` queued items
+        self.scheduler = FlushScheduler(
+            quiet_period=server_timeout,
+            max_delay=max_delay,
+            max_queue=max_queue,
+        )
+        self.worker = PushWorker(self.provider.push)
+        self.push_failures = 0
+        self._pull_future = None
 
         # Setup logger
         self.logger = logging.getLogger("tasksync")
@@ -41,6 +91,19 @@ class TasksyncServer:
         self.logger.addHandler(handler)
         self.logger.setLevel(loglevel)
         self.logger.info("Starting Tasksync server")
+        # Replayed commands may refer to temp_ids confirmed before the restart
+        self.provider.pending.resolved.update(self.journal.resolved)
+        if commands := self.journal.replay():
+            self.logger.info("Recovered {} unsynced commands".format(len(commands)))
+            self.provider.commands += commands
+            self.provider.pending.register(commands)
+        if len(self.journal) > 0:
+            self.logger.info(
+                "Recovered {} unprocessed hook events".format(len(self.journal))
+            )
+            for _, event in self.journal.pending:
+                self.provider.pending.pin(_event_uuid(event))
+        self.scheduler.touch(self._queued_count())
 
         # Setup socket
         # remove the socket file if it already exists
@@ -55,14 +118,37 @@ class TasksyncServer:
         self.server.bind(self.socket_path)
 
     def start(self):
+        if self.mode == "asyncio":
+            self._start_asyncio()
+        else:
+            self._start_blocking()
+        return
+
+    def _start_blocking(self):
         # Listen for incoming connections
         self.server.listen(1)
         self.logger.debug("Server is listening for incoming connections...")
+        self.drain()
         while True:
             try:
+                self.collect()
+                if self.worker.busy:
+                    # Keep accepting hooks while the push is in flight
+                    timeout = PUSH_POLL_INTERVAL
+                elif self.scheduler.due():
+                    raise socket.timeout()
+                else:
+                    timeout = self.scheduler.timeout()
+                self.server.settimeout(
+                    self.server_timeout if timeout is None else timeout
+                )
                 self.accept()
+                self.drain()
+                self.journal.maybe_commit()
             except socket.timeout as err:
-                self.sync()
+                self.journal.commit()
+                if not self.worker.busy:
+                    self.sync()
             except TasksyncTermination:
                 self.logger.info("Tasksync shutting down (per request)")
                 self.stop()
@@ -73,38 +159,313 @@ class TasksyncServer:
 
     def stop(self, sync_updates=True, exit_code=0):
         # Sync updates (if indicated)
-        if sync_updates and self.provider.updated:
+        if sync_updates and (
+            self.provider.updated or len(self.journal) > 0 or self.worker.busy
+        ):
             self.logger.debug("Syncing unsaved changes")
-            self.sync()
+            self.sync(wait=True)
             self.logger.debug("Complete")
 
         # Clean up socket
+        self.worker.shutdown()
+        self.journal.close()
         os.unlink(self.socket_path)
 
         # Exit clean
         sys.exit(exit_code)
 
-    def sync(self):
+    def sync(self, wait: bool = False):
+        """Hand queued commands to the push worker
+
+        The command buffer is swapped out, so hooks processed while the push
+        is in flight queue up for the next batch. Only one batch is in flight
+        at a time; if one already is, this is a no-op unless `wait` is set.
+
+        Parameters
+        ----------
+        wait : bool, optional
+            Block until every queued command has been pushed
+        """
+        self.collect()
+        if self.worker.busy:
+            if not wait:
+                return
+            self.worker.wait()
+            self.collect()
+        self.drain()
+        upto = self.journal.seq
         if self.provider.updated:
-            self.provider.push()
+            commands, self.provider.commands = self.provider.commands, []
+            self.worker.submit(commands, upto)
+        else:
+            self.journal.truncate(upto)
+        self.scheduler.reset(self._queued_count())
+        if wait:
+            self.worker.wait()
+            self.collect()
+        return
+
+    def pull(self, full: bool = True) -> Future:
+        """Pull from Todoist into the in-memory store (and Taskwarrior)
+
+        Queued commands are handed to the push worker first, and the pull runs
+        on the same thread, so it always comes after every push already
+        queued and never overlaps one.
+
+        Parameters
+        ----------
+        full : bool, optional
+            Pull every resource type rather than just items
+
+        Returns
+        -------
+        future : Future
+            Resolves once the pull has completed
+        """
+        self.sync()
+        self._pull_future = self.worker.call(self.provider.pull, full=full)
+        return self._pull_future
+
+    async def _wait_for_pull(self, timeout: float | None = None) -> bool:
+        # Hooks resolve names against the store, so let a running pull finish
+        if self._pull_future is not None and not self._pull_future.done():
+            await asyncio.wait(
+                [asyncio.wrap_future(self._pull_future)], timeout=timeout
+            )
+        return self._pull_future is None or self._pull_future.done()
+
+    def collect(self):
+        """Apply the results of batches the push worker has finished
+
+        Commands that could not be pushed for now (e.g. while offline) are
+        queued again and stay in the journal; the next push waits with jittered
+        exponential backoff (or as long as the API asked), and hooks are
+        accepted in the meantime. Commands Todoist rejected for good are not
+        queued again: the provider has dead-lettered them.
+        """
+        for upto, commands, err in self.worker.collect():
+            if isinstance(err, TodoistPushError) and not err.transient:
+                self.logger.error("Push rejected: {}".format(err))
+                err = None
+            if isinstance(err, TodoistPushError):
+                self.provider.commands[:0] = err.commands
+                delay = max(
+                    backoff_delay(self.push_failures, PUSH_BACKOFF, PUSH_BACKOFF_MAX),
+                    err.retry_after or 0,
+                )
+                self.push_failures += 1
+                self.scheduler.defer(delay)
+                self.scheduler.touch(self._queued_count())
+                self.logger.warning(
+                    "Push failed, retrying in {:.0f}s: {}".format(delay, err)
+                )
+                continue
+            if err is not None:
+                # Put the batch back in front so ordering is preserved
+                self.provider.commands[:0] = commands
+                self.scheduler.touch(self._queued_count())
+                raise err
+            if self.push_failures > 0:
+                self.push_failures = 0
+                self.scheduler.defer(None)
+            # Later records may use this batch's temp_ids; keep the real ids
+            # in the journal for when they are replayed
+            if self.journal.seq > upto and (
+                resolved := self.provider.pending.confirmed(commands)
+            ):
+                self.journal.append_resolved(resolved)
+            self.journal.truncate(upto)
+        return
+
+    def drain(self, limit: int | None = None) -> int:
+        """Process hook events that were acknowledged in deferred mode
+
+        Parameters
+        ----------
+        limit : int, optional
+            Maximum number of events to process (default: all of them)
+
+        Returns
+        -------
+        count : int
+            Number of events processed
+        """
+        count = 0
+        while limit is None or count < limit:
+            if (pending := self.journal.pop()) is None:
+                break
+            event_seq, data = pending
+            try:
+                feedback = self._process_event(data, event_seq=event_seq)
+            except Exception as err:
+                feedback = self._get_error_message(err)
+                self.logger.error(feedback)
+            self.provider.pending.unpin(_event_uuid(data))
+            self._record_feedback(data, feedback)
+            count += 1
+        return count
+
+    def _record_feedback(self, data: dict, feedback: str):
+        task = json.loads(data["args"][-1])
+        self.feedback.append(
+            {
+                "uuid": task.get("uuid"),
+                "description": task.get("description"),
+                "feedback": feedback,
+            }
+        )
+        return
 
     def accept(self):
         connection, client_address = self.server.accept()
         self.logger.debug("Connection received")
         connection.settimeout(CONNECTION_TIMEOUT)
+        version = PROTOCOL_VERSION
         try:
-            data = receive_data(connection)
+            data, version = receive_message(
+                connection, self._buffer, allow_legacy=self.allow_legacy
+            )
             feedback = self._process(data)
-            send_data(connection, feedback)
+            send_message(connection, feedback, version)
         except socket.timeout:
             raise TasksyncTimeoutError()
         except Exception as err:
-            send_data(connection, self._get_error_message(err))
+            send_message(connection, self._get_error_message(err), version)
             connection.close()
             raise err
         else:
             connection.close()
 
+    def _start_asyncio(self):
+        try:
+            asyncio.run(self._serve())
+        except Exception as err:
+            self.logger.error(self._get_error_message(err))
+            self.stop(exit_code=100)
+        else:
+            self.logger.info("Tasksync shutting down (per request)")
+            self.stop()
+        return
+
+    async def _serve(self):
+        """Accept hook connections concurrently until a stop is requested
+
+        Each connection is handled on its own task, so a slow or stalled client
+        never holds up the others. Flushing to Todoist runs on a separate task
+        whenever the scheduler says a flush is due.
+        """
+        self._shutdown = asyncio.Event()
+        self._queued = asyncio.Event()
+        self._activity = asyncio.Event()
+        server = await asyncio.start_unix_server(
+            self._handle_connection,
+            sock=self.server,
+            backlog=SERVER_BACKLOG,
+        )
+        self.logger.debug("Server is listening for incoming connections...")
+        async with server:
+            tasks = [
+                asyncio.create_task(self._flush_loop()),
+                asyncio.create_task(self._drain_loop()),
+                asyncio.create_task(self._shutdown.wait()),
+            ]
+            self._queued.set()
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                task.cancel()
+            # Surface errors raised while flushing/draining
+            for task in tasks:
+                if task.done() and not task.cancelled():
+                    task.result()
+        return
+
+    async def _flush_loop(self):
+        while True:
+            if self.scheduler.due():
+                # sync() drains deferred events, which resolve against the store
+                await self._wait_for_pull()
+                self.sync()
+                # Wait for the push off the event loop, then apply the result
+                if future := self.worker.future:
+                    await asyncio.wait([asyncio.wrap_future(future)])
+                    self.collect()
+                continue
+            # Sleep until the deadline, re-evaluating whenever a hook comes in
+            try:
+                await asyncio.wait_for(
+                    self._activity.wait(),
+                    self.scheduler.timeout(),
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._activity.clear()
+
+    def _schedule_commit(self):
+        if self.journal.dirty and self._commit_handle is None:
+            self._commit_handle = asyncio.get_running_loop().call_later(
+                self.journal.group_interval, self._commit
+            )
+        return
+
+    def _commit(self):
+        self._commit_handle = None
+        self.journal.commit()
+        return
+
+    async def _drain_loop(self):
+        while True:
+            await self._queued.wait()
+            self._queued.clear()
+            await self._wait_for_pull()
+            # One event at a time so new connections are accepted in between
+            while self.drain(limit=1) > 0:
+                self._schedule_commit()
+                await asyncio.sleep(0)
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        self.logger.debug("Connection received")
+        try:
+            data, version = await asyncio.wait_for(
+                receive_message_async(reader, writer, allow_legacy=self.allow_legacy),
+                CONNECTION_TIMEOUT,
+            )
+            try:
+                method = data.get("method")
+                if method == "pull":
+                    feedback = await self._process_pull_async(data)
+                else:
+                    if method in self._deferred_methods and not self.deferred:
+                        # Give up before the hook does, so that it is told
+                        # the event was dropped rather than processed later
+                        if not await self._wait_for_pull(timeout=PULL_WAIT_TIMEOUT):
+                            raise TasksyncTimeoutError(
+                                "A pull is still running; the update was not sent"
+                            )
+                    feedback = self._process(data)
+                if self.deferred:
+                    self._queued.set()
+                self._schedule_commit()
+                self._activity.set()
+            except TasksyncTermination as err:
+                feedback = self._get_error_message(err)
+                self._shutdown.set()
+            except Exception as err:
+                self.logger.error(self._get_error_message(err))
+                feedback = self._get_error_message(err)
+            await asyncio.wait_for(
+                send_message_async(reader, writer, feedback, version),
+                CONNECTION_TIMEOUT,
+            )
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError) as err:
+            self.logger.warning(
+                "Dropped connection: {}".format(self._get_error_message(err))
+            )
+        finally:
+            writer.close()
+        return
+
     def _get_error_message(self, err) -> str:
         return "{} raised: {}".format(type(err).__name__, err)
 
@@ -113,6 +474,19 @@ class TasksyncServer:
         if "method" not in data:
             raise TasksyncBadRequestError("No method specified")
 
+        # Task updates are journaled; in deferred mode they are acknowledged
+        # now and processed later
+        if data["method"] in self._deferred_methods:
+            if self.deferred:
+                self.journal.append_event(data)
+                # The event's task may only get its Todoist ID after this
+                self.provider.pending.pin(_event_uuid(data))
+                feedback = "Todoist: update queued"
+            else:
+                feedback = self._process_event(data)
+            self.scheduler.touch(self._queued_count())
+            return feedback
+
         # Process data
         if _processor := self._processor_map.get(data["method"]):
             return _processor(self, data)
@@ -121,6 +495,20 @@ class TasksyncServer:
                 "No processor defined for method '{}'".format(data["method"])
             )
 
+    def _process_event(self, data: dict, event_seq: int | None = None) -> str:
+        ncommands = len(self.provider.commands)
+        feedback = self._processor_map[data["method"]](self, data)
+        commands = self.provider.commands[ncommands:]
+        if event_seq is not None:
+            # Always mark deferred events as processed
+            self.journal.append_commands(commands, event_seq=event_seq)
+        elif len(commands) > 0:
+            self.journal.append_commands(commands, event=data)
+        return feedback
+
+    def _queued_count(self) -> int:
+        return len(self.provider.commands) + len(self.journal)
+
     def _process_on_add(self, data: dict) -> str:
         task = TaskwarriorTask.from_taskwarrior(data["args"][0])
         task_str_out, feedback = self.provider.on_add(task)
@@ -131,18 +519,51 @@ class TasksyncServer:
         task_str_out, feedback = self.provider.on_modify(task_old, task_new)
         return feedback
 
-    def _process_status(self, data: dict) -> str:
-        return str(os.getpid())
+    def _process_status(self, data: dict) -> dict:
+        return {
+            "pid": os.getpid(),
+            "mode": self.mode,
+            "deferred": self.deferred,
+            "scheduler": self.scheduler.status(),
+            "compacted": self.provider.compacted,
+            "writeback": len(self.provider.writeback),
+            "push_failures": self.push_failures,
+            "rejected": self.provider.rejected,
+            "rate_limit": self.provider.rate_limit(),
+        }
+
+    def _process_pull(self, data: dict) -> str:
+        # A failed pull is reported to the client but does not stop the server
+        if err := self.pull(*data.get("args", [])).exception():
+            self.logger.error(self._get_error_message(err))
+            return self._get_error_message(err)
+        self.collect()
+        return "Todoist: pull complete"
+
+    async def _process_pull_async(self, data: dict) -> str:
+        future = self.pull(*data.get("args", []))
+        await asyncio.wait([asyncio.wrap_future(future)])
+        if err := future.exception():
+            self.logger.error(self._get_error_message(err))
+            return self._get_error_message(err)
+        self.collect()
+        return "Todoist: pull complete"
 
     def _process_stop(self, data: dict) -> str:
         raise TasksyncTermination("Tasksync shutting down...")
 
+    def _process_feedback(self, data: dict) -> list:
+        return list(self.feedback)
+
     _processor_map = {
         "on-add": _process_on_add,
         "on-modify": _process_on_modify,
         "status": _process_status,
         "stop": _process_stop,
+        "feedback": _process_feedback,
+        "pull": _process_pull,
     }
+    _deferred_methods = ("on-add", "on-modify")
 
 
 class TasksyncServerError(Exception):
@@ -165,6 +586,11 @@ class TasksyncTimeoutError(Exception):
     pass
 
 
+def _event_uuid(data: dict) -> str:
+    """Taskwarrior uuid of the task a hook event is about"""
+    return json.loads(data["args"][-1]).get("uuid")
+
+
 if __name__ == "__main__":
     server = TasksyncServer()
     server.start()
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+
+class PushWorker:
+    """Pushes batches of commands to Todoist on a dedicated thread
+
+    The server swaps out its command buffer and hands it to `submit()`, so
+    hook events keep landing in a fresh buffer while the previous batch is in
+    flight. A single worker thread pushes batches strictly in submission
+    order; finished batches are handed back through `collect()` so the caller
+    can update its own state (e.g. truncate the journal) on its own thread.
+    """
+
+    def __init__(self, push: Callable[[list], object]):
+        self.push = push
+        self.inflight = deque()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="tasksync-push"
+        )
+
+    @property
+    def busy(self) -> bool:
+        return len(self.inflight) > 0
+
+    @property
+    def future(self) -> Future | None:
+        """Future of the oldest batch still in flight"""
+        return self.inflight[0][2] if self.inflight else None
+
+    def submit(self, commands: list, upto: int) -> Future:
+        """Queue `commands` (journaled up to sequence `upto`) for pushing"""
+        future = self._executor.submit(self.push, commands)
+        self.inflight.append((upto, commands, future))
+        return future
+
+    def call(self, fn: Callable, *args, **kwargs) -> Future:
+        """Run `fn` on the worker thread once every batch submitted so far is pushed"""
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def collect(self) -> list[tuple[int, list, BaseException | None]]:
+        """Pop finished batches, in order, as (upto, commands, error) tuples"""
+        done = []
+        while self.inflight and self.inflight[0][2].done():
+            upto, commands, future = self.inflight.popleft()
+            done.append((upto, commands, future.exception()))
+        return done
+
+    def wait(self):
+        for _, _, future in list(self.inflight):
+            future.exception()
+        return
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+        return
@@ -1 +1,2 @@
-from .models import TaskwarriorTask
\ No newline at end of file
+from .models import TaskwarriorTask
+from .reader import TaskwarriorReader
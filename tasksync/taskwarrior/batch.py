@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import json
+import logging
+import subprocess
+
+TASK_BIN = "task"
+TASK_OVERRIDES = ["rc.hooks=off", "rc.verbose=nothing", "rc.confirmation=off"]
+IMPORT_CHUNK_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+
+class TaskwarriorCommandError(RuntimeError):
+    """A `task` invocation exited with a non-zero status"""
+
+    def __init__(self, args: list, returncode: int, stderr: str):
+        self.returncode = returncode
+        self.stderr = stderr
+        super().__init__(
+            "task {} exited with status {}: {}".format(
+                " ".join(args), returncode, stderr.strip()
+            )
+        )
+
+
+def run_task(args: list, input: str | None = None) -> str:
+    """Run `task` with hooks disabled and return its stdout
+
+    Raises
+    ------
+    TaskwarriorCommandError
+        If `task` exits with a non-zero status
+    """
+    res = subprocess.run(
+        [TASK_BIN, *TASK_OVERRIDES, *args],
+        input=input,
+        capture_output=True,
+        text=True,
+    )
+    if res.returncode != 0:
+        raise TaskwarriorCommandError(args, res.returncode, res.stderr)
+    return res.stdout
+
+
+def export_tasks(uuids: list[str]) -> list[dict]:
+    """Export the tasks with the given uuids in a single `task` invocation"""
+    if len(uuids) == 0:
+        return []
+    return json.loads(run_task([*uuids, "export"]) or "[]")
+
+
+def import_tasks(tasks: list[dict]) -> None:
+    """Write full task records to Taskwarrior, `IMPORT_CHUNK_SIZE` per `task import`
+
+    Taskwarrior replaces an existing task with the imported record, so each
+    record must be complete (e.g. from `export_tasks`), not a partial update.
+    """
+    for i in range(0, len(tasks), IMPORT_CHUNK_SIZE):
+        run_task(["import", "-"], input=json.dumps(tasks[i : i + IMPORT_CHUNK_SIZE]))
+    return
+
+
+def modify_tasks(changes: dict[str, dict]) -> dict[str, dict]:
+    """Apply attribute changes to many tasks with two `task` calls per chunk
+
+    Each chunk of `IMPORT_CHUNK_SIZE` tasks is exported, updated in memory and
+    imported back, instead of running one `task <uuid> modify` per task.
+
+    Parameters
+    ----------
+    changes : dict
+        Task uuid -> attributes to set on that task
+
+    Returns
+    -------
+    failed : dict
+        The subset of `changes` that could not be applied, either because the
+        task does not exist (yet) or because `task` failed
+    """
+    failed = {}
+    uuids = list(changes)
+    for i in range(0, len(uuids), IMPORT_CHUNK_SIZE):
+        chunk = uuids[i : i + IMPORT_CHUNK_SIZE]
+        try:
+            tasks = [x for x in export_tasks(chunk) if x.get("uuid") in changes]
+            for task in tasks:
+                task.update(changes[task["uuid"]])
+                # Taskwarrior computes these; they are not importable
+                task.pop("id", None)
+                task.pop("urgency", None)
+            import_tasks(tasks)
+        except TaskwarriorCommandError as e:
+            logger.warning(
+                "Could not update {} tasks: {}".format(len(chunk), e.stderr.strip())
+            )
+            failed.update((x, changes[x]) for x in chunk)
+            continue
+        found = set(x["uuid"] for x in tasks)
+        failed.update((x, changes[x]) for x in chunk if x not in found)
+    return failed
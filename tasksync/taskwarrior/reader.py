@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import datetime
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from tasksync.models import TASKWARRIOR_DATETIME_FORMAT
+from tasksync.taskwarrior.models import TaskwarriorTask
+
+TASKRC = "~/.taskrc"
+TASKDATA = "~/.task"
+DATA_FILES = ["pending.data", "completed.data"]
+TASKCHAMPION_FILE = "taskchampion.sqlite3"
+DATE_ATTRIBUTES = [
+    "entry",
+    "start",
+    "end",
+    "due",
+    "until",
+    "wait",
+    "modified",
+    "scheduled",
+]
+PENDING_STATUSES = ["pending", "waiting", "recurring"]
+
+F4_ATTRIBUTE = re.compile(r'([^\s:"]+):"((?:[^"\\]|\\.)*)"')
+F4_ENTITIES = {"&open;": "[", "&close;": "]", "&dquot;": '"'}
+
+
+class TaskwarriorReader:
+    """Read-only view of the Taskwarrior database without running `task`
+
+    Parses `pending.data`/`completed.data` (Taskwarrior 2) or
+    `taskchampion.sqlite3` (Taskwarrior 3) into records shaped like the output
+    of `task export`. The parsed records are cached until one of the files
+    changes size or modification time, so repeated lookups are free.
+
+    Nothing computed by Taskwarrior at export time (urgency, recurrence,
+    waiting status) is reproduced. `records` returns None when no database is
+    found, in which case callers should fall back to `task export`.
+    """
+
+    def __init__(self, data_location: str | None = None):
+        self.data_location = (
+            find_data_location() if data_location is None else data_location
+        )
+        self._signature = None
+        self._records = []
+        self._uuids = {}
+        self._todoist = {}
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self) -> str | None:
+        """The database found: "taskchampion", "file" or None"""
+        if os.path.exists(os.path.join(self.data_location, TASKCHAMPION_FILE)):
+            return "taskchampion"
+        if os.path.exists(os.path.join(self.data_location, DATA_FILES[0])):
+            return "file"
+        return None
+
+    def records(self) -> list[dict] | None:
+        """Return every task as a `task export` record, or None if unavailable"""
+        with self._lock:
+            if (backend := self.backend) is None:
+                return None
+            if (signature := self._stat(backend)) != self._signature:
+                if backend == "taskchampion":
+                    records = read_taskchampion(self.data_location)
+                else:
+                    records = read_data_files(self.data_location)
+                self._index(records)
+                self._signature = signature
+            return self._records
+
+    def tasks(self) -> list[TaskwarriorTask]:
+        return [TaskwarriorTask.from_taskwarrior(x) for x in self.records() or []]
+
+    def get(self, uuid: str) -> TaskwarriorTask | None:
+        """Return the task with the given uuid"""
+        self.records()
+        if (record := self._uuids.get(str(uuid))) is None:
+            return None
+        return TaskwarriorTask.from_taskwarrior(record)
+
+    def find(self, todoist: str) -> TaskwarriorTask | None:
+        """Return the task linked to a Todoist ID through the `todoist` UDA"""
+        self.records()
+        if (record := self._todoist.get(str(todoist))) is None:
+            return None
+        return TaskwarriorTask.from_taskwarrior(record)
+
+    def _stat(self, backend: str) -> tuple:
+        if backend == "taskchampion":
+            names = [TASKCHAMPION_FILE, TASKCHAMPION_FILE + "-wal"]
+        else:
+            names = DATA_FILES
+        out = []
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self.data_location, name))
+            except FileNotFoundError:
+                continue
+            out.append((name, stat.st_mtime_ns, stat.st_size))
+        return tuple(out)
+
+    def _index(self, records: list[dict]):
+        self._records = records
+        self._uuids = dict((x["uuid"], x) for x in records)
+        self._todoist = dict(
+            (str(x["todoist"]), x) for x in records if x.get("todoist") is not None
+        )
+        return
+
+
+def find_data_location() -> str:
+    """Resolve the data directory like `task` does (TASKDATA, then the taskrc)"""
+    if location := os.environ.get("TASKDATA"):
+        return os.path.expanduser(location)
+    location = TASKDATA
+    try:
+        with open(os.path.expanduser(os.environ.get("TASKRC", TASKRC))) as f:
+            for line in f:
+                key, _, value = line.partition("=")
+                if key.strip() == "data.location":
+                    location = value.split("#")[0].strip()
+    except OSError:
+        pass
+    return os.path.expanduser(location)
+
+
+def read_data_files(data_location: str) -> list[dict]:
+    """Parse Taskwarrior 2 `pending.data` and `completed.data` (format 4)"""
+    out = []
+    working_set = 0
+    for name in DATA_FILES:
+        try:
+            f = open(os.path.join(data_location, name), encoding="utf-8")
+        except FileNotFoundError:
+            continue
+        with f:
+            for line in f:
+                line = line.strip()
+                if not (line.startswith("[") and line.endswith("]")):
+                    continue
+                data = dict(
+                    (key, decode_f4(value))
+                    for key, value in F4_ATTRIBUTE.findall(line[1:-1])
+                )
+                record = to_record(data)
+                # IDs follow the order of pending.data; export gives others 0
+                record["id"] = 0
+                if name == DATA_FILES[0]:
+                    working_set += 1
+                    if record.get("status") in PENDING_STATUSES:
+                        record["id"] = working_set
+                out.append(record)
+    return out
+
+
+def read_taskchampion(data_location: str) -> list[dict]:
+    """Read the Taskwarrior 3 (TaskChampion) SQLite database"""
+    path = os.path.join(data_location, TASKCHAMPION_FILE)
+    con = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+    try:
+        ids = dict(
+            (uuid, id_)
+            for id_, uuid in con.execute("SELECT id, uuid FROM working_set")
+            if uuid is not None
+        )
+        out = []
+        for uuid, data in con.execute("SELECT uuid, data FROM tasks"):
+            data = json.loads(data)
+            data["uuid"] = uuid
+            tags = [x[4:] for x in data if x.startswith("tag_")]
+            depends = [x[4:] for x in data if x.startswith("dep_")]
+            data = dict(
+                (k, v) for k, v in data.items() if not k.startswith(("tag_", "dep_"))
+            )
+            if tags:
+                data["tags"] = ",".join(tags)
+            if depends:
+                data["depends"] = ",".join(depends)
+            record = to_record(data)
+            record["id"] = 0
+            if uuid in ids and record.get("status") in PENDING_STATUSES:
+                record["id"] = ids[uuid]
+            out.append(record)
+    finally:
+        con.close()
+    return out
+
+
+def decode_f4(value: str) -> str:
+    if "\\" in value:
+        value = json.loads('"{}"'.format(value))
+    if "&" in value:
+        for entity, char in F4_ENTITIES.items():
+            value = value.replace(entity, char)
+    return value
+
+
+def to_record(data: dict) -> dict:
+    """Convert stored attributes (epoch dates, comma lists) to export format"""
+    out = {}
+    annotations = []
+    for key, value in data.items():
+        if key.startswith("annotation_"):
+            annotations.append((int(key[11:]), value))
+        elif key in DATE_ATTRIBUTES:
+            out[key] = convert_epoch(value)
+        elif key in ("tags", "depends"):
+            if values := [x for x in value.split(",") if x]:
+                out[key] = values
+        else:
+            out[key] = value
+    if annotations:
+        out["annotations"] = [
+            {"entry": convert_epoch(str(entry)), "description": description}
+            for entry, description in sorted(annotations)
+        ]
+    return out
+
+
+def convert_epoch(value: str) -> str:
+    if not value.isdigit():
+        return value
+    return datetime.datetime.fromtimestamp(
+        int(value), datetime.timezone.utc
+    ).strftime(TASKWARRIOR_DATETIME_FORMAT)
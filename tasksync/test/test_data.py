@@ -1,6 +1,8 @@
 from __future__ import annotations
 
 import json
+import os
+import sys
 
 from tasksync.models import TasksyncDatetime
 from todoist_api_python.models import Task as TodoistTask, Due as TodoistDueDate
@@ -72,4 +74,37 @@ def get_todoist(due_datetime=False):
             'datetime': '2023-08-28T13:00:00Z',
             'timezone': 'America/New_York'
         })
-    return todoist
\ No newline at end of file
+    return todoist
+
+FAKE_TASK = """#!{python}
+import json, os, sys
+db = os.path.join(os.path.dirname(__file__), 'tasks.json')
+with open(os.path.join(os.path.dirname(__file__), 'calls.log'), 'a') as f:
+    f.write(' '.join(sys.argv[1:]) + '\\n')
+if os.path.exists(os.path.join(os.path.dirname(__file__), 'fail')):
+    sys.stderr.write('database is locked')
+    sys.exit(2)
+tasks = json.load(open(db))
+args = [x for x in sys.argv[1:] if not x.startswith('rc.')]
+if args[-1] == 'export':
+    uuids = set(args[:-1])
+    print(json.dumps([x for x in tasks if not uuids or x['uuid'] in uuids]))
+elif args[0] == 'import':
+    by_uuid = dict((x['uuid'], x) for x in tasks)
+    by_uuid.update((x['uuid'], x) for x in json.load(sys.stdin))
+    json.dump(list(by_uuid.values()), open(db, 'w'))
+"""
+
+def write_fake_task(basedir, tasks=()) -> str:
+    """Write a stand-in `task` binary backed by tasks.json in `basedir`
+
+    It supports `<uuid>... export` and `import -`, logs every call to
+    calls.log, and fails while a file called `fail` exists in `basedir`.
+    """
+    path = os.path.join(basedir, 'task')
+    with open(path, 'w') as f:
+        f.write(FAKE_TASK.format(python=sys.executable))
+    os.chmod(path, 0o755)
+    with open(os.path.join(basedir, 'tasks.json'), 'w') as f:
+        json.dump(list(tasks), f)
+    return path
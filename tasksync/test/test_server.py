@@ -0,0 +1,622 @@
+#!/usr/bin/env python3
+
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+from os.path import dirname, join
+import socket
+import threading
+import time
+
+from tasksync.server import (
+    CONNECTION_TIMEOUT,
+    FRAME_HEADER,
+    PROTOCOL_FRAMED,
+    PROTOCOL_LEGACY,
+    encode_frame,
+    parse_header,
+    receive_message,
+    recv_frame,
+    send_frame,
+)
+from tasksync.server.client import TasksyncClient
+from tasksync.server.server import TasksyncServer
+from tasksync.server.journal import Journal
+from tasksync.server.scheduler import FlushScheduler
+from tasksync.todoist.api import TodoistPushError, TodoistSyncAPI, TodoistSyncDataStore
+from tasksync.todoist.ratelimit import RATE_LIMIT_REQUESTS
+from tasksync.todoist.provider import TodoistProvider
+
+from test_data import get_taskwarrior_input
+
+DATADIR = join(dirname(__file__), 'data')
+
+def run_server(server):
+    # TasksyncServer.stop() exits the process; contain that to the thread
+    try:
+        server.start()
+    except SystemExit:
+        pass
+
+def start_server(socket_path, **kwargs):
+    provider = TodoistProvider(store=TodoistSyncDataStore(basedir=DATADIR))
+    kwargs.setdefault('journal_path', join(dirname(socket_path), 'journal'))
+    server = TasksyncServer(
+        socket_path=socket_path,
+        provider=provider,
+        **kwargs,
+    )
+    thread = threading.Thread(target=run_server, args=(server,), daemon=True)
+    thread.start()
+    # Wait for the server to start accepting connections
+    for _ in range(100):
+        try:
+            client = TasksyncClient(socket_path)
+            client.connect()
+            client.status()
+            client.close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return server, thread
+
+def send(socket_path, method, *args, protocol=PROTOCOL_FRAMED):
+    client = TasksyncClient(socket_path, protocol=protocol)
+    client.connect()
+    res = getattr(client, method)(*args)
+    client.close()
+    return res
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+@pytest.fixture(params=['asyncio', 'blocking'])
+def server(request, tmp_path):
+    socket_path = str(tmp_path / 'tasksync')
+    server, thread = start_server(
+        socket_path, mode=request.param, server_timeout=60, max_queue=1000
+    )
+    yield server
+    # Drop queued commands so shutdown does not attempt a push
+    server.provider.commands.clear()
+    send(socket_path, 'stop')
+    thread.join(timeout=5)
+
+class TestTasksyncServer:
+
+    def test_unknown_mode(self, tmp_path):
+        with pytest.raises(ValueError):
+            TasksyncServer(socket_path=str(tmp_path / 'tasksync'), mode='foo')
+
+    def test_status(self, server):
+        status = send(server.socket_path, 'status')
+        assert status['pid'] > 0
+        assert status['mode'] == server.mode
+        assert status['scheduler']['quiet_period'] == 60
+        assert status['scheduler']['queued'] == 0
+        assert status['scheduler']['next_flush'] is None
+        assert status['rate_limit']['capacity'] == RATE_LIMIT_REQUESTS
+        assert 0 <= status['rate_limit']['remaining'] <= RATE_LIMIT_REQUESTS
+
+    def test_status_queued(self, server):
+        send(server.socket_path, 'on_add', get_taskwarrior_input('str'))
+        status = send(server.socket_path, 'status')
+        assert status['scheduler']['queued'] == 1
+        assert 0 < status['scheduler']['next_flush'] <= 60
+
+    @pytest.mark.parametrize('mode', ['asyncio', 'blocking'])
+    def test_max_queue_flush(self, tmp_path, mode):
+        socket_path = str(tmp_path / 'tasksync')
+        server, thread = start_server(
+            socket_path, mode=mode, server_timeout=60, max_queue=3
+        )
+        pushed = []
+        server.worker.push = pushed.append
+        for _ in range(3):
+            send(socket_path, 'on_add', get_taskwarrior_input('str'))
+        assert wait_for(lambda: len(pushed) == 1)
+        assert len(pushed[0]) == 3
+        send(socket_path, 'stop')
+        thread.join(timeout=5)
+
+    def test_on_add(self, server):
+        feedback = send(server.socket_path, 'on_add', get_taskwarrior_input('str'))
+        assert feedback == 'Todoist: item created'
+        assert len(server.provider.commands) == 1
+        # The journal record is group committed shortly afterwards
+        if server.mode == 'asyncio':
+            assert wait_for(lambda: not server.journal.dirty)
+
+    @pytest.mark.parametrize('mode', ['asyncio', 'blocking'])
+    @pytest.mark.parametrize('protocol', [PROTOCOL_LEGACY, PROTOCOL_FRAMED])
+    def test_protocol_negotiation(self, tmp_path, mode, protocol):
+        socket_path = str(tmp_path / 'tasksync')
+        server, thread = start_server(
+            socket_path, mode=mode, server_timeout=60, allow_legacy=True
+        )
+        feedback = send(
+            socket_path,
+            'on_add',
+            get_taskwarrior_input('str'),
+            protocol=protocol,
+        )
+        assert feedback == 'Todoist: item created'
+        server.provider.commands.clear()
+        send(socket_path, 'stop')
+        thread.join(timeout=5)
+
+    def test_legacy_disabled(self, tmp_path):
+        socket_path = str(tmp_path / 'tasksync')
+        server, thread = start_server(socket_path, mode='asyncio')
+        assert not server.allow_legacy
+        with pytest.raises(OSError):
+            send(socket_path, 'on_add', get_taskwarrior_input('str'), protocol=PROTOCOL_LEGACY)
+        assert server.provider.commands == []
+        assert send(socket_path, 'status')['pid'] > 0
+        send(socket_path, 'stop')
+        thread.join(timeout=5)
+
+    def test_concurrent_connections(self, server):
+        if server.mode == 'blocking':
+            pytest.skip('blocking server only accepts one pending connection')
+        task_str = get_taskwarrior_input('str')
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            results = list(pool.map(
+                lambda _: send(server.socket_path, 'on_add', task_str),
+                range(200),
+            ))
+        assert all(x == 'Todoist: item created' for x in results)
+        assert len(server.provider.commands) == 200
+
+    @pytest.mark.parametrize('mode', ['asyncio', 'blocking'])
+    def test_deferred(self, tmp_path, mode):
+        socket_path = str(tmp_path / 'tasksync')
+        server, thread = start_server(socket_path, mode=mode, deferred=True)
+        task_str = get_taskwarrior_input('str')
+        feedback = send(socket_path, 'on_add', task_str)
+        assert feedback == 'Todoist: update queued'
+        assert wait_for(lambda: len(server.provider.commands) == 1)
+        entries = send(socket_path, 'feedback')
+        assert entries[-1]['feedback'] == 'Todoist: item created'
+        assert entries[-1]['uuid'] == get_taskwarrior_input()['uuid']
+        server.provider.commands.clear()
+        send(socket_path, 'stop')
+        thread.join(timeout=5)
+
+    def test_deferred_replay(self, tmp_path):
+        journal = Journal(str(tmp_path / 'journal'))
+        journal.append_event({'method': 'on-add', 'args': [get_taskwarrior_input('str')]})
+        journal.close()
+
+        socket_path = str(tmp_path / 'tasksync')
+        server, thread = start_server(socket_path, mode='asyncio')
+        assert wait_for(lambda: len(server.provider.commands) == 1)
+        server.provider.commands.clear()
+        send(socket_path, 'stop')
+        thread.join(timeout=5)
+
+    def test_deferred_flush_waits_for_pull(self, tmp_path):
+        socket_path = str(tmp_path / 'tasksync')
+        server, thread = start_server(
+            socket_path, mode='asyncio', deferred=True, max_queue=1
+        )
+        started, release = threading.Event(), threading.Event()
+        def pull(full=False):
+            started.set()
+            release.wait(5)
+        server.provider.pull = pull
+        server.worker.push = lambda commands: None
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pulled = executor.submit(send, socket_path, 'pull')
+            assert started.wait(5)
+            # The flush is due at once, but the event is not processed mid-pull
+            assert send(socket_path, 'on_add', get_taskwarrior_input('str')) == 'Todoist: update queued'
+            time.sleep(0.2)
+            assert len(server.journal) == 1
+            # Its task's temp_id must outlive the write-back until processed
+            assert server.provider.pending.pinned == {get_taskwarrior_input()['uuid']: 1}
+            release.set()
+            assert pulled.result(5) == 'Todoist: pull complete'
+        assert wait_for(lambda: len(server.journal) == 0)
+        assert server.provider.pending.pinned == {}
+        send(socket_path, 'stop')
+        thread.join(timeout=5)
+
+    def test_hook_during_long_pull(self, tmp_path):
+        socket_path = str(tmp_path / 'tasksync')
+        server, thread = start_server(socket_path, mode='asyncio', server_timeout=60)
+        started, release = threading.Event(), threading.Event()
+        def pull(full=False):
+            started.set()
+            # Outlasts the hook's CONNECTION_TIMEOUT
+            release.wait(CONNECTION_TIMEOUT * 2)
+        server.provider.pull = pull
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pulled = executor.submit(send, socket_path, 'pull')
+            assert started.wait(5)
+            start = time.time()
+            feedback = send(socket_path, 'on_add', get_taskwarrior_input('str'))
+            assert time.time() - start < CONNECTION_TIMEOUT
+            assert feedback.startswith('TasksyncTimeoutError')
+            release.set()
+            assert pulled.result(5) == 'Todoist: pull complete'
+        # The hook was told the update failed, so nothing may be sent later
+        time.sleep(0.2)
+        assert server.provider.commands == []
+        assert len(server.journal) == 0
+        send(socket_path, 'stop')
+        thread.join(timeout=5)
+
+    def test_journal_replay(self, tmp_path):
+        socket_path = str(tmp_path / 'tasksync')
+        server, thread = start_server(socket_path, mode='asyncio')
+        send(socket_path, 'on_add', get_taskwarrior_input('str'))
+        commands = list(server.provider.commands)
+        # Simulate a crash: nothing pushed, journal left behind
+        server.journal.close()
+        server.provider.commands.clear()
+        send(socket_path, 'stop')
+        thread.join(timeout=5)
+
+        server, thread = start_server(socket_path, mode='asyncio')
+        assert server.provider.commands == commands
+        server.provider.commands.clear()
+        send(socket_path, 'stop')
+        thread.join(timeout=5)
+
+    def test_journal_replay_resolved(self, tmp_path):
+        def new_server():
+            return TasksyncServer(
+                socket_path=str(tmp_path / 'tasksync'),
+                provider=TodoistProvider(store=TodoistSyncDataStore(basedir=DATADIR)),
+                journal_path=str(tmp_path / 'journal'),
+            )
+        server = new_server()
+        create = TodoistSyncAPI.create_project('Work', 'p')
+        server.provider.commands.append(create)
+        server.provider.pending.register([create])
+        server.journal.append_commands([create], event={})
+        release = threading.Event()
+        def push(commands):
+            release.wait(5)
+            server.provider.pending.reconcile(commands, {'p': '123'})
+        server.worker.push = push
+        server.sync()
+        # A hook handled while the batch is in flight reuses its temp_id
+        add = TodoistSyncAPI.add_item('Task', 'i', project_id=server.provider.pending.find_project('Work'))
+        server.provider.commands.append(add)
+        server.journal.append_commands([add], event={})
+        release.set()
+        server.worker.wait()
+        server.collect()
+        # Crash before the next push: the replayed item still finds the project
+        server.journal.close()
+        server.worker.shutdown()
+        server.server.close()
+        server = new_server()
+        assert server.provider.commands == [add]
+        assert server.provider.pending.resolve([add])[0]['args']['project_id'] == '123'
+        server.worker.shutdown()
+        server.server.close()
+
+    @pytest.mark.parametrize('mode', ['asyncio', 'blocking'])
+    def test_push_does_not_block_hooks(self, tmp_path, mode):
+        socket_path = str(tmp_path / 'tasksync')
+        server, thread = start_server(
+            socket_path, mode=mode, server_timeout=60, max_queue=1
+        )
+        release = threading.Event()
+        pushed = []
+        def slow_push(commands):
+            release.wait(5)
+            pushed.append(commands)
+        server.worker.push = slow_push
+
+        task_str = get_taskwarrior_input('str')
+        send(socket_path, 'on_add', task_str)
+        assert wait_for(lambda: server.worker.busy)
+        # Hooks are still served while the first batch is stuck in flight
+        start = time.time()
+        for _ in range(3):
+            assert send(socket_path, 'on_add', task_str) == 'Todoist: item created'
+        assert time.time() - start < 1
+        assert len(server.provider.commands) == 3
+
+        release.set()
+        assert wait_for(lambda: len(pushed) == 2)
+        assert [len(x) for x in pushed] == [1, 3]
+        assert wait_for(lambda: server.journal.seq > 0 and len(server.journal._records) == 0)
+        send(socket_path, 'stop')
+        thread.join(timeout=5)
+
+    def test_push_failure_requeues(self, tmp_path):
+        socket_path = str(tmp_path / 'tasksync')
+        server, thread = start_server(socket_path, mode='asyncio')
+        def failing_push(commands):
+            raise RuntimeError('sync error (503)')
+        server.worker.push = failing_push
+        send(socket_path, 'on_add', get_taskwarrior_input('str'))
+        send(socket_path, 'on_add', get_taskwarrior_input('str'))
+        commands = list(server.provider.commands)
+        server.sync()
+        server.worker.wait()
+        server.provider.commands.append({'type': 'item_update'})
+        with pytest.raises(RuntimeError):
+            server.collect()
+        assert server.provider.commands[:2] == commands
+        assert len(server.journal._records) == 2
+        server.provider.commands.clear()
+        send(socket_path, 'stop')
+        thread.join(timeout=5)
+
+    def test_push_rejected(self, server):
+        def rejected(commands):
+            raise TodoistPushError('sync error (400)', commands=commands, status_code=400)
+        server.worker.push = rejected
+        send(server.socket_path, 'on_add', get_taskwarrior_input('str'))
+        server.sync(wait=True)
+        # Dead-lettered by the provider, so neither queued again nor journaled
+        assert len(server.provider.commands) == 0
+        assert len(server.journal._records) == 0
+        assert server.push_failures == 0
+
+    def test_pull(self, server):
+        events = []
+        server.worker.push = lambda commands: events.append(('push', len(commands)))
+        server.provider.pull = lambda full=False: events.append(('pull', full))
+        send(server.socket_path, 'on_add', get_taskwarrior_input('str'))
+        assert send(server.socket_path, 'pull') == 'Todoist: pull complete'
+        # Queued commands are pushed before the pull, on the same thread
+        assert events == [('push', 1), ('pull', True)]
+        assert len(server.provider.commands) == 0
+
+    def test_pull_failure(self, server):
+        def failing_pull(full=False):
+            raise RuntimeError('sync error (503)')
+        server.provider.pull = failing_pull
+        feedback = send(server.socket_path, 'pull')
+        assert feedback == 'RuntimeError raised: sync error (503)'
+        assert send(server.socket_path, 'status')['pid'] > 0
+
+    def test_push_offline(self, server):
+        def offline(commands):
+            raise TodoistPushError('sync error (503)', commands=commands, transient=True)
+        server.worker.push = offline
+        server.provider.pull = lambda full=False: None
+        send(server.socket_path, 'on_add', get_taskwarrior_input('str'))
+        assert send(server.socket_path, 'pull') == 'Todoist: pull complete'
+        # The command is queued again (and kept in the journal), the next push
+        # is held back, and hooks are still accepted
+        status = send(server.socket_path, 'status')
+        assert status['push_failures'] == 1
+        assert status['scheduler']['deferred']
+        assert status['scheduler']['next_flush'] > 0
+        assert len(server.provider.commands) == 1
+        assert len(server.journal._records) == 1
+        send(server.socket_path, 'on_add', get_taskwarrior_input('str'))
+        assert len(server.provider.commands) == 2
+
+    def test_stop(self, tmp_path):
+        socket_path = str(tmp_path / 'tasksync')
+        server, thread = start_server(socket_path, mode='asyncio')
+        feedback = send(socket_path, 'stop')
+        assert feedback.startswith('TasksyncTermination')
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+
+class TestProtocol:
+
+    def test_frame_roundtrip(self):
+        data = {'method': 'on-add', 'args': [get_taskwarrior_input('str')]}
+        left, right = socket.socketpair()
+        send_frame(left, data)
+        assert recv_frame(right) == data
+        left.close()
+        right.close()
+
+    def test_buffer_reused_and_grown(self):
+        buffer = bytearray(16)
+        data = {'args': ['x' * 4096]}
+        left, right = socket.socketpair()
+        send_frame(left, data)
+        send_frame(left, 'small')
+        assert recv_frame(right, buffer) == data
+        assert len(buffer) >= 4096
+        size = len(buffer)
+        assert recv_frame(right, buffer) == 'small'
+        assert len(buffer) == size
+        left.close()
+        right.close()
+
+    def test_parse_header_framed(self):
+        frame = encode_frame({'method': 'status'})
+        version, _, size = parse_header(frame[:FRAME_HEADER.size])
+        assert version == PROTOCOL_FRAMED
+        assert size == len(frame) - FRAME_HEADER.size
+
+    def test_parse_header_legacy(self):
+        header = (21332).to_bytes(8, 'little', signed=False)
+        version, _, size = parse_header(header)
+        assert version == PROTOCOL_LEGACY
+        assert size == 21332
+
+    def test_parse_header_unknown(self):
+        with pytest.raises(ConnectionError):
+            parse_header(b'XX\x09\x01\x00\x00\x00\x01')
+
+    def test_legacy_rejected(self):
+        left, right = socket.socketpair()
+        left.sendall((10).to_bytes(8, 'little', signed=False))
+        with pytest.raises(ConnectionError):
+            receive_message(right, allow_legacy=False)
+        left.close()
+        right.close()
+
+class TestJournal:
+
+    def test_append_pop(self, tmp_path):
+        journal = Journal(str(tmp_path / 'state' / 'journal'))
+        journal.append_event({'method': 'on-add', 'args': ['a']})
+        journal.append_event({'method': 'on-add', 'args': ['b']})
+        assert len(journal) == 2
+        seq, event = journal.pop()
+        assert seq == 1
+        assert event['args'] == ['a']
+        assert len(journal) == 1
+
+    def test_reload_unprocessed(self, tmp_path):
+        path = str(tmp_path / 'journal')
+        journal = Journal(path)
+        journal.append_event({'method': 'on-add', 'args': ['a']})
+        journal.append_event({'method': 'on-add', 'args': ['b']})
+        seq, _ = journal.pop()
+        journal.append_commands([{'type': 'item_add'}], event_seq=seq)
+        journal.close()
+        # Only the event without commands is still pending after restart
+        journal = Journal(path)
+        assert len(journal) == 1
+        assert journal.pop()[1]['args'] == ['b']
+        assert journal.replay() == [{'type': 'item_add'}]
+        assert journal.replay() == []
+
+    def test_group_commit(self, tmp_path):
+        journal = Journal(str(tmp_path / 'journal'), group_size=3, group_interval=60)
+        for _ in range(2):
+            journal.append_commands([{'type': 'item_update'}], event={})
+        assert journal.dirty
+        journal.append_commands([{'type': 'item_update'}], event={})
+        assert not journal.dirty
+
+    def test_truncate(self, tmp_path):
+        path = str(tmp_path / 'journal')
+        journal = Journal(path)
+        journal.append_commands([{'type': 'item_add'}], event={})
+        upto = journal.seq
+        journal.append_commands([{'type': 'item_update'}], event={})
+        journal.append_event({'method': 'on-add', 'args': ['a']})
+        journal.truncate(upto)
+        journal.append_commands([{'type': 'item_delete'}], event={})
+        journal.close()
+
+        journal = Journal(path)
+        assert len(journal) == 1
+        assert journal.seq == 4
+        assert [x['type'] for x in journal.replay()] == ['item_update', 'item_delete']
+        journal.pop()
+        journal.truncate()
+        journal.close()
+        assert len(Journal(path)._records) == 0
+
+    def test_truncate_keeps_pending(self, tmp_path):
+        path = str(tmp_path / 'journal')
+        journal = Journal(path)
+        journal.append_event({'method': 'on-add', 'args': ['a']})
+        journal.truncate()
+        journal.close()
+        assert len(Journal(path)) == 1
+
+    def test_torn_write(self, tmp_path):
+        path = str(tmp_path / 'journal')
+        journal = Journal(path)
+        journal.append_event({'method': 'on-add', 'args': ['a']})
+        journal.close()
+        with open(path, 'a') as f:
+            f.write('{"seq": 2, "event": {"method": "on-a')
+        journal = Journal(path)
+        assert len(journal) == 1
+        journal.append_event({'method': 'on-add', 'args': ['b']})
+        journal.close()
+        assert len(Journal(path)) == 2
+
+    def test_resolved(self, tmp_path):
+        path = str(tmp_path / 'journal')
+        journal = Journal(path)
+        journal.append_commands([{'type': 'project_add', 'temp_id': 'p'}], event={})
+        upto = journal.seq
+        journal.append_commands([{'type': 'item_add', 'args': {'project_id': 'p'}}], event={})
+        journal.append_resolved({'p': '123'})
+        journal.truncate(upto)
+        journal.close()
+        journal = Journal(path)
+        assert journal.resolved == {'p': '123'}
+        assert len(journal.replay()) == 1
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestFlushScheduler:
+
+    @pytest.fixture
+    def clock(self):
+        return FakeClock()
+
+    @pytest.fixture
+    def scheduler(self, clock):
+        return FlushScheduler(quiet_period=10, max_delay=30, max_queue=5, clock=clock)
+
+    def test_idle(self, scheduler):
+        assert scheduler.deadline() is None
+        assert scheduler.timeout() is None
+        assert not scheduler.due()
+
+    def test_quiet_period(self, scheduler, clock):
+        scheduler.touch(1)
+        clock.now = 9
+        assert not scheduler.due()
+        clock.now = 10
+        assert scheduler.due()
+
+    def test_debounce(self, scheduler, clock):
+        scheduler.touch(1)
+        clock.now = 5
+        scheduler.touch(2)
+        assert scheduler.timeout() == 10
+
+    def test_max_delay(self, scheduler, clock):
+        # An edit every 5 seconds never satisfies the quiet period...
+        for i in range(6):
+            clock.now = i * 5
+            scheduler.touch(1)
+            assert not scheduler.due()
+        # ...but the oldest change caps the wait
+        assert scheduler.deadline() == 30
+        clock.now = 30
+        assert scheduler.due()
+
+    def test_max_queue(self, scheduler, clock):
+        scheduler.touch(4)
+        assert not scheduler.due()
+        scheduler.touch(5)
+        assert scheduler.due()
+
+    def test_reset(self, scheduler, clock):
+        scheduler.touch(3)
+        clock.now = 20
+        scheduler.reset()
+        assert scheduler.deadline() is None
+        scheduler.reset(queued=2)
+        assert scheduler.deadline() == 30
+
+    def test_defer(self, scheduler, clock):
+        scheduler.touch(5)
+        scheduler.defer(20)
+        assert scheduler.deadline() == 20
+        assert scheduler.status()['deferred']
+        scheduler.defer(None)
+        assert scheduler.due()
+
+    def test_status(self, scheduler, clock):
+        scheduler.touch(2)
+        clock.now = 4
+        status = scheduler.status()
+        assert status['queued'] == 2
+        assert status['oldest_age'] == 4
+        assert status['next_flush'] == 6
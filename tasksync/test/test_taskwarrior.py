@@ -2,14 +2,22 @@
 
 import pytest
 
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+
 from tasksync.models import TasksyncDatetime
+from tasksync.taskwarrior import batch
+from tasksync.taskwarrior.reader import TaskwarriorReader
 from tasksync.taskwarrior.models import (
     TaskwarriorPriority,
     TaskwarriorStatus,
     TaskwarriorTask
 )
 
-from test_data import get_task, get_taskwarrior_input
+from test_data import get_task, get_taskwarrior_input, write_fake_task
 
 class TestTaskwarrior:
 
@@ -49,4 +57,157 @@ class TestTaskwarrior:
     def test_to_json(self):
         json_data = '{"description":"Test 1","entry":"20230827T232837Z","id":3,"modified":"20230827T232837Z","status":"pending","todoist":123,"urgency":0,"uuid":"5da82ec9-e85b-47ac-b0c6-9e3486f9fb74"}'
         task = TaskwarriorTask.from_taskwarrior(json_data)
-        assert json_data == task.to_taskwarrior(exclude_id=False, sort_keys=True).replace(', ', ',').replace(': ', ':')
\ No newline at end of file
+        assert json_data == task.to_taskwarrior(exclude_id=False, sort_keys=True).replace(', ', ',').replace(': ', ':')
+
+
+@pytest.fixture()
+def fake_task(tmp_path, monkeypatch):
+    tasks = [
+        {'uuid': 'u{}'.format(i), 'description': 'Task {}'.format(i), 'id': i, 'urgency': 1}
+        for i in range(5)
+    ]
+    monkeypatch.setattr(batch, 'TASK_BIN', write_fake_task(str(tmp_path), tasks))
+    return tmp_path
+
+def read_fake_task(basedir):
+    with open(os.path.join(basedir, 'tasks.json')) as f:
+        tasks = dict((x['uuid'], x) for x in json.load(f))
+    with open(os.path.join(basedir, 'calls.log')) as f:
+        calls = f.read().splitlines()
+    return tasks, calls
+
+class TestTaskwarriorBatch:
+
+    def test_modify_tasks(self, fake_task, monkeypatch):
+        monkeypatch.setattr(batch, 'IMPORT_CHUNK_SIZE', 2)
+        changes = {'u{}'.format(i): {'todoist': str(100 + i)} for i in range(5)}
+        assert batch.modify_tasks(changes) == {}
+        tasks, calls = read_fake_task(fake_task)
+        assert [tasks['u{}'.format(i)]['todoist'] for i in range(5)] == [str(100 + i) for i in range(5)]
+        assert tasks['u0']['description'] == 'Task 0'
+        assert 'id' not in tasks['u0'] and 'urgency' not in tasks['u0']
+        # One export and one import per chunk of 2
+        assert len(calls) == 6
+        assert calls[0].endswith('u0 u1 export')
+        assert calls[1].endswith('import -')
+
+    def test_modify_tasks_missing(self, fake_task):
+        failed = batch.modify_tasks({'u0': {'todoist': '1'}, 'missing': {'todoist': '2'}})
+        assert failed == {'missing': {'todoist': '2'}}
+        tasks, _ = read_fake_task(fake_task)
+        assert tasks['u0']['todoist'] == '1'
+        assert 'missing' not in tasks
+
+    def test_modify_tasks_failure(self, fake_task):
+        open(os.path.join(fake_task, 'fail'), 'w').close()
+        changes = {'u0': {'todoist': '1'}}
+        assert batch.modify_tasks(changes) == changes
+        with pytest.raises(batch.TaskwarriorCommandError, match='database is locked'):
+            batch.export_tasks(['u0'])
+
+
+PENDING_DATA = """[description:"Buy &open;milk&close; \\"2%\\"" entry:"1693171770" modified:"1693171771" project:"Inbox" status:"pending" tags:"shop,home" todoist:"7173209653" uuid:"2d0fc886-3a8e-478c-a323-5d13de45e254"]
+[annotation_1693171800:"note" description:"Waiting" entry:"1693171770" status:"waiting" uuid:"5da82ec9-e85b-47ac-b0c6-9e3486f9fb74" wait:"1893456000"]
+[description:"Gone" end:"1693171900" entry:"1693171770" status:"deleted" uuid:"0c7ae9e2-7c8d-4ab4-9a0e-6b0e1cfae2f1"]
+"""
+COMPLETED_DATA = """[description:"Done" end:"1693171900" entry:"1693171770" status:"completed" todoist:"1" uuid:"8b0f5d1e-0d1f-4d52-9b1a-0d6f4e5d8a11"]
+"""
+
+@pytest.fixture()
+def taskdata(tmp_path):
+    with open(tmp_path / 'pending.data', 'w') as f:
+        f.write(PENDING_DATA)
+    with open(tmp_path / 'completed.data', 'w') as f:
+        f.write(COMPLETED_DATA)
+    return tmp_path
+
+class TestTaskwarriorReader:
+
+    def test_data_files(self, taskdata):
+        reader = TaskwarriorReader(str(taskdata))
+        assert reader.backend == 'file'
+        task = reader.get('2d0fc886-3a8e-478c-a323-5d13de45e254')
+        assert task.description == 'Buy [milk] "2%"'
+        assert task.id == 1
+        assert task.status == TaskwarriorStatus.PENDING
+        assert task.entry.to_taskwarrior() == '20230827T212930Z'
+        assert task.tags == ['shop', 'home']
+        assert task.todoist == '7173209653'
+        records = dict((x['uuid'], x) for x in reader.records())
+        waiting = records['5da82ec9-e85b-47ac-b0c6-9e3486f9fb74']
+        assert waiting['id'] == 2
+        assert waiting['annotations'] == [{'entry': '20230827T213000Z', 'description': 'note'}]
+        assert records['0c7ae9e2-7c8d-4ab4-9a0e-6b0e1cfae2f1']['id'] == 0
+        assert reader.find('1').status == TaskwarriorStatus.COMPLETED
+        assert reader.find('missing') is None
+        assert len(reader.tasks()) == 4
+
+    def test_cache(self, taskdata):
+        reader = TaskwarriorReader(str(taskdata))
+        records = reader.records()
+        assert reader.records() is records
+        with open(taskdata / 'completed.data', 'a') as f:
+            f.write('[description:"More" entry:"1693171770" status:"completed" uuid:"1b0f5d1e-0d1f-4d52-9b1a-0d6f4e5d8a11"]\n')
+        assert len(reader.records()) == 5
+
+    def test_missing(self, tmp_path):
+        reader = TaskwarriorReader(str(tmp_path))
+        assert reader.backend is None
+        assert reader.records() is None
+        assert reader.get('2d0fc886-3a8e-478c-a323-5d13de45e254') is None
+
+    def test_taskchampion(self, tmp_path):
+        con = sqlite3.connect(tmp_path / 'taskchampion.sqlite3')
+        con.execute('CREATE TABLE tasks (uuid STRING PRIMARY KEY, data STRING)')
+        con.execute('CREATE TABLE working_set (id INTEGER PRIMARY KEY, uuid STRING)')
+        data = {
+            'description': 'From TaskChampion', 'entry': '1693171770', 'status': 'pending',
+            'tag_shop': '', 'dep_5da82ec9-e85b-47ac-b0c6-9e3486f9fb74': '', 'todoist': '42',
+        }
+        con.execute('INSERT INTO tasks VALUES (?, ?)', ('2d0fc886-3a8e-478c-a323-5d13de45e254', json.dumps(data)))
+        con.execute('INSERT INTO working_set VALUES (3, ?)', ('2d0fc886-3a8e-478c-a323-5d13de45e254',))
+        con.commit()
+        con.close()
+        reader = TaskwarriorReader(str(tmp_path))
+        assert reader.backend == 'taskchampion'
+        record = reader.records()[0]
+        assert record['id'] == 3
+        assert record['tags'] == ['shop']
+        assert record['depends'] == ['5da82ec9-e85b-47ac-b0c6-9e3486f9fb74']
+        assert reader.find('42').description == 'From TaskChampion'
+
+
+@pytest.mark.skipif(shutil.which('task') is None, reason='requires the task binary')
+class TestTaskwarriorReaderEquivalence:
+
+    @pytest.fixture()
+    def task(self, tmp_path, monkeypatch):
+        with open(tmp_path / 'taskrc', 'w') as f:
+            f.write('data.location={}\nuda.todoist.type=string\nhooks=off\n'.format(tmp_path / 'data'))
+        monkeypatch.setenv('TASKRC', str(tmp_path / 'taskrc'))
+        monkeypatch.delenv('TASKDATA', raising=False)
+        def task(*args):
+            return subprocess.run(
+                ['task', 'rc.confirmation=off', 'rc.verbose=nothing', *args],
+                capture_output=True, text=True, check=True,
+            ).stdout
+        task('add', 'First', 'project:Inbox', '+shop', 'todoist:100', 'due:2030-01-01')
+        task('add', 'Second [with] brackets', 'priority:H')
+        task('add', 'Third')
+        task('1', 'annotate', 'a note')
+        task('2', 'done')
+        task('3', 'delete')
+        return task
+
+    def test_equivalent(self, task, tmp_path):
+        exported = dict(
+            (x['uuid'], TaskwarriorTask.from_taskwarrior(x)) for x in json.loads(task('export'))
+        )
+        reader = TaskwarriorReader()
+        assert reader.data_location == str(tmp_path / 'data')
+        read = dict((str(x.uuid), x) for x in reader.tasks())
+        assert set(read) == set(exported)
+        for uuid, task in exported.items():
+            # Urgency is computed by task export
+            read[uuid].urgency = task.urgency
+            assert read[uuid] == task
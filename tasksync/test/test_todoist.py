@@ -1,29 +1,63 @@
 #!/usr/bin/env python3
 
 import pytest
+from tasklib import Task, TaskWarrior
 
 from os.path import dirname, join
 import os
+import shutil
+import threading
+import time
 import datetime
+import gzip
+import http.server
+import json
 import uuid
 
 from tasksync.models import (
     TasksyncDatetime
 )
+from tasksync.taskwarrior import batch
 from tasksync.taskwarrior.models import (
     TaskwarriorPriority,
     TaskwarriorStatus,
     TaskwarriorTask,
 )
 from tasksync.todoist.api import (
+    RetentionPolicy,
     SyncToken,
     SyncTokenManager,
+    TodoistSync,
     TodoistSyncDataStore,
     TodoistSyncAPI,
+    TodoistSyncError,
+    TodoistPushError,
+)
+from tasksync.todoist.chunking import group_commands, plan_chunks, resolve_temp_ids
+from tasksync.todoist.compaction import compact_commands
+from tasksync.todoist.ratelimit import (
+    PRIORITY_PULL,
+    RateLimiter,
+    RateLimitExceeded,
+    parse_retry_after,
+)
+from tasksync.todoist.provider import (
+    TodoistProvider,
+    DEAD_LETTER_FILE,
+    TODOIST_DATETIME_FORMAT,
+    WRITEBACK_MAX_ATTEMPTS,
+    queued_item_ids,
+)
+from tasksync.todoist.models import ITEM_RECORD_FIELDS, TodoistItemRecord
+from tasksync.todoist.registry import TodoistPendingRegistry
+from tasksync.todoist.storage import (
+    TodoistLogDataStore,
+    TodoistSqliteDataStore,
+    open_store,
+    store_lock,
 )
-from tasksync.todoist.provider import TodoistProvider, TODOIST_DATETIME_FORMAT
 
-from test_data import get_task
+from test_data import get_task, write_fake_task
 
 DATADIR = join(dirname(__file__), 'data')
 
@@ -141,6 +175,319 @@ class TestSyncTokenManager:
         token_manager_test = SyncTokenManager(basedir)
         assert token_manager.get() == token_manager_test.get()
 
+class TestTodoistSyncDataStore:
+
+    @pytest.fixture
+    def tmp_store(self, tmp_path):
+        shutil.copytree(DATADIR, tmp_path, dirs_exist_ok=True)
+        return TodoistSyncDataStore(basedir=str(tmp_path))
+
+    def test_find_by_id(self, store):
+        assert store.find('items', id='1000000001')['content'] == 'Sample Task 1'
+        assert store.find('items', id='missing') is None
+        assert store.find('items', id='1000000001', content='other') is None
+
+    def test_find_by_index(self, store):
+        inbox = store.find('projects', name='Inbox')
+        assert inbox['id'] == '1000000000'
+        assert store.find_all('projects', name='Inbox') == [inbox]
+        assert store.find('projects', name='missing') is None
+
+    def test_find_unindexed(self, store):
+        items = store.find_all('items', project_id='1000000000')
+        assert len(items) > 0
+        assert all(x['project_id'] == '1000000000' for x in items)
+        assert len(store.find_all('items')) == len(store.items)
+
+    def test_update(self, tmp_store):
+        n_projects = len(tmp_store.projects)
+        tmp_store.update({
+            'sync_token': 'abc',
+            'projects': [
+                {'id': '1000000000', 'name': 'Renamed'},
+                {'id': '2000000000', 'name': 'New'},
+            ],
+        }, resource_types=['projects'])
+        assert len(tmp_store.projects) == n_projects + 1
+        assert tmp_store.find('projects', name='Inbox') is None
+        assert tmp_store.find('projects', name='Renamed')['id'] == '1000000000'
+        assert tmp_store.find('projects', id='2000000000')['name'] == 'New'
+        # Indexes are rebuilt from what was saved
+        reloaded = TodoistSyncDataStore(basedir=tmp_store.basedir)
+        assert reloaded.find('projects', name='New')['id'] == '2000000000'
+
+    def test_replace_list(self, store):
+        store.projects = []
+        assert store.find('projects', name='Inbox') is None
+
+    def test_lazy_load(self, tmp_store):
+        assert 'items' not in vars(tmp_store)
+        assert tmp_store.find('projects', name='Inbox') is not None
+        assert 'projects' in vars(tmp_store)
+        assert 'items' not in vars(tmp_store)
+        assert len(tmp_store.items) == 4
+        assert 'items' in vars(tmp_store)
+
+    def test_compact_items(self, tmp_path):
+        shutil.copytree(DATADIR, tmp_path, dirs_exist_ok=True)
+        store = TodoistSyncDataStore(basedir=str(tmp_path), compact_items=True)
+        plain = TodoistSyncDataStore(basedir=DATADIR)
+        item = store.find('items', id='1000000001')
+        assert isinstance(item, TodoistItemRecord)
+        expected = plain.find('items', id='1000000001')
+        assert item == {k: v for k, v in expected.items() if k in ITEM_RECORD_FIELDS}
+        assert 'added_at' not in item
+        assert item.get('added_at') is None
+        store.update({
+            'sync_token': 'abc',
+            'items': [dict(expected, content='Changed')],
+        }, resource_types=['items'])
+        assert store.find('items', id='1000000001')['content'] == 'Changed'
+        reloaded = TodoistSyncDataStore(basedir=str(tmp_path))
+        assert reloaded.find('items', id='1000000001')['content'] == 'Changed'
+
+    def test_prune_deleted(self, tmp_store):
+        item = dict(tmp_store.items[0], is_deleted=True)
+        tmp_store.update({'sync_token': 'abc', 'items': [item]}, resource_types=['items'])
+        # Kept until a pull has applied the deletion to Taskwarrior
+        tmp_store.update({'sync_token': 'def', 'items': []}, resource_types=['items'])
+        assert tmp_store.find('items', id=item['id']) is not None
+        assert TodoistSyncDataStore(basedir=tmp_store.basedir).unreconciled.get('items') == {item['id']}
+        tmp_store.reconciled('items', {item['id']})
+        tmp_store.update({'sync_token': 'ghi', 'items': []}, resource_types=['items'])
+        assert tmp_store.find('items', id=item['id']) is None
+        assert tmp_store.pruned == 1
+        reloaded = TodoistSyncDataStore(basedir=tmp_store.basedir)
+        assert reloaded.find('items', id=item['id']) is None
+
+    def test_prune_completed(self, tmp_path):
+        shutil.copytree(DATADIR, tmp_path, dirs_exist_ok=True)
+        store = TodoistSyncDataStore(
+            basedir=str(tmp_path), retention=RetentionPolicy(completed_days=30)
+        )
+        now = datetime.datetime.now(datetime.timezone.utc)
+        old = dict(store.items[0], completed_at=(now - datetime.timedelta(days=31)).strftime(TODOIST_DATETIME_FORMAT))
+        new = dict(store.items[1], completed_at=now.strftime(TODOIST_DATETIME_FORMAT))
+        n_items = len(store.items)
+        store.update({'sync_token': 'abc', 'items': [old, new]}, resource_types=['items'])
+        store.reconciled('items', {old['id'], new['id']})
+        store.update({'sync_token': 'def', 'items': []}, resource_types=['items'])
+        assert store.find('items', id=old['id']) is None
+        assert store.find('items', id=new['id']) is not None
+        assert len(store.items) == n_items - 1
+
+    def test_store_lock(self, tmp_path):
+        acquired = threading.Event()
+        def hold():
+            with store_lock(str(tmp_path)):
+                acquired.set()
+                time.sleep(0.2)
+        thread = threading.Thread(target=hold)
+        thread.start()
+        acquired.wait(5)
+        start = time.time()
+        with store_lock(str(tmp_path)):
+            assert time.time() - start > 0.1
+        thread.join()
+
+    def test_lookup_during_update(self, tmp_store, monkeypatch):
+        # Hold the push worker's update between unindexing and reindexing
+        entered, release = threading.Event(), threading.Event()
+        index = tmp_store._index
+        def slow_index(resource_type, element):
+            entered.set()
+            release.wait(5)
+            return index(resource_type, element)
+        project = tmp_store.find('projects', name='Inbox')
+        monkeypatch.setattr(tmp_store, '_index', slow_index)
+        worker = threading.Thread(target=tmp_store.update, args=(
+            {'sync_token': 'abc', 'projects': [dict(project, color='red')]},
+            ['projects'],
+        ))
+        worker.start()
+        entered.wait(5)
+        found = []
+        lookup = threading.Thread(target=lambda: found.append(tmp_store.find('projects', name='Inbox')))
+        lookup.start()
+        lookup.join(0.2)
+        release.set()
+        lookup.join()
+        worker.join()
+        assert found[0] is not None
+        assert found[0]['color'] == 'red'
+
+    def test_save_dirty_only(self, tmp_store):
+        items_size = os.path.getsize(join(tmp_store.basedir, 'items.json'))
+        tmp_store.update({
+            'sync_token': 'abc',
+            'projects': [{'id': '2000000000', 'name': 'New'}],
+            'items': [dict(tmp_store.items[0])],
+        }, resource_types=['items', 'projects'])
+        files = [os.path.basename(x) for x in tmp_store.last_save['files']]
+        assert files == ['projects.json', 'sync_tokens.json']
+        assert tmp_store.last_save['skipped'] == items_size
+        assert not any(x.endswith('.tmp') for x in os.listdir(tmp_store.basedir))
+        assert tmp_store.dirty == set()
+        # Tokens are written even if no data changed
+        tmp_store.update({'sync_token': 'def'}, resource_types=['items'])
+        files = [os.path.basename(x) for x in tmp_store.last_save['files']]
+        assert files == ['sync_tokens.json']
+        reloaded = TodoistSyncDataStore(basedir=tmp_store.basedir)
+        assert reloaded.tokens.get(['items']).token == 'def'
+        assert reloaded.find('projects', id='2000000000')['name'] == 'New'
+
+
+class TestTodoistSqliteDataStore:
+
+    @pytest.fixture
+    def sqlite_store(self, tmp_path):
+        shutil.copytree(DATADIR, tmp_path, dirs_exist_ok=True)
+        store = TodoistSqliteDataStore(basedir=str(tmp_path))
+        yield store
+        store.close()
+
+    def test_migrate(self, store, sqlite_store):
+        for key in store.resource_types:
+            assert sqlite_store.find_all(key) == store.find_all(key)
+        assert sqlite_store.tokens.get(['items']) == store.tokens.get(['items'])
+
+    def test_find(self, store, sqlite_store):
+        for kwargs in (
+            {'id': '1000000001'},
+            {'name': 'Inbox'},
+            {'id': 'missing'},
+        ):
+            assert sqlite_store.find('projects', **kwargs) == store.find('projects', **kwargs)
+        assert sqlite_store.find_all('items', project_id='1000000000') == \
+            store.find_all('items', project_id='1000000000')
+
+    def test_update(self, sqlite_store):
+        sqlite_store.update({
+            'sync_token': 'abc',
+            'projects': [
+                {'id': '1000000000', 'name': 'Renamed'},
+                {'id': '2000000000', 'name': 'New'},
+            ],
+        }, resource_types=['projects'])
+        sqlite_store.close()
+        reloaded = TodoistSqliteDataStore(basedir=sqlite_store.basedir)
+        assert reloaded.find('projects', name='Inbox') is None
+        renamed = reloaded.find('projects', name='Renamed')
+        assert renamed['id'] == '1000000000'
+        assert renamed['inbox_project'] is True
+        assert reloaded.find('projects', id='2000000000')['name'] == 'New'
+        assert reloaded.tokens.get(['projects']).token == 'abc'
+        # The JSON cache is only imported once
+        assert reloaded.find('projects', name='Inbox') is None
+        reloaded.close()
+
+    def test_prune_deleted(self, sqlite_store):
+        item = dict(sqlite_store.items[0], is_deleted=True)
+        sqlite_store.update({'sync_token': 'abc', 'items': [item]}, resource_types=['items'])
+        sqlite_store.update({'sync_token': 'def', 'items': []}, resource_types=['items'])
+        assert sqlite_store.find('items', id=item['id']) is not None
+        sqlite_store.reconciled('items', {item['id']})
+        sqlite_store.update({'sync_token': 'ghi', 'items': []}, resource_types=['items'])
+        assert sqlite_store.find('items', id=item['id']) is None
+        assert sqlite_store.pruned == 1
+
+    def test_replace_list(self, sqlite_store):
+        sqlite_store.projects = []
+        assert sqlite_store.find('projects', name='Inbox') is None
+        assert sqlite_store.projects == []
+
+    def test_open_store(self, tmp_path):
+        store = open_store(basedir=str(tmp_path), backend='sqlite')
+        assert isinstance(store, TodoistSqliteDataStore)
+        assert store.find_all('items') == []
+        store.close()
+        with pytest.raises(ValueError):
+            open_store(basedir=str(tmp_path), backend='missing')
+
+
+class TestTodoistLogDataStore:
+
+    @pytest.fixture
+    def log_store(self, tmp_path):
+        shutil.copytree(DATADIR, tmp_path, dirs_exist_ok=True)
+        store = TodoistLogDataStore(basedir=str(tmp_path))
+        yield store
+        store.close()
+
+    def test_update_appends(self, log_store):
+        items = os.path.getsize(join(log_store.basedir, 'items.json'))
+        item = dict(log_store.items[0], content='Changed')
+        log_store.update({'sync_token': 'abc', 'items': [item]}, resource_types=['items'])
+        assert log_store.last_save['files'] == [log_store.log_file]
+        assert log_store.last_save['written'] < items
+        assert os.path.getsize(join(log_store.basedir, 'items.json')) == items
+        log_store.close()
+        reloaded = TodoistLogDataStore(basedir=log_store.basedir)
+        assert reloaded.find('items', id=item['id'])['content'] == 'Changed'
+        assert reloaded.tokens.get(['items']).token == 'abc'
+        reloaded.close()
+
+    def test_lazy_replay(self, log_store):
+        item = dict(log_store.items[0], content='Changed')
+        log_store.update({'sync_token': 'abc', 'items': [item]}, resource_types=['items'])
+        log_store.close()
+        reloaded = TodoistLogDataStore(basedir=log_store.basedir, compact_size=1)
+        assert reloaded.tokens.get(['items']).token == 'abc'
+        assert 'items' not in vars(reloaded)
+        reloaded.update({
+            'sync_token': 'def',
+            'projects': [{'id': '2000000000', 'name': 'New'}],
+        }, resource_types=['projects'])
+        # Compaction loaded items so the logged delta made it to the snapshot
+        reloaded.close()
+        snapshot = TodoistSyncDataStore(basedir=log_store.basedir)
+        assert snapshot.find('items', id=item['id'])['content'] == 'Changed'
+        assert snapshot.tokens.get(['items']).token == 'abc'
+
+    def test_lazy_replay_keeps_token(self, log_store):
+        item = dict(log_store.items[0], content='Changed')
+        log_store.update({'sync_token': 'T1', 'items': [item]}, resource_types=['items'])
+        log_store.close()
+        reloaded = TodoistLogDataStore(basedir=log_store.basedir)
+        # Loading items inside the update replays T1's data, not its token
+        reloaded.update({'sync_token': 'T2', 'items': []}, resource_types=['items'])
+        assert reloaded.tokens.tokens['items'].token == 'T2'
+        assert reloaded.find('items', id=item['id'])['content'] == 'Changed'
+        reloaded.compact()
+        reloaded.close()
+        assert TodoistSyncDataStore(basedir=log_store.basedir).tokens.get(['items']).token == 'T2'
+
+    def test_torn_write(self, log_store):
+        log_store.update({
+            'sync_token': 'abc',
+            'projects': [{'id': '2000000000', 'name': 'New'}],
+        }, resource_types=['projects'])
+        log_store.close()
+        with open(log_store.log_file, 'a') as f:
+            f.write('{"resource_types": ["projects"], "sync')
+        reloaded = TodoistLogDataStore(basedir=log_store.basedir)
+        assert reloaded.find('projects', name='New') is not None
+        assert reloaded.tokens.get(['projects']).token == 'abc'
+        with open(log_store.log_file) as f:
+            assert len(f.readlines()) == 1
+        reloaded.close()
+
+    def test_compact(self, tmp_path):
+        shutil.copytree(DATADIR, tmp_path, dirs_exist_ok=True)
+        store = TodoistLogDataStore(basedir=str(tmp_path), compact_size=1)
+        store.update({
+            'sync_token': 'abc',
+            'projects': [{'id': '2000000000', 'name': 'New'}],
+        }, resource_types=['projects'])
+        assert os.path.getsize(store.log_file) == 0
+        files = [os.path.basename(x) for x in store.last_save['files']]
+        assert files == ['projects.json', 'sync_tokens.json']
+        store.close()
+        reloaded = TodoistSyncDataStore(basedir=str(tmp_path))
+        assert reloaded.find('projects', name='New') is not None
+        assert reloaded.tokens.get(['projects']).token == 'abc'
+
+
 class TestTodoistProvider:
 
     @pytest.mark.skip()
@@ -494,4 +841,775 @@ class TestTodoistSyncAPI:
         assert data['type'] == 'project_add'
         assert uuid.UUID(data['uuid'])
         for key, value in kwargs.items():
-            assert data['args'][key] == value
\ No newline at end of file
+            assert data['args'][key] == value
+
+
+class SyncStandIn(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    delay = 0
+    pushed = []
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(self.delay)
+        if type(self).throttle > 0:
+            type(self).throttle -= 1
+            self.send_response(429)
+            self.send_header('Retry-After', '2')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        out = {'sync_token': 'abc', 'auth': self.headers['Authorization']}
+        if self.headers['Content-Type'] == 'application/json':
+            body = json.loads(data)
+            type(self).bodies.append(body)
+            if commands := body.get('commands'):
+                type(self).pushed.append(commands)
+                out['sync_status'] = {x['uuid']: 'ok' for x in commands}
+                out['temp_id_mapping'] = {x['temp_id']: 'real-' + x['temp_id'] for x in commands if 'temp_id' in x}
+                type(self).projects += [
+                    {'id': 'real-' + x['temp_id'], 'name': x['args']['name']}
+                    for x in commands if x['type'] == 'project_add'
+                ]
+            if 'sync_token' in body:
+                out['projects'] = list(type(self).projects)
+        body = json.dumps(out).encode()
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_response(200)
+            self.send_header('Content-Encoding', 'gzip')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        return
+
+
+class SyncStandInServer(http.server.ThreadingHTTPServer):
+
+    def handle_error(self, request, client_address):
+        # The client hangs up on purpose in the timeout test
+        return
+
+
+class TestTodoistSyncAPISession:
+
+    @pytest.fixture
+    def url(self):
+        SyncStandIn.connections = 0
+        SyncStandIn.delay = 0
+        SyncStandIn.pushed = []
+        SyncStandIn.bodies = []
+        SyncStandIn.projects = []
+        SyncStandIn.throttle = 0
+        server = SyncStandInServer(('127.0.0.1', 0), SyncStandIn)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield 'http://127.0.0.1:{}/sync'.format(server.server_address[1])
+        server.shutdown()
+        server.server_close()
+
+    def test_reuses_connection(self, url):
+        api = TodoistSyncAPI(token='secret', limiter=RateLimiter(), url=url)
+        for _ in range(3):
+            assert api.pull()['auth'] == 'Bearer secret'
+        assert api.push([TodoistSyncAPI.modify_item('1', content='a')])['sync_token'] == 'abc'
+        assert SyncStandIn.connections == 1
+        api.close()
+
+    def test_token_read_once(self, url, monkeypatch):
+        monkeypatch.setenv('TODOIST_API_KEY', 'first')
+        api = TodoistSyncAPI(url=url, limiter=RateLimiter())
+        api.pull()
+        monkeypatch.setenv('TODOIST_API_KEY', 'second')
+        assert api.pull()['auth'] == 'Bearer first'
+
+    def test_read_timeout(self, url):
+        SyncStandIn.delay = 0.5
+        api = TodoistSyncAPI(token='secret', limiter=RateLimiter(), url=url, read_timeout=0.1, retries=0)
+        with pytest.raises(TodoistSyncError) as err:
+            api.pull()
+        assert err.value.transient
+
+    def test_chunked_push(self, url):
+        api = TodoistSyncAPI(token='secret', limiter=RateLimiter(), url=url, chunk_size=3)
+        commands = [TodoistSyncAPI.create_project('Work', 'p')]
+        commands += [TodoistSyncAPI.add_item(str(i), 'i{}'.format(i), project_id='p') for i in range(4)]
+        commands += [TodoistSyncAPI.modify_item('1', content='a'), TodoistSyncAPI.modify_item('2', content='b')]
+        res = api.push(commands)
+        assert sorted(len(x) for x in SyncStandIn.pushed) == [2, 2, 3]
+        assert set(res['sync_status']) == set(x['uuid'] for x in commands)
+        assert res['temp_id_mapping'] == {'p': 'real-p', **{'i{}'.format(i): 'real-i{}'.format(i) for i in range(4)}}
+        # The project is created before the items in the later chunk refer to it
+        chunks = [x for x in SyncStandIn.pushed if x[0]['type'] != 'item_update']
+        assert chunks[0][0]['type'] == 'project_add'
+        assert chunks[1][0]['args']['project_id'] == 'real-p'
+
+    def test_retry_after(self, url):
+        SyncStandIn.throttle = 1
+        clock = FakeClock()
+        limiter = RateLimiter(clock=clock, sleep=clock.sleep)
+        api = TodoistSyncAPI(token='secret', url=url, limiter=limiter)
+        assert api.pull()['sync_token'] == 'abc'
+        # The second attempt waited for Retry-After instead of backing off
+        assert clock.slept == [2]
+        SyncStandIn.throttle = 1
+        limiter.max_wait = 1
+        with pytest.raises(TodoistSyncError) as err:
+            api.pull()
+        assert err.value.transient
+        assert err.value.retry_after == 2
+        assert limiter.status()['blocked_for'] == 2
+
+    def test_push_delta(self, url, tmp_path):
+        store = TodoistSyncDataStore(basedir=str(tmp_path))
+        api = TodoistSyncAPI(token='secret', url=url, limiter=RateLimiter())
+        TodoistSync(api=api, store=store).push([TodoistSyncAPI.create_project('Work', 'p')])
+        # One request carries the commands and asks for the delta
+        assert len(SyncStandIn.bodies) == 1
+        assert SyncStandIn.bodies[0]['sync_token'] == '*'
+        assert SyncStandIn.bodies[0]['resource_types'] == ['items', 'labels', 'projects', 'sections']
+        assert store.find('projects', name='Work')['id'] == 'real-p'
+        assert store.tokens.get(['projects']).token == 'abc'
+
+    def test_chunked_push_delta(self, url, tmp_path):
+        store = TodoistSyncDataStore(basedir=str(tmp_path))
+        api = TodoistSyncAPI(token='secret', url=url, chunk_size=1, limiter=RateLimiter())
+        commands = [TodoistSyncAPI.create_project('Work', 'p'), TodoistSyncAPI.create_project('Home', 'q')]
+        TodoistSync(api=api, store=store).push(commands)
+        # The delta is fetched once, after both chunks
+        assert ['commands' in x for x in SyncStandIn.bodies] == [True, True, False]
+        assert ['sync_token' in x for x in SyncStandIn.bodies] == [False, False, True]
+        assert store.find('projects', name='Work')['id'] == 'real-p'
+        assert store.find('projects', name='Home')['id'] == 'real-q'
+
+    def test_provider_push_delta(self, url, tmp_path, monkeypatch):
+        monkeypatch.setattr(batch, 'TASK_BIN', write_fake_task(str(tmp_path)))
+        store = TodoistSyncDataStore(basedir=str(tmp_path))
+        api = TodoistSyncAPI(token='secret', url=url, limiter=RateLimiter())
+        provider = TodoistProvider(store=store, api=TodoistSync(api=api, store=store))
+        provider.commands = [TodoistSyncAPI.create_project('Work', 'p')]
+        provider.pending.add_project('Work', 'p')
+        provider.push()
+        # The store knows the project now, so the registry can let go of it
+        assert provider.pending.find_project('Work') is None
+        assert store.find('projects', name='Work')['id'] == 'real-p'
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.slept.append(delay)
+        self.now += delay
+
+
+class TestRateLimiter:
+
+    @pytest.fixture
+    def clock(self):
+        return FakeClock()
+
+    def test_bucket(self, clock):
+        limiter = RateLimiter(capacity=10, period=10, clock=clock, sleep=clock.sleep)
+        for _ in range(10):
+            assert limiter.acquire() == 0
+        assert limiter.status()['remaining'] == 0
+        # Refills at capacity / period per second
+        assert limiter.acquire() == pytest.approx(1)
+        clock.now += 5
+        assert limiter.status()['remaining'] == 5
+
+    def test_priority(self, clock):
+        limiter = RateLimiter(capacity=10, period=10, reserve=0.5, max_wait=0, clock=clock)
+        for _ in range(5):
+            limiter.acquire(PRIORITY_PULL)
+        # Pulls leave the reserve to pushes
+        with pytest.raises(RateLimitExceeded):
+            limiter.acquire(PRIORITY_PULL)
+        for _ in range(5):
+            limiter.acquire()
+        with pytest.raises(RateLimitExceeded) as err:
+            limiter.acquire()
+        assert err.value.delay == pytest.approx(1)
+
+    def test_block(self, clock):
+        limiter = RateLimiter(capacity=10, period=10, clock=clock, sleep=clock.sleep)
+        limiter.block(5)
+        assert limiter.status() == {'remaining': 0, 'capacity': 10, 'blocked_for': 5}
+        assert limiter.acquire() == 5
+        limiter.max_wait = 3
+        limiter.block(4)
+        with pytest.raises(RateLimitExceeded):
+            limiter.acquire()
+
+    def test_shared_file(self, tmp_path, clock):
+        path = str(tmp_path / 'ratelimit.json')
+        first = RateLimiter(path=path, capacity=10, clock=clock)
+        second = RateLimiter(path=path, capacity=10, clock=clock)
+        for _ in range(3):
+            first.acquire()
+        second.acquire()
+        assert first.status()['remaining'] == 6
+        second.block(30)
+        assert first.status()['blocked_for'] == 30
+
+    def test_parse_retry_after(self):
+        assert parse_retry_after(None) is None
+        assert parse_retry_after('120') == 120
+        assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+        later = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=1)
+        assert 50 < parse_retry_after(later.strftime('%a, %d %b %Y %H:%M:%S GMT')) <= 60
+        assert parse_retry_after('soon') is None
+
+
+class TestChunking:
+
+    def test_small_batch(self):
+        commands = [TodoistSyncAPI.modify_item(str(i), content='a') for i in range(3)]
+        assert plan_chunks(commands) == [[commands]]
+
+    def test_groups(self):
+        commands = [
+            TodoistSyncAPI.modify_item('1', content='a'),
+            TodoistSyncAPI.create_project('Work', 'p'),
+            TodoistSyncAPI.modify_item('2', content='a'),
+            TodoistSyncAPI.add_item('x', 'i', project_id='p'),
+            TodoistSyncAPI.modify_item('1', content='b'),
+            TodoistSyncAPI.move_item('2', project_id='p'),
+        ]
+        groups = group_commands(commands)
+        # Item 2 is moved into the new project, so it joins the project group
+        assert groups == [
+            [commands[0], commands[4]],
+            [commands[1], commands[2], commands[3], commands[5]],
+        ]
+        # The project group does not fit a chunk of 2, so it gets its own lane
+        lanes = plan_chunks(commands, size=2)
+        assert lanes == [
+            [[commands[1], commands[2]], [commands[3], commands[5]]],
+            [[commands[0], commands[4]]],
+        ]
+
+    def test_resolve_temp_ids(self):
+        commands = [TodoistSyncAPI.add_item('x', 'i', project_id='p')]
+        resolved = resolve_temp_ids(commands, {'p': 1})
+        assert resolved[0]['args']['project_id'] == '1'
+        assert commands[0]['args']['project_id'] == 'p'
+
+
+class TestCompaction:
+
+    def test_noop(self):
+        commands = [
+            TodoistSyncAPI.modify_item('1', content='a'),
+            TodoistSyncAPI.modify_item('2', content='b'),
+        ]
+        compacted, eliminated = compact_commands(commands)
+        assert compacted == commands
+        assert eliminated == 0
+
+    def test_merge_updates(self):
+        commands = [
+            TodoistSyncAPI.modify_item('1', content='a'),
+            TodoistSyncAPI.move_item('1', project_id='2'),
+            TodoistSyncAPI.modify_item('1', content='b', priority=4),
+            TodoistSyncAPI.modify_item('1', due=None),
+        ]
+        compacted, eliminated = compact_commands(commands)
+        assert eliminated == 2
+        assert [x['type'] for x in compacted] == ['item_update', 'item_move']
+        assert compacted[0]['args'] == {'id': '1', 'content': 'b', 'priority': 4, 'due': None}
+        # Input is left untouched
+        assert commands[0]['args'] == {'id': '1', 'content': 'a'}
+
+    def test_fold_update_into_add(self):
+        temp_id = str(uuid.uuid4())
+        commands = [
+            TodoistSyncAPI.add_item('a', temp_id, due={'date': '2023-08-28'}),
+            TodoistSyncAPI.modify_item(temp_id, content='b', due=None),
+        ]
+        compacted, eliminated = compact_commands(commands)
+        assert eliminated == 1
+        assert compacted[0]['type'] == 'item_add'
+        assert compacted[0]['args'] == {'content': 'b'}
+
+    def test_repeated_add(self):
+        temp_id = str(uuid.uuid4())
+        project_id = str(uuid.uuid4())
+        commands = [
+            TodoistSyncAPI.add_item('a', temp_id),
+            TodoistSyncAPI.create_project('Work', project_id),
+            TodoistSyncAPI.add_item('b', temp_id, project_id=project_id),
+        ]
+        compacted, eliminated = compact_commands(commands)
+        assert eliminated == 1
+        assert [x['type'] for x in compacted] == ['project_add', 'item_add']
+        assert compacted[1]['args']['content'] == 'b'
+
+    def test_add_delete(self):
+        temp_id = str(uuid.uuid4())
+        project_id = str(uuid.uuid4())
+        commands = [
+            TodoistSyncAPI.create_project('Work', project_id),
+            TodoistSyncAPI.add_item('a', temp_id, project_id=project_id),
+            TodoistSyncAPI.modify_item('1', content='unrelated'),
+            TodoistSyncAPI.move_item(temp_id, section_id='2'),
+            TodoistSyncAPI.delete_item(temp_id),
+        ]
+        compacted, eliminated = compact_commands(commands)
+        assert eliminated == 4
+        assert [x['type'] for x in compacted] == ['item_update']
+
+    def test_delete_existing(self):
+        commands = [
+            TodoistSyncAPI.modify_item('1', content='a'),
+            TodoistSyncAPI.complete_item('1'),
+            TodoistSyncAPI.delete_item('1'),
+        ]
+        compacted, eliminated = compact_commands(commands)
+        assert eliminated == 2
+        assert [x['type'] for x in compacted] == ['item_delete']
+
+    def test_complete_flip(self):
+        commands = [
+            TodoistSyncAPI.complete_item('1'),
+            TodoistSyncAPI.uncomplete_item('1'),
+            TodoistSyncAPI.complete_item('2'),
+            TodoistSyncAPI.complete_item('2'),
+            TodoistSyncAPI.uncomplete_item('2'),
+        ]
+        compacted, eliminated = compact_commands(commands)
+        assert eliminated == 5
+        assert compacted == []
+
+    def test_completion_is_barrier(self):
+        commands = [
+            TodoistSyncAPI.modify_item('1', content='a'),
+            TodoistSyncAPI.complete_item('1'),
+            TodoistSyncAPI.modify_item('1', content='b'),
+        ]
+        compacted, eliminated = compact_commands(commands)
+        assert eliminated == 0
+
+    def test_keeps_referenced_project(self):
+        project_id = str(uuid.uuid4())
+        temp_id = str(uuid.uuid4())
+        commands = [
+            TodoistSyncAPI.create_project('Work', project_id),
+            TodoistSyncAPI.move_item('1', project_id=project_id),
+            TodoistSyncAPI.add_item('a', temp_id, project_id=project_id),
+            TodoistSyncAPI.delete_item(temp_id),
+        ]
+        compacted, eliminated = compact_commands(commands)
+        assert [x['type'] for x in compacted] == ['project_add', 'item_move']
+
+    def test_modify_before_push(self, store):
+        provider = TodoistProvider(store=store)
+        task_old = get_task()
+        task_old.todoist = None
+        provider.on_add(task_old)
+        task_new = get_task()
+        task_new.todoist = None
+        task_new.description = 'Changed'
+        task_json, feedback = provider.on_modify(task_old, task_new)
+        assert feedback == 'Todoist: item updated'
+        assert provider.commands[-1]['args']['id'] == str(task_new.uuid)
+        assert '"todoist"' not in task_json
+        task_new.status = TaskwarriorStatus.DELETED
+        provider.on_modify(task_old, task_new)
+        compacted, eliminated = compact_commands(provider.commands)
+        assert compacted == []
+        assert eliminated == len(provider.commands)
+
+
+class TestPendingRegistry:
+
+    def test_add_to_new_project_once(self, store):
+        provider = TodoistProvider(store=store)
+        for description in ('a', 'b'):
+            task = get_task()
+            task.uuid = uuid.uuid4()
+            task.todoist = None
+            task.description = description
+            task.project = 'Work'
+            provider.on_add(task)
+        types = [x['type'] for x in provider.commands]
+        assert types == ['project_add', 'item_add', 'item_add']
+        project_id = provider.commands[0]['temp_id']
+        assert provider.commands[1]['args']['project_id'] == project_id
+        assert provider.commands[2]['args']['project_id'] == project_id
+
+    def test_move_to_pending_section(self, old_task, new_task, store):
+        pending = TodoistPendingRegistry()
+        old_task.project = 'Personal'
+        new_task.project = 'Work'
+        new_task.section = 'Meetings'
+        first = TodoistProvider.move_item(old_task, new_task, store, pending)
+        assert [x['type'] for x in first] == ['project_add', 'section_add', 'item_move']
+        second = TodoistProvider.move_item(old_task, new_task, store, pending)
+        assert [x['type'] for x in second] == ['item_move']
+        assert second[0]['args']['section_id'] == first[1]['temp_id']
+
+    def test_reconcile(self):
+        pending = TodoistPendingRegistry()
+        commands = [
+            TodoistSyncAPI.create_project('Work', 'p'),
+            TodoistSyncAPI.create_section('Meetings', 's', project_id='p'),
+            TodoistSyncAPI.add_item('a', 'i', section_id='s'),
+        ]
+        pending.register(commands)
+        assert pending.find_item('i') == 'i'
+        pending.reconcile(commands, {'p': '1', 's': '2', 'i': '3'})
+        assert pending.find_project('Work') == '1'
+        assert pending.find_section('Meetings', '1') == '2'
+        assert pending.find_item('i') == '3'
+        # Later batches still referring to temp_ids get the real ids
+        later = [TodoistSyncAPI.modify_item('i', content='b')]
+        assert pending.resolve(later)[0]['args']['id'] == '3'
+        assert later[0]['args']['id'] == 'i'
+        # Once the store is refreshed it is the source of truth again
+        pending.forget_confirmed()
+        assert pending.find_project('Work') is None
+
+    def test_forget_confirmed(self):
+        pending = TodoistPendingRegistry()
+        commands = [TodoistSyncAPI.add_item(x, x) for x in 'abc']
+        pending.register(commands)
+        pending.reconcile(commands, {'a': '1', 'b': '2', 'c': '3'})
+        pending.pin('c')
+        pending.forget_confirmed(keep={'b'})
+        assert pending.resolved == {'b': '2', 'c': '3'}
+        pending.unpin('c')
+        pending.forget_confirmed()
+        assert pending.resolved == {}
+
+    def test_reconcile_forgets_unmapped(self):
+        pending = TodoistPendingRegistry()
+        commands = [TodoistSyncAPI.create_project('Work', 'p')]
+        pending.register(commands)
+        pending.reconcile(commands, {})
+        assert pending.find_project('Work') is None
+
+
+class FakeSyncAPI:
+
+    def __init__(self):
+        self.pushed = []
+
+    def push(self, commands):
+        self.pushed.append(commands)
+        return {'temp_id_mapping': {x['temp_id']: 'id-' + x['temp_id'] for x in commands if 'temp_id' in x}}
+
+
+class RejectingSyncAPI(FakeSyncAPI):
+
+    def push(self, commands):
+        res = super().push(commands)
+        errors = {
+            'bad': {'error': 'Invalid argument value', 'http_code': 400},
+            'later': {'error': 'Service unavailable', 'http_code': 503},
+        }
+        res['sync_status'] = {x['uuid']: errors.get(x['args'].get('content'), 'ok') for x in commands}
+        for command in commands:
+            if command['uuid'] in res['sync_status'] and res['sync_status'][command['uuid']] != 'ok':
+                res['temp_id_mapping'].pop(command.get('temp_id'), None)
+        return res
+
+
+class TestPushFailures:
+
+    def test_classify(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(batch, 'TASK_BIN', write_fake_task(str(tmp_path)))
+        store = TodoistSyncDataStore(basedir=str(tmp_path))
+        provider = TodoistProvider(store=store, api=RejectingSyncAPI())
+        provider.commands = [
+            TodoistSyncAPI.modify_item('1', content='ok'),
+            TodoistSyncAPI.modify_item('2', content='bad'),
+            TodoistSyncAPI.add_item('later', 'i'),
+        ]
+        provider.pending.add_item('i')
+        with pytest.raises(TodoistPushError) as err:
+            provider.push()
+        # The transient failure is kept queued, the rejected command is not
+        assert [x['args']['content'] for x in err.value.commands] == ['later']
+        assert provider.commands == err.value.commands
+        assert provider.pending.find_item('i') == 'i'
+        assert provider.rejected == 1
+        with open(join(tmp_path, DEAD_LETTER_FILE)) as f:
+            dead = [json.loads(x) for x in f]
+        assert [x['command']['args']['content'] for x in dead] == ['bad']
+        assert dead[0]['status']['http_code'] == 400
+
+    @pytest.mark.parametrize('status_code', [400, 401])
+    def test_request_rejected(self, tmp_path, monkeypatch, status_code):
+        api = TodoistSyncAPI(token='secret', limiter=RateLimiter(), retries=0)
+        class Response:
+            headers = {}
+        Response.status_code = status_code
+        monkeypatch.setattr(api, '_send', lambda **kwargs: Response())
+        provider = TodoistProvider(store=TodoistSyncDataStore(basedir=str(tmp_path)), api=api)
+        provider.commands = [TodoistSyncAPI.modify_item('1', content='bad')]
+        if status_code == 401:
+            # A bad token says nothing about the commands: push them again
+            with pytest.raises(TodoistPushError) as err:
+                provider.push()
+            assert err.value.transient
+            assert len(provider.commands) == 1
+            assert provider.rejected == 0
+            return
+        provider.push()
+        assert provider.commands == []
+        assert provider.rejected == 1
+        with open(join(tmp_path, DEAD_LETTER_FILE)) as f:
+            dead = [json.loads(x) for x in f]
+        assert dead[0]['command']['args']['content'] == 'bad'
+        assert dead[0]['status']['http_code'] == 400
+
+    def test_retry_transient(self, monkeypatch):
+        monkeypatch.setattr('tasksync.todoist.api.RETRY_BACKOFF', 0)
+        api = TodoistSyncAPI(token='secret', limiter=RateLimiter(), retries=2)
+        responses = iter([503, 429, 200])
+        class Response:
+            def __init__(self, status_code):
+                self.status_code = status_code
+                self.headers = {}
+            def json(self):
+                return {'sync_token': 'abc'}
+        monkeypatch.setattr(api, '_send', lambda **kwargs: Response(next(responses)))
+        monkeypatch.setattr('tasksync.todoist.api.backoff_delay', lambda attempt: 0)
+        assert api.pull() == {'sync_token': 'abc'}
+        monkeypatch.setattr(api, '_send', lambda **kwargs: Response(403))
+        with pytest.raises(TodoistSyncError) as err:
+            api.pull()
+        assert err.value.status_code == 403
+        assert not err.value.transient
+
+    def test_partial_push(self, monkeypatch):
+        api = TodoistSyncAPI(token='secret', limiter=RateLimiter(), chunk_size=1, concurrency=1, retries=0)
+        sent = []
+        def post(json=None, **kwargs):
+            command = json['commands'][0]
+            if command['args']['content'] == 'down':
+                raise TodoistSyncError('sync error (502)', status_code=502, transient=True)
+            sent.append(command)
+            return {'sync_status': {command['uuid']: 'ok'}, 'temp_id_mapping': {}}
+        monkeypatch.setattr(api, '_post', post)
+        commands = [TodoistSyncAPI.modify_item(str(i), content=x) for i, x in enumerate(['a', 'down', 'b'])]
+        with pytest.raises(TodoistPushError) as err:
+            api.push(commands)
+        assert err.value.commands == [commands[1]]
+        assert set(err.value.response['sync_status']) == {commands[0]['uuid'], commands[2]['uuid']}
+
+
+class TestWriteBack:
+
+    @pytest.fixture
+    def provider(self, tmp_path, monkeypatch, store):
+        tasks = [{'uuid': 'u{}'.format(i), 'description': 'Task {}'.format(i)} for i in range(3)]
+        monkeypatch.setattr(batch, 'TASK_BIN', write_fake_task(str(tmp_path), tasks))
+        return TodoistProvider(store=store, api=FakeSyncAPI())
+
+    def read_tasks(self, basedir):
+        with open(join(basedir, 'tasks.json')) as f:
+            return dict((x['uuid'], x.get('todoist')) for x in json.load(f))
+
+    def test_batched(self, provider, tmp_path):
+        provider.push([TodoistSyncAPI.add_item('Task', 'u{}'.format(i)) for i in range(3)])
+        assert self.read_tasks(tmp_path) == {'u0': 'id-u0', 'u1': 'id-u1', 'u2': 'id-u2'}
+        with open(join(tmp_path, 'calls.log')) as f:
+            assert len(f.read().splitlines()) == 2
+        assert provider.writeback == {}
+
+    def test_retry(self, provider, tmp_path):
+        open(join(tmp_path, 'fail'), 'w').close()
+        provider.push([TodoistSyncAPI.add_item('Task', 'u0')])
+        assert provider.writeback == {'u0': 'id-u0'}
+        assert provider.writeback_attempts == {'u0': 1}
+        os.remove(join(tmp_path, 'fail'))
+        # The next push writes back the earlier ID along with the new one
+        provider.push([TodoistSyncAPI.add_item('Task', 'u1')])
+        assert self.read_tasks(tmp_path) == {'u0': 'id-u0', 'u1': 'id-u1', 'u2': None}
+        assert provider.writeback == {}
+        assert provider.writeback_attempts == {}
+
+    def test_forget_written_back(self, provider, tmp_path):
+        push = provider.api.push
+        provider.api.push = lambda commands: dict(push(commands), sync_token='abc')
+        open(join(tmp_path, 'fail'), 'w').close()
+        provider.push([TodoistSyncAPI.add_item('Task', 'u0')])
+        # Not written back yet, so on_modify still needs the Todoist ID
+        assert provider.pending.find_item('u0') == 'id-u0'
+        os.remove(join(tmp_path, 'fail'))
+        provider.commands.append(TodoistSyncAPI.modify_item('u1', content='b'))
+        provider.push([TodoistSyncAPI.add_item('Task', 'u1')])
+        assert 'u0' not in provider.pending.resolved
+        # A queued command still refers to the temp_id
+        assert provider.pending.resolved == {'u1': 'id-u1'}
+
+    def test_give_up(self, provider):
+        provider.push([TodoistSyncAPI.add_item('Task', 'missing')])
+        for _ in range(WRITEBACK_MAX_ATTEMPTS - 1):
+            assert provider.writeback == {'missing': 'id-missing'}
+            provider.push([])
+        assert provider.writeback == {}
+
+
+class FakeTaskWarrior(TaskWarrior):
+
+    def __init__(self, tasks):
+        super().__init__(version_override='2.6.2')
+        self.data = tasks
+        self.exports = 0
+        self.saved = []
+
+    def filter_tasks(self, filter_obj):
+        self.exports += 1
+        out = []
+        for data in self.data:
+            task = Task(self)
+            task._load_data(dict(data))
+            out.append(task)
+        return out
+
+    def save_task(self, task):
+        self.saved.append(task)
+
+
+class TestPullTaskwarrior:
+
+    @pytest.fixture
+    def tw(self, tmp_path, monkeypatch):
+        tasks = [
+            {'uuid': str(uuid.uuid4()), 'description': 'Sample Task {}'.format(i), 'status': 'pending',
+             'entry': '20230101T000000Z', 'project': 'Inbox', 'todoist': '100000000{}'.format(i)}
+            for i in (1, 2)
+        ]
+        tasks.append({'uuid': str(uuid.uuid4()), 'description': 'Local', 'status': 'pending', 'entry': '20230101T000000Z'})
+        monkeypatch.setattr(batch, 'TASK_BIN', write_fake_task(str(tmp_path), tasks))
+        return FakeTaskWarrior(tasks)
+
+    def read_tasks(self, basedir):
+        with open(join(basedir, 'tasks.json')) as f:
+            return dict((x.get('todoist'), x) for x in json.load(f))
+
+    def test_single_export(self, tw, store, tmp_path):
+        TodoistProvider.update_taskwarrior_from_store(tw, store)
+        assert tw.exports == 1
+        assert tw.saved == []
+        with open(join(tmp_path, 'calls.log')) as f:
+            assert [x.split()[-2:] for x in f.read().splitlines()] == [['import', '-']]
+        tasks = self.read_tasks(tmp_path)
+        assert sorted(tasks, key=str) == ['1000000001', '1000000002', '1000000003', '1000000004', None]
+        # Task 2 gains its due date, tasks 3 and 4 are new
+        assert tasks['1000000002']['uuid'] == tw.data[1]['uuid']
+        assert tasks['1000000002']['due'] == '20230102T000000Z'
+        assert tasks['1000000002']['project'] == 'Inbox'
+        assert tasks['1000000003']['description'] == 'Sample Task 3'
+        assert tasks['1000000003']['status'] == 'pending'
+        assert 'entry' in tasks['1000000003']
+        assert tasks['1000000001'] == tw.data[0]
+
+    def test_status_transitions(self, tw, tmp_path):
+        shutil.copytree(DATADIR, tmp_path / 'store')
+        store = TodoistSyncDataStore(basedir=str(tmp_path / 'store'))
+        store.update({
+            'sync_token': 'abc',
+            'items': [
+                dict(store.find('items', id='1000000001'), checked=True, completed_at='2023-02-01T01:00:00.000000Z'),
+                dict(store.find('items', id='1000000002'), is_deleted=True),
+            ],
+        }, resource_types=['items'])
+        tw.data.append({'uuid': str(uuid.uuid4()), 'description': 'Sample Task 3', 'status': 'completed',
+                        'entry': '20230101T000000Z', 'end': '20230102T000000Z', 'todoist': '1000000003'})
+        TodoistProvider.update_taskwarrior_from_store(tw, store)
+        tasks = self.read_tasks(tmp_path)
+        assert tasks['1000000001']['status'] == 'completed'
+        assert tasks['1000000001']['end'] == '20230201T010000Z'
+        assert tasks['1000000002']['status'] == 'deleted'
+        assert 'end' in tasks['1000000002']
+        # Reopened in Todoist
+        assert tasks['1000000003']['status'] == 'pending'
+        assert 'end' not in tasks['1000000003']
+
+    def test_status_outside_delta(self, tw, tmp_path):
+        shutil.copytree(DATADIR, tmp_path / 'store')
+        store = TodoistSyncDataStore(basedir=str(tmp_path / 'store'))
+        store.update({
+            'sync_token': 'abc',
+            'items': [dict(store.find('items', id='1000000002'), is_deleted=True)],
+        }, resource_types=['items'])
+        # Completed locally while the cached item is still open
+        tw.data.append({'uuid': str(uuid.uuid4()), 'description': 'Sample Task 3', 'status': 'completed',
+                        'entry': '20230101T000000Z', 'end': '20230102T000000Z', 'todoist': '1000000003'})
+        # Item 2 was pulled, but its task has a queued command (e.g. item_complete)
+        queued = queued_item_ids([TodoistSyncAPI.complete_item('1000000002')])
+        TodoistProvider.update_taskwarrior_from_store(tw, store, update_status={'1000000002'} - queued)
+        tasks = self.read_tasks(tmp_path)
+        assert tasks['1000000002']['status'] == 'pending'
+        assert tasks['1000000003']['status'] == 'completed'
+        TodoistProvider.update_taskwarrior_from_store(tw, store, update_status={'1000000002'})
+        assert self.read_tasks(tmp_path)['1000000002']['status'] == 'deleted'
+
+    def test_pull_after_push_delta(self, tw, tmp_path, monkeypatch):
+        shutil.copytree(DATADIR, tmp_path / 'store')
+        store = TodoistSyncDataStore(basedir=str(tmp_path / 'store'))
+        # A push brought in the deletion; the pull's own delta is empty
+        store.update({
+            'sync_token': 'abc',
+            'items': [dict(store.find('items', id='1000000002'), is_deleted=True)],
+        }, resource_types=['items'])
+        class PullAPI:
+            def pull(self, resource_types=None):
+                data = {'sync_token': 'def', 'items': []}
+                store.update(data, resource_types=resource_types)
+                return data
+        monkeypatch.setattr('tasksync.todoist.provider.TaskWarrior', lambda: tw)
+        provider = TodoistProvider(store=store, api=PullAPI())
+        provider._pull()
+        assert self.read_tasks(tmp_path)['1000000002']['status'] == 'deleted'
+        assert store.unreconciled.get('items') == set()
+        # Only dropped from the store once reconciled
+        assert store.find('items', id='1000000002') is not None
+        provider._pull()
+        assert store.find('items', id='1000000002') is None
+
+    def test_pending_writeback(self, tw, tmp_path, monkeypatch):
+        shutil.copytree(DATADIR, tmp_path / 'store')
+        store = TodoistSyncDataStore(basedir=str(tmp_path / 'store'))
+        class PullAPI:
+            def pull(self, resource_types=None):
+                store.update({'sync_token': 'abc'}, resource_types=resource_types)
+        monkeypatch.setattr('tasksync.todoist.provider.TaskWarrior', lambda: tw)
+        provider = TodoistProvider(store=store, api=PullAPI())
+        # Item 3 was created from the 'Local' task, whose ID write-back failed
+        local = tw.data[2]['uuid']
+        provider.writeback = {local: '1000000003'}
+        provider._pull()
+        tasks = self.read_tasks(tmp_path)
+        assert sorted(tasks, key=str) == ['1000000001', '1000000002', '1000000003', '1000000004']
+        assert tasks['1000000003']['uuid'] == local
+
+    def test_reader(self, tw, store, tmp_path):
+        class StaticReader:
+            def records(self):
+                return tw.data
+        TodoistProvider.update_taskwarrior_from_store(tw, store, StaticReader())
+        assert tw.exports == 0
+        tasks = self.read_tasks(tmp_path)
+        assert tasks['1000000002']['due'] == '20230102T000000Z'
+        assert tasks['1000000001'] == tw.data[0]
@@ -6,6 +6,12 @@ from .api import (
     TodoistSyncAPI,
 )
 
+from .storage import (
+    TodoistLogDataStore,
+    TodoistSqliteDataStore,
+    open_store,
+)
+
 from .models import (
     TodoistSyncDuration,
     TodoistSyncDue,
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+from tasksync.todoist.compaction import REFERENCE_ARGS
+
+# Most commands the Sync API accepts in one request
+PUSH_CHUNK_SIZE = 100
+# Requests sent at once when a push is split into independent chunks
+PUSH_CONCURRENCY = 2
+
+
+def plan_chunks(commands: list, size: int = PUSH_CHUNK_SIZE) -> list[list[list]]:
+    """Split Sync API commands into requests of at most `size` commands
+
+    Commands that touch the same object (an item, or a project/section created
+    in the batch and the commands referring to its temp_id) form a group
+    which keeps its order. Groups are packed into chunks in order of
+    appearance. A group larger than `size` is spread over consecutive chunks,
+    so a creation always lands in the same chunk as the commands that refer
+    to it, or an earlier one.
+
+    Parameters
+    ----------
+    commands : list
+        Sync API commands, in the order they must be applied
+    size : int, optional
+        Maximum number of commands per chunk
+
+    Returns
+    -------
+    lanes : list
+        Lists of chunks. The chunks in a lane must be sent one after another
+        (a later chunk may refer to temp_ids created by an earlier one); the
+        lanes do not depend on each other.
+    """
+    groups = group_commands(commands)
+    lanes = []
+    packed = []
+    for group in groups:
+        if len(group) > size:
+            lanes.append([group[i : i + size] for i in range(0, len(group), size)])
+            continue
+        if len(packed) + len(group) > size:
+            lanes.append([packed])
+            packed = []
+        packed += group
+    if len(packed) > 0:
+        lanes.append([packed])
+    return lanes
+
+
+def group_commands(commands: list) -> list[list]:
+    """Group commands that depend on each other, keeping their order"""
+    # Objects acted on by the batch: created (temp_id) or changed (args["id"])
+    targets = set()
+    for command in commands:
+        targets.add(command.get("temp_id", command["args"].get("id")))
+    targets.discard(None)
+
+    parent = list(range(len(commands)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    owner = {}  # object -> index of a command touching it
+    for i, command in enumerate(commands):
+        args = command["args"]
+        keys = [command.get("temp_id", args.get("id"))]
+        keys += [args.get(x) for x in REFERENCE_ARGS]
+        for key in keys:
+            if key is None or key not in targets:
+                continue
+            if key in owner:
+                parent[find(i)] = find(owner[key])
+            else:
+                owner[key] = i
+
+    # Groups come out in order of their first command
+    groups = {}
+    for i, command in enumerate(commands):
+        groups.setdefault(find(i), []).append(command)
+    return list(groups.values())
+
+
+def resolve_temp_ids(commands: list, temp_id_mapping: dict) -> list:
+    """Replace temp_ids confirmed by an earlier request with their real ids"""
+    if len(temp_id_mapping) == 0:
+        return commands
+    out = []
+    for command in commands:
+        args = command["args"]
+        keys = [
+            key
+            for key in ("id", *REFERENCE_ARGS)
+            if isinstance(args.get(key), str) and args[key] in temp_id_mapping
+        ]
+        if keys:
+            command = dict(command, args=dict(args))
+            for key in keys:
+                command["args"][key] = str(temp_id_mapping[args[key]])
+        out.append(command)
+    return out
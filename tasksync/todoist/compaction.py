@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import copy
+
+# Commands that refer to an existing item through args["id"]
+ITEM_COMMANDS = (
+    "item_update",
+    "item_move",
+    "item_complete",
+    "item_uncomplete",
+    "item_delete",
+)
+# Arguments that may refer to a project/section created in the same batch
+REFERENCE_ARGS = ("project_id", "section_id", "parent_id")
+
+
+def compact_commands(commands: list) -> tuple[list, int]:
+    """Collapse redundant Sync API commands before they are pushed
+
+    Commands are only merged with earlier commands for the same item, and
+    never across a completion change, so the end state in Todoist is the same
+    as pushing every command in order:
+
+    - successive `item_update`s for an id are merged into the first one
+    - `item_update`s for an item added in the same batch are folded into its
+      `item_add`; a repeated `item_add` for the same temp_id carries the full
+      task state and replaces the earlier one (and everything in between)
+    - an `item_delete` drops every earlier command for that item; if the
+      item was added in the same batch, the delete is dropped as well
+    - `item_complete` followed by `item_uncomplete` (or vice versa) cancel out
+    - `project_add`/`section_add` commands that only existed for dropped
+      commands are dropped too
+
+    Parameters
+    ----------
+    commands : list
+        Sync API commands, in the order they were generated
+
+    Returns
+    -------
+    compacted, eliminated : tuple[list, int]
+        Compacted commands (the input is not modified) and the number of
+        commands removed
+    """
+    added = set(x["temp_id"] for x in commands if x["type"] == "item_add")
+    out = []
+    adds = {}  # temp_id -> index of item_add still open to folding
+    updates = {}  # id -> index of item_update still open to merging
+    flips = {}  # id -> index of last item_complete/item_uncomplete
+    refs = {}  # id -> indices of every command for that item
+    for command in commands:
+        kind = command["type"]
+        if kind == "item_add":
+            temp_id = command["temp_id"]
+            for index in refs.pop(temp_id, []):
+                out[index] = None
+            updates.pop(temp_id, None)
+            flips.pop(temp_id, None)
+            adds[temp_id] = len(out)
+            refs.setdefault(temp_id, []).append(len(out))
+            out.append(_copy(command))
+            continue
+        if kind not in ITEM_COMMANDS:
+            out.append(command)
+            continue
+
+        id_ = command["args"]["id"]
+        if kind == "item_update":
+            if (index := adds.get(id_)) is not None:
+                args = {k: v for k, v in command["args"].items() if k != "id"}
+                _merge_args(out[index], args, drop_none=True)
+                continue
+            if (index := updates.get(id_)) is not None:
+                _merge_args(out[index], command["args"])
+                continue
+            updates[id_] = len(out)
+            command = _copy(command)
+        elif kind in ("item_complete", "item_uncomplete"):
+            # Completion is a barrier for merging
+            adds.pop(id_, None)
+            updates.pop(id_, None)
+            if (index := flips.pop(id_, None)) is not None:
+                if out[index]["type"] != kind:
+                    out[index] = None
+                else:
+                    flips[id_] = index
+                continue
+            flips[id_] = len(out)
+        elif kind == "item_delete":
+            for index in refs.pop(id_, []):
+                out[index] = None
+            adds.pop(id_, None)
+            updates.pop(id_, None)
+            flips.pop(id_, None)
+            if id_ in added:
+                continue
+        refs.setdefault(id_, []).append(len(out))
+        out.append(command)
+
+    out = _drop_orphans(commands, [x for x in out if x is not None])
+    return out, len(commands) - len(out)
+
+
+def _copy(command: dict) -> dict:
+    out = dict(command)
+    out["args"] = copy.deepcopy(command["args"])
+    return out
+
+
+def _merge_args(command: dict, args: dict, drop_none: bool = False):
+    # Merge targets are always copies, so this never touches the input
+    for key, value in args.items():
+        if drop_none and value is None:
+            command["args"].pop(key, None)
+        else:
+            command["args"][key] = copy.deepcopy(value)
+    return
+
+
+def _references(commands: list) -> set:
+    out = set()
+    for command in commands:
+        for key in REFERENCE_ARGS:
+            if (value := command["args"].get(key)) is not None:
+                out.add(value)
+    return out
+
+
+def _drop_orphans(commands: list, compacted: list) -> list:
+    referenced = _references(commands)
+    # Sections first, since a section_add itself references its project
+    for kind in ("section_add", "project_add"):
+        remaining = _references(compacted)
+        compacted = [
+            x
+            for x in compacted
+            if not (
+                x["type"] == kind
+                and x["temp_id"] in referenced
+                and x["temp_id"] not in remaining
+            )
+        ]
+    return compacted
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
+from collections.abc import Mapping
 from typing import TypedDict
+import sys
 
 class TodoistSyncDuration(TypedDict):
     amount : float
@@ -36,4 +38,67 @@ class TodoistSyncTask(TypedDict):
     user_id : str
 
     due : TodoistSyncDue | None
-    duration : TodoistSyncDuration | None
\ No newline at end of file
+    duration : TodoistSyncDuration | None
+
+
+# Fields of a TodoistSyncTask that tasksync reads; compact records keep only these
+ITEM_RECORD_FIELDS = (
+    "id",
+    "content",
+    "project_id",
+    "section_id",
+    "parent_id",
+    "priority",
+    "labels",
+    "due",
+    "checked",
+    "is_deleted",
+    "completed_at",
+)
+# Id fields repeat across items, so their strings are interned
+_INTERNED_FIELDS = frozenset(("id", "project_id", "section_id", "parent_id"))
+
+
+class TodoistItemRecord(Mapping):
+    """Compact, read-mostly stand-in for a cached TodoistSyncTask dict
+
+    Stores only `ITEM_RECORD_FIELDS` in slots (other keys are dropped) and
+    interns id strings, but supports the mapping access the provider and the
+    data store use (`record["id"]`, `get`, `in`, iteration, `update`).
+    """
+
+    __slots__ = ITEM_RECORD_FIELDS
+
+    def __init__(self, data=(), **kwargs):
+        self.update(data, **kwargs)
+
+    def __getitem__(self, key):
+        if key in ITEM_RECORD_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in ITEM_RECORD_FIELDS:
+            return
+        if key in _INTERNED_FIELDS and isinstance(value, str):
+            value = sys.intern(value)
+        elif key == "labels" and value is not None:
+            value = [sys.intern(x) for x in value]
+        setattr(self, key, value)
+
+    def __iter__(self):
+        return (x for x in ITEM_RECORD_FIELDS if hasattr(self, x))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, dict(self))
+
+    def update(self, data=(), **kwargs):
+        for key, value in dict(data, **kwargs).items():
+            self[key] = value
+        return
@@ -1,44 +1,77 @@
 from __future__ import annotations
 
+import dataclasses
+import datetime
+import json
+import logging
+import os
+import time
 import uuid
-import subprocess
 from zoneinfo import ZoneInfo
 
 from tasklib import Task, TaskWarrior
 
 from tasksync.models import TasksyncDatetime
+from tasksync.taskwarrior.batch import import_tasks, modify_tasks
+from tasksync.taskwarrior.reader import TaskwarriorReader
 from tasksync.taskwarrior.models import (
     TaskwarriorTask,
     TaskwarriorPriority,
     TaskwarriorStatus,
 )
 from tasksync.todoist.api import (
+    TRANSIENT_STATUS_CODES,
+    TodoistPushError,
     TodoistSync,
     TodoistSyncDataStore,
     TodoistSyncAPI,
 )
+from tasksync.todoist.compaction import REFERENCE_ARGS, compact_commands
 from tasksync.todoist.models import TodoistSyncTask, TodoistSyncDue
+from tasksync.todoist.registry import TodoistPendingRegistry
+from tasksync.todoist.storage import open_store, store_lock
 
 TODOIST_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+WRITEBACK_MAX_ATTEMPTS = 5
+# Commands rejected by Todoist for good, kept in the store directory
+DEAD_LETTER_FILE = "dead_letter.jsonl"
+# Rejections of a whole request that are not about its commands (a bad token):
+# the commands are pushed again instead of being dead-lettered
+REQUEUE_STATUS_CODES = (401,)
+
+logger = logging.getLogger(__name__)
 
 
 class TodoistProvider:
     def __init__(self, store=None, api=None):
         self.commands = []
-        self.store = TodoistSyncDataStore() if store is None else store
+        self.compacted = 0
+        self.pending = TodoistPendingRegistry()
+        self.writeback = {}
+        self.writeback_attempts = {}
+        self.rejected = 0
+        self.reader = TaskwarriorReader()
+        self.store = open_store() if store is None else store
         self.api = TodoistSync(store=self.store) if api is None else api
 
     def on_add(self, task: TaskwarriorTask) -> tuple[str, str]:
-        self.commands += TodoistProvider.add_item(task, self.store)
+        self.commands += TodoistProvider.add_item(task, self.store, self.pending)
         feedback = "Todoist: item created"
         return task.to_taskwarrior(), feedback
 
     def on_modify(
         self, task_old: TaskwarriorTask, task_new: TaskwarriorTask
     ) -> tuple[str, str]:
+        task_out = task_new.to_taskwarrior(exclude_id=True)
+
         # If task doesn't have a todoist id just create it and move on
         if task_new.todoist is None:
-            return self.on_add(task_new)[0], "Todoist: item created (did not exist)"
+            if (todoist_id := self.pending.find_item(str(task_new.uuid))) is None:
+                return self.on_add(task_new)[0], "Todoist: item created (did not exist)"
+            # Added but not written back to Taskwarrior yet: use the temp_id
+            # (or the id a previous push assigned to it)
+            task_old = dataclasses.replace(task_old, todoist=todoist_id)
+            task_new = dataclasses.replace(task_new, todoist=todoist_id)
 
         # Record any supported updates
         actions = []
@@ -46,7 +79,9 @@ class TodoistProvider:
         if ops := TodoistProvider.update_item(task_old, task_new, self.store):
             commands += ops
             actions.append("updated")
-        if ops := TodoistProvider.move_item(task_old, task_new, self.store):
+        if ops := TodoistProvider.move_item(
+            task_old, task_new, self.store, self.pending
+        ):
             commands += ops
             actions.append("moved")
         if ops := TodoistProvider.delete_item(task_old, task_new, self.store):
@@ -71,47 +106,205 @@ class TodoistProvider:
                     actions[-1],
                 )
             self.commands += commands
-        return task_new.to_taskwarrior(exclude_id=True), feedback
+        return task_out, feedback
 
     def pull(self, full=False) -> None:
+        # Another process may be writing the same cache
+        with store_lock(self.store.basedir):
+            self._pull(full=full)
+        return
+
+    def _pull(self, full=False) -> None:
         resource_types = None if full else ["items"]
-        _ = self.api.pull(resource_types=resource_types)
+        pruned = getattr(self.store, "pruned", 0)
+        self.api.pull(resource_types=resource_types)
+        self._forget_confirmed()
+        if (pruned := getattr(self.store, "pruned", 0) - pruned) > 0:
+            logger.info("Pruned {} expired elements from the store".format(pruned))
+        if stats := getattr(self.store, "last_save", None):
+            logger.info(
+                "Saved {} bytes to {} files, skipped {} bytes unchanged".format(
+                    stats["written"], len(stats["files"]), stats["skipped"]
+                )
+            )
         tw = TaskWarrior()
         tw.overrides.update({"hooks": "off"})
-
-        # Get only those taskwarrior tasks with Todoist IDs
-        known_ids = set((task["todoist"] for task in tw.tasks))
-        if None in known_ids:
-            known_ids.remove(None)
-        for todoist_task in self.store.find_all("items"):
-            if todoist_task["id"] in known_ids:
-                # Update from todoist
-                task = update_from_todoist(tw, todoist_task, self.store)
-                if task:
-                    task.save()
-            # Else if task does not exist, but is not deleted or completed
-            elif (
-                not todoist_task["is_deleted"] and todoist_task["completed_at"] is None
-            ):
-                task = create_from_todoist(
-                    tw,
-                    todoist_task,
-                    self.store,
-                )
-                task.save()
+        # Only items that changed in Todoist since the last pull (in a pull's
+        # or a push's delta), and that have no local change waiting to be
+        # pushed, may change status
+        queued = queued_item_ids(self.commands)
+        unreconciled = dict(
+            (x, self.store.unreconciled.get(x)) for x in self.store.resource_types
+        )
+        unreconciled["items"] = set(
+            x for x in unreconciled["items"] if str(x) not in queued
+        )
+        TodoistProvider.update_taskwarrior_from_store(
+            tw,
+            self.store,
+            self.reader,
+            update_status=set(str(x) for x in unreconciled["items"]),
+            writeback=self.writeback,
+        )
+        # Only now may the store prune them
+        for resource_type, ids in unreconciled.items():
+            self.store.reconciled(resource_type, ids)
         return
 
-    def push(self) -> None:
-        res = self.api.push(commands=self.commands)
+    def push(self, commands: list | None = None) -> None:
+        """Push commands to Todoist
+
+        Each command is classified by its `sync_status`: commands Todoist
+        rejects for good are written to the dead-letter file, and commands that
+        failed transiently are handed back. Commands whose request failed are
+        handed back if the failure was transient, and dead-lettered otherwise
+        (e.g. a 400 for the whole request).
+
+        Parameters
+        ----------
+        commands : list, optional
+            Batch of commands to push. If not provided, all queued commands
+            are pushed and the queue is cleared.
+
+        Raises
+        ------
+        TodoistPushError
+            If some commands have to be pushed again (`err.commands`). When
+            pushing the queue, they are also left in it.
+        """
+        clear_commands = commands is None
+        if clear_commands:
+            commands = self.commands
+        resolved = self.pending.resolve(commands)
+        commands, eliminated = compact_commands(resolved)
+        if eliminated > 0:
+            logger.info("Compaction eliminated {} commands".format(eliminated))
+            self.compacted += eliminated
+        error = None
+        try:
+            res = self.api.push(commands=commands)
+        except TodoistPushError as err:
+            res, error = err.response, err
+        retry = []
+        unsent = set()
+        requeue = error is not None and (
+            error.transient or error.status_code in REQUEUE_STATUS_CODES
+        )
+        if error is not None:
+            unsent = set(x["uuid"] for x in error.commands)
+            if requeue:
+                retry = list(error.commands)
+            else:
+                # Sending the same request again would fail the same way
+                status = {"error": str(error), "http_code": error.status_code}
+                for command in error.commands:
+                    self._dead_letter(command, status)
+        for command in commands:
+            if command["uuid"] in unsent:
+                continue
+            status = res.get("sync_status", {}).get(command["uuid"], "ok")
+            if status == "ok":
+                continue
+            if status.get("http_code") in TRANSIENT_STATUS_CODES:
+                retry.append(command)
+            else:
+                self._dead_letter(command, status)
+
+        # Creations still to be retried keep their temp_ids
+        retry_uuids = set(x["uuid"] for x in retry)
+        self.pending.reconcile(
+            [x for x in resolved if x["uuid"] not in retry_uuids],
+            res.get("temp_id_mapping", {}),
+        )
 
         # Check to see if any item_add commands were included
         # (in this case we need to update Taskwarrior with the IDs)
-        new_uuids = [x.get("temp_id") for x in self.commands if x["type"] == "item_add"]
-        if len(new_uuids) > 0:
-            TodoistProvider.update_taskwarrior(res, new_uuids)
+        new_uuids = [x.get("temp_id") for x in commands if x["type"] == "item_add"]
+        self._write_back(res, new_uuids)
 
         # Clear out commands
-        self.commands.clear()
+        if clear_commands:
+            self.commands.clear()
+            self.commands += retry
+        if "sync_token" in res:
+            # The push brought the store up to date, as a pull would have
+            self._forget_confirmed(retry)
+        if len(retry) > 0:
+            raise TodoistPushError(
+                "{} commands to retry{}".format(
+                    len(retry), "" if error is None else ": {}".format(error)
+                ),
+                response=res,
+                commands=retry,
+                status_code=None if error is None else error.status_code,
+                transient=error is None or requeue,
+                retry_after=None if error is None else error.retry_after,
+            )
+        return
+
+    def rate_limit(self) -> dict | None:
+        """Remaining Sync API request budget, if the API has a rate limiter"""
+        if (limiter := getattr(self.api, "limiter", None)) is None:
+            return None
+        return limiter.status()
+
+    def _forget_confirmed(self, retry: list = []):
+        # Commands still to be pushed, and tasks still waiting for their
+        # Todoist ID, may refer to confirmed temp_ids
+        keep = set(self.writeback)
+        keep |= referenced_ids(list(self.commands) + retry)
+        self.pending.forget_confirmed(keep)
+        return
+
+    def _dead_letter(self, command: dict, status: dict):
+        """Record a command Todoist rejected, so it is not retried"""
+        self.rejected += 1
+        logger.error(
+            "Todoist rejected {} command {}: {}".format(
+                command["type"], command["uuid"], status.get("error", status)
+            )
+        )
+        path = os.path.join(self.store.basedir, DEAD_LETTER_FILE)
+        with open(path, "a") as f:
+            f.write(
+                json.dumps({"time": time.time(), "command": command, "status": status})
+                + "\n"
+            )
+        return
+
+    def _write_back(self, sync_res: dict, taskwarrior_uuids: list) -> None:
+        """Write new Todoist IDs to Taskwarrior, retrying earlier failures
+
+        Write-backs that fail are kept and retried on the next push, up to
+        `WRITEBACK_MAX_ATTEMPTS` times. Until then `on_modify` still finds the
+        Todoist ID through the pending registry.
+        """
+        mapping = sync_res.get("temp_id_mapping", {})
+        for taskwarrior_uuid in taskwarrior_uuids:
+            if (todoist_id := mapping.get(taskwarrior_uuid)) is not None:
+                self.writeback[taskwarrior_uuid] = str(todoist_id)
+        if len(self.writeback) == 0:
+            return
+        failed = TodoistProvider.update_taskwarrior(self.writeback)
+        for taskwarrior_uuid in self.writeback:
+            if taskwarrior_uuid not in failed:
+                self.writeback_attempts.pop(taskwarrior_uuid, None)
+                continue
+            attempts = self.writeback_attempts.get(taskwarrior_uuid, 0) + 1
+            if attempts < WRITEBACK_MAX_ATTEMPTS:
+                self.writeback_attempts[taskwarrior_uuid] = attempts
+                continue
+            logger.error(
+                "Giving up writing Todoist ID {} to task {}".format(
+                    failed.pop(taskwarrior_uuid), taskwarrior_uuid
+                )
+            )
+            self.writeback_attempts.pop(taskwarrior_uuid, None)
+        if len(failed) > 0:
+            logger.warning(
+                "Will retry writing {} Todoist IDs on the next push".format(len(failed))
+            )
+        self.writeback = failed
         return
 
     @property
@@ -119,17 +312,23 @@ class TodoistProvider:
         return len(self.commands) > 0
 
     @staticmethod
-    def add_item(task: TaskwarriorTask, store: TodoistSyncDataStore) -> list:
+    def add_item(
+        task: TaskwarriorTask,
+        store: TodoistSyncDataStore,
+        pending: TodoistPendingRegistry | None = None,
+    ) -> list:
         ops = []
         kwargs = {}
         if task.project:
-            if project := store.find("projects", name=task.project):
-                kwargs["project_id"] = project["id"]
+            if project_id := TodoistProvider.find_project(task.project, store, pending):
+                kwargs["project_id"] = project_id
             else:
                 temp_id = str(uuid.uuid4())
                 ops.append(
                     TodoistSyncAPI.create_project(name=task.project, temp_id=temp_id)
                 )
+                if pending is not None:
+                    pending.add_project(task.project, temp_id)
                 kwargs["project_id"] = temp_id
         if task.due:
             kwargs["due"] = TodoistProvider.date_from_taskwarrior(
@@ -147,6 +346,8 @@ class TodoistProvider:
                 **kwargs,
             )
         )
+        if pending is not None:
+            pending.add_item(str(task.uuid))
         return ops
 
     @staticmethod
@@ -196,6 +397,7 @@ class TodoistProvider:
         task_old: TaskwarriorTask,
         task_new: TaskwarriorTask,
         store: TodoistSyncDataStore,
+        pending: TodoistPendingRegistry | None = None,
     ) -> list:
         ops = []
         kwargs = {}
@@ -204,8 +406,9 @@ class TodoistProvider:
         project_id = None
         # (0, 1) or (1, 1)
         if task_new.project is not None:
-            if project := store.find("projects", name=task_new.project):
-                project_id = project["id"]
+            if project_id := TodoistProvider.find_project(
+                task_new.project, store, pending
+            ):
                 if task_old.project != task_new.project:
                     kwargs["project_id"] = project_id
             else:
@@ -218,6 +421,8 @@ class TodoistProvider:
                         temp_id=project_id,
                     )
                 )  # type: ignore
+                if pending is not None:
+                    pending.add_project(task_new.project, project_id)
                 kwargs["project_id"] = project_id
         else:
             if project := store.find("projects", name="Inbox"):
@@ -231,13 +436,12 @@ class TodoistProvider:
         # Now do the same thing for the section
         if task_new.section is not None:
             # Section was updated
-            if section := store.find(
-                "sections", name=task_new.section, project_id=project_id
+            if section_id := TodoistProvider.find_section(
+                task_new.section, project_id, store, pending
             ):
                 # if it exists in this project, supply section_id as argument
                 # instead of project_id
-                section_id = section["id"]
-                kwargs["section_id"] = section["id"]
+                kwargs["section_id"] = section_id
                 if "project_id" in kwargs:
                     del kwargs["project_id"]
             else:
@@ -250,6 +454,8 @@ class TodoistProvider:
                         project_id=project_id,
                     )
                 )  # type: ignore
+                if pending is not None:
+                    pending.add_section(task_new.section, project_id, section_id)
                 kwargs["section_id"] = section_id
         elif task_old.section is not None:
             # From API docs:
@@ -322,6 +528,33 @@ class TodoistProvider:
             )
         return ops
 
+    @staticmethod
+    def find_project(
+        name: str,
+        store: TodoistSyncDataStore,
+        pending: TodoistPendingRegistry | None = None,
+    ) -> str | None:
+        """Return the id (or pending temp_id) of the project called `name`"""
+        if project := store.find("projects", name=name):
+            return project["id"]
+        if pending is not None:
+            return pending.find_project(name)
+        return None
+
+    @staticmethod
+    def find_section(
+        name: str,
+        project_id: str | None,
+        store: TodoistSyncDataStore,
+        pending: TodoistPendingRegistry | None = None,
+    ) -> str | None:
+        """Return the id (or pending temp_id) of section `name` in a project"""
+        if section := store.find("sections", name=name, project_id=project_id):
+            return section["id"]
+        if pending is not None:
+            return pending.find_section(name, project_id)
+        return None
+
     @staticmethod
     def date_from_taskwarrior(date: TasksyncDatetime, timezone: str) -> TodoistSyncDue:
         out = TodoistSyncDue(
@@ -338,26 +571,88 @@ class TodoistProvider:
         return out
 
     @staticmethod
-    def update_taskwarrior(sync_res, taskwarrior_uuids):
+    def update_taskwarrior_from_store(
+        tw: TaskWarrior,
+        store: TodoistSyncDataStore,
+        reader: TaskwarriorReader | None = None,
+        update_status: set | None = None,
+        writeback: dict | None = None,
+    ):
+        """Bring Taskwarrior in line with the Todoist items in `store`
+
+        Taskwarrior is read once (from its data files through `reader` if
+        possible, otherwise with `task export`) and indexed by Todoist ID, so
+        each item is resolved without another `task` call. Created and modified
+        tasks are then written back together with `task import`.
+
+        Tasks are only completed, reopened or deleted for the item ids in
+        `update_status` (default: every item), so a stale cache entry cannot
+        undo a status change made locally.
+
+        `writeback` (Taskwarrior uuid -> Todoist ID) links the tasks whose
+        Todoist ID has not been written back yet to their items, which would
+        otherwise be created again.
+        """
+        changed = []
+        records = None if reader is None else reader.records()
+        if records is None:
+            tasks = list(tw.tasks)
+        else:
+            tasks = [load_task(tw, x) for x in records]
+        linked = index_by_todoist(tasks)
+        if writeback:
+            by_uuid = dict((str(x["uuid"]), x) for x in tasks)
+            for taskwarrior_uuid, todoist_id in writeback.items():
+                if todoist_id not in linked and taskwarrior_uuid in by_uuid:
+                    linked[todoist_id] = by_uuid[taskwarrior_uuid]
+        for todoist_task in store.find_all("items"):
+            if (task := linked.get(todoist_task["id"])) is not None:
+                # Update from todoist
+                task = update_from_todoist(
+                    tw,
+                    todoist_task,
+                    store,
+                    task=task,
+                    status=update_status is None
+                    or todoist_task["id"] in update_status,
+                )
+                if task and task.modified:
+                    changed.append(task)
+            # Else if task does not exist, but is not deleted or completed
+            elif (
+                not todoist_task["is_deleted"] and todoist_task["completed_at"] is None
+            ):
+                task = create_from_todoist(
+                    tw,
+                    todoist_task,
+                    store,
+                )
+                changed.append(task)
+        if len(changed) > 0:
+            import_tasks([to_import(x) for x in changed])
+            logger.info("Wrote {} tasks to Taskwarrior".format(len(changed)))
+        return
+
+    @staticmethod
+    def update_taskwarrior(todoist_ids: dict) -> dict:
         """
         Update Taskwarrior with Todoist IDs returned by the Sync API
 
         Note: this only works if you use the taskwarrior UUID as the temp_id in your
         API calls!
+
+        Parameters
+        ----------
+        todoist_ids : dict
+            Taskwarrior UUID -> Todoist ID
+
+        Returns
+        -------
+        failed : dict
+            The subset of `todoist_ids` that could not be written
         """
-        for taskwarrior_uuid in taskwarrior_uuids:
-            if todoist_id := sync_res.get("temp_id_mapping", {}).get(taskwarrior_uuid):
-                command = [
-                    "task",
-                    "rc.hooks=off",  # bypass hooks
-                    taskwarrior_uuid,
-                    "modify",
-                    "todoist={}".format(str(todoist_id)),
-                ]
-                _ = subprocess.run(
-                    command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-                )
-        return
+        failed = modify_tasks({k: {"todoist": v} for k, v in todoist_ids.items()})
+        return {k: v["todoist"] for k, v in failed.items()}
 
     @staticmethod
     def _check_update(
@@ -412,19 +707,33 @@ def create_from_todoist(
 
 
 def update_from_todoist(
-    tw: TaskWarrior, todoist_task: TodoistSyncTask, store: TodoistSyncDataStore
+    tw: TaskWarrior,
+    todoist_task: TodoistSyncTask,
+    store: TodoistSyncDataStore,
+    task: Task | None = None,
+    status: bool = True,
 ) -> Task | None:
-    task = tw.tasks.get(todoist=todoist_task["id"])
+    if task is None:
+        task = tw.tasks.get(todoist=todoist_task["id"])
 
     # Ignore deleted tasks
     if task.deleted and todoist_task["is_deleted"]:
         return
 
-    # Update status
-    # - Close completed tasks
-    if not task.completed and todoist_task["completed_at"] is not None:
-        task.done()
-        # task._data['end'] = TasksyncDatetime.from_todoist(todoist_task['completed_at']).to_taskwarrior()  # noqa: E501
+    # Update status (unless told to leave it alone)
+    if status:
+        # - Delete deleted tasks
+        if todoist_task["is_deleted"]:
+            task["status"] = "deleted"
+            task["end"] = datetime.datetime.now(datetime.timezone.utc)
+        # - Close completed tasks
+        elif not task.completed and todoist_task["completed_at"] is not None:
+            task["status"] = "completed"
+            task["end"] = convert_timestamp(todoist_task["completed_at"])
+        # - Reopen tasks uncompleted in Todoist
+        elif task.completed and todoist_task["completed_at"] is None:
+            task["status"] = "pending"
+            task["end"] = None
 
     # Update description
     if task["description"] != todoist_task["content"]:
@@ -466,6 +775,66 @@ def update_from_todoist(
     return task
 
 
+def referenced_ids(commands: list) -> set:
+    """Ids (and temp_ids) that commands act on or refer to"""
+    out = set()
+    for command in commands:
+        args = command["args"]
+        out.update(
+            args[x] for x in ("id", *REFERENCE_ARGS) if isinstance(args.get(x), str)
+        )
+    return out
+
+
+def queued_item_ids(commands: list) -> set:
+    """Ids of the Todoist items that queued commands act on"""
+    return set(
+        str(x["args"]["id"])
+        for x in commands
+        if x["type"].startswith("item_") and "id" in x["args"]
+    )
+
+
+def index_by_todoist(tasks) -> dict[str, Task]:
+    """Map Todoist ID -> Taskwarrior task for the tasks linked to Todoist"""
+    out = {}
+    for task in tasks:
+        if task["todoist"] is not None:
+            out[str(task["todoist"])] = task
+    return out
+
+
+def load_task(tw: TaskWarrior, record: dict) -> Task:
+    """Build a tasklib task from a `task export` record without running `task`"""
+    task = Task(tw)
+    task._load_data(dict(record))
+    return task
+
+
+def to_import(task: Task) -> dict:
+    """Return a complete `task import` record for a tasklib task
+
+    `task import` replaces the stored task with the record, so this includes
+    every attribute, and gives new tasks their uuid, status and entry.
+    """
+    out = json.loads(task.export_data())
+    # Computed by Taskwarrior
+    out.pop("id", None)
+    out.pop("urgency", None)
+    if task["tags"]:
+        out["tags"] = sorted(task["tags"])
+    if "uuid" not in out:
+        out["uuid"] = str(uuid.uuid4())
+        out["entry"] = TasksyncDatetime.now(datetime.timezone.utc).to_taskwarrior()
+    out.setdefault("status", "pending")
+    return out
+
+
+def convert_timestamp(value: str) -> datetime.datetime:
+    """Convert a Sync API timestamp (e.g. `completed_at`) to an aware datetime"""
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
 def convert_labels(labels: list[str]) -> set:
     return set(labels)
 
@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+from email.utils import parsedate_to_datetime
+from typing import Callable
+import datetime
+import fcntl
+import json
+import threading
+import time
+
+# Sync API budget: requests per user in each RATE_LIMIT_PERIOD seconds
+RATE_LIMIT_REQUESTS = 1000
+RATE_LIMIT_PERIOD = 15 * 60
+# Share of the budget that pulls leave to pushes
+RATE_LIMIT_RESERVE = 0.1
+# Longest a request waits for budget before failing (seconds)
+RATE_LIMIT_MAX_WAIT = 30
+# Bucket state shared by every process using the same Todoist cache directory
+RATE_LIMIT_FILE = "ratelimit.json"
+PRIORITY_PUSH = "push"
+PRIORITY_PULL = "pull"
+
+
+class RateLimitExceeded(RuntimeError):
+    """No request budget is left for the next `delay` seconds"""
+
+    def __init__(self, delay: float):
+        super().__init__("Sync API budget exhausted for {:.0f}s".format(delay))
+        self.delay = delay
+
+
+class RateLimiter:
+    """Token bucket for the Todoist Sync API request budget
+
+    The bucket holds `capacity` requests and refills at `capacity` per
+    `period` seconds. Pushes may use the whole bucket, whereas pulls leave
+    `reserve` of it to pushes, so background pulls cannot starve hooks.
+    A `Retry-After` from the API holds every request back until it has passed.
+
+    With a `path`, the bucket is kept in that file (under an exclusive lock)
+    so that the server and the CLI draw from the same budget. Otherwise it
+    only lives in this process.
+    """
+
+    def __init__(
+        self,
+        path: str | None = None,
+        capacity: int = RATE_LIMIT_REQUESTS,
+        period: float = RATE_LIMIT_PERIOD,
+        reserve: float = RATE_LIMIT_RESERVE,
+        max_wait: float = RATE_LIMIT_MAX_WAIT,
+        clock: Callable[[], float] = time.time,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.path = path
+        self.capacity = capacity
+        self.period = period
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.clock = clock
+        self.sleep = sleep
+        self._state = None
+        self._lock = threading.Lock()
+
+    def acquire(self, priority: str = PRIORITY_PUSH) -> float:
+        """Take one request from the budget, waiting for it if needed
+
+        Returns
+        -------
+        waited : float
+            Seconds spent waiting for budget
+
+        Raises
+        ------
+        RateLimitExceeded
+            If the budget would take longer than `max_wait` seconds to allow
+            the request
+        """
+        floor = self.reserve * self.capacity if priority == PRIORITY_PULL else 0
+        waited = 0.0
+        while (delay := self._update(lambda state: self._take(state, floor))) > 0:
+            if waited + delay > self.max_wait:
+                raise RateLimitExceeded(delay)
+            self.sleep(delay)
+            waited += delay
+        return waited
+
+    def block(self, delay: float):
+        """Honour a `Retry-After`: no requests for the next `delay` seconds"""
+
+        def block(state):
+            state["blocked_until"] = max(
+                state["blocked_until"], state["updated"] + delay
+            )
+            return
+
+        self._update(block)
+        return
+
+    def status(self) -> dict:
+        state = self._update(lambda state: dict(state), save=False)
+        blocked = max(0.0, state["blocked_until"] - state["updated"])
+        return {
+            "remaining": 0 if blocked > 0 else int(state["tokens"]),
+            "capacity": self.capacity,
+            "blocked_for": blocked,
+        }
+
+    def _take(self, state: dict, floor: float) -> float:
+        """Take a token from `state`, or return the seconds until possible"""
+        if (blocked := state["blocked_until"] - state["updated"]) > 0:
+            return blocked
+        if state["tokens"] - 1 >= floor:
+            state["tokens"] -= 1
+            return 0.0
+        return (floor + 1 - state["tokens"]) * self.period / self.capacity
+
+    def _update(self, fn: Callable[[dict], object], save: bool = True):
+        """Call `fn` on the refilled bucket state, holding the lock(s)"""
+        with self._lock:
+            if self.path is None:
+                self._state = self._refill(self._state)
+                return fn(self._state)
+            with open(self.path, "a+") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read())
+                    except ValueError:
+                        state = None
+                    state = self._refill(state)
+                    out = fn(state)
+                    if save:
+                        f.seek(0)
+                        f.truncate()
+                        f.write(json.dumps(state))
+                        f.flush()
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            return out
+
+    def _refill(self, state: dict | None) -> dict:
+        now = self.clock()
+        if state is None:
+            return {"tokens": float(self.capacity), "updated": now, "blocked_until": 0}
+        elapsed = max(0.0, now - state["updated"])
+        return {
+            "tokens": min(
+                float(self.capacity),
+                state["tokens"] + elapsed * self.capacity / self.period,
+            ),
+            "updated": now,
+            "blocked_until": state["blocked_until"],
+        }
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Seconds to wait from a `Retry-After` header (seconds or HTTP date)"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(date.tzinfo or datetime.timezone.utc)
+    return max(0.0, (date - now).total_seconds())
@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import threading
+
+from tasksync.todoist.chunking import resolve_temp_ids
+
+
+class TodoistPendingRegistry:
+    """Projects, sections and items created by commands not yet confirmed
+
+    The provider resolves names against the data store, which only knows what
+    was last pulled. This registry remembers what queued commands will create,
+    keyed the same way the store is searched (projects by name, sections by
+    (name, project_id), items by temp_id), so later commands reuse the same
+    temp_id instead of creating duplicates.
+
+    A temp_id is only valid within the request that created it, so once a
+    push confirms it (`reconcile`) the real id replaces it in the registry and
+    in any later batch (`resolve`). Once the store has been refreshed, the
+    confirmed ids are forgotten (`forget_confirmed`), except those still in
+    use or `pin`ned.
+    """
+
+    def __init__(self):
+        self.projects = {}
+        self.sections = {}
+        self.items = set()
+        self.resolved = {}
+        self.pinned = {}
+        self._lock = threading.Lock()
+
+    def find_project(self, name: str) -> str | None:
+        return self.projects.get(name)
+
+    def add_project(self, name: str, temp_id: str):
+        with self._lock:
+            self.projects[name] = temp_id
+        return
+
+    def find_section(self, name: str, project_id: str | None) -> str | None:
+        return self.sections.get((name, project_id))
+
+    def add_section(self, name: str, project_id: str, temp_id: str):
+        with self._lock:
+            self.sections[(name, project_id)] = temp_id
+        return
+
+    def find_item(self, temp_id: str) -> str | None:
+        """Return the id to use for an item added under `temp_id`, if any"""
+        with self._lock:
+            if temp_id in self.resolved:
+                return self.resolved[temp_id]
+            return temp_id if temp_id in self.items else None
+
+    def add_item(self, temp_id: str):
+        with self._lock:
+            self.items.add(temp_id)
+        return
+
+    def register(self, commands: list):
+        """Record the creations in `commands` (e.g. replayed from a journal)"""
+        for command in commands:
+            args = command["args"]
+            if command["type"] == "project_add":
+                self.add_project(args["name"], command["temp_id"])
+            elif command["type"] == "section_add":
+                self.add_section(args["name"], args["project_id"], command["temp_id"])
+            elif command["type"] == "item_add":
+                self.add_item(command["temp_id"])
+        return
+
+    def resolve(self, commands: list) -> list:
+        """Replace temp_ids confirmed by earlier pushes with real ids"""
+        with self._lock:
+            return resolve_temp_ids(commands, self.resolved)
+
+    def reconcile(self, commands: list, temp_id_mapping: dict):
+        """Swap in real ids for the creations confirmed by a push
+
+        Creations that were pushed but are missing from `temp_id_mapping`
+        (e.g. dropped by compaction) are forgotten.
+        """
+        created = set(x["temp_id"] for x in commands if "temp_id" in x)
+        with self._lock:
+            for temp_id in created:
+                if (id_ := temp_id_mapping.get(temp_id)) is not None:
+                    self.resolved[temp_id] = str(id_)
+            self.items -= created
+            self.projects = self._remap(self.projects, created)
+            self.sections = {
+                (name, self.resolved.get(project_id, project_id)): id_
+                for (name, project_id), id_ in self._remap(
+                    self.sections, created
+                ).items()
+            }
+        return
+
+    def confirmed(self, commands: list) -> dict:
+        """Return the real ids confirmed for the creations in `commands`"""
+        with self._lock:
+            return {
+                x["temp_id"]: self.resolved[x["temp_id"]]
+                for x in commands
+                if x.get("temp_id") in self.resolved
+            }
+
+    def pin(self, temp_id: str):
+        """Keep the real id of `temp_id` until `unpin` (e.g. for a stored event)"""
+        with self._lock:
+            self.pinned[temp_id] = self.pinned.get(temp_id, 0) + 1
+        return
+
+    def unpin(self, temp_id: str):
+        with self._lock:
+            if (count := self.pinned.pop(temp_id, 0)) > 1:
+                self.pinned[temp_id] = count - 1
+        return
+
+    def forget_confirmed(self, keep=()):
+        """Drop confirmed creations once the store has been refreshed
+
+        Projects and sections are then found in the store, and items by the
+        Todoist ID written back to Taskwarrior. Only the real ids of temp_ids
+        in `keep` (e.g. referred to by queued commands) or pinned are kept.
+        """
+        with self._lock:
+            confirmed = set(self.resolved.values())
+            self.projects = {
+                k: v for k, v in self.projects.items() if v not in confirmed
+            }
+            self.sections = {
+                k: v for k, v in self.sections.items() if v not in confirmed
+            }
+            keep = set(keep) | set(self.pinned)
+            self.resolved = {k: v for k, v in self.resolved.items() if k in keep}
+        return
+
+    def _remap(self, registry: dict, created: set) -> dict:
+        out = {}
+        for key, id_ in registry.items():
+            if id_ in self.resolved:
+                out[key] = self.resolved[id_]
+            elif id_ not in created:
+                out[key] = id_
+        return out
@@ -0,0 +1,461 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from os.path import exists, join
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+
+from tasksync.todoist.api import (
+    CACHE_PATH,
+    STORE_INDEXES,
+    ReconcileState,
+    RetentionPolicy,
+    SyncToken,
+    SyncTokenDict,
+    SyncTokenManager,
+    TodoistSyncDataStore,
+    write_atomic,
+)
+
+STORE_BACKEND = "json"
+SQLITE_FILE = "todoist.db"
+DELTA_LOG_FILE = "delta.log"
+DELTA_LOG_COMPACT_SIZE = 4 * 1024 * 1024
+STORE_LOCK_FILE = "lock"
+
+
+class SqliteSyncTokenManager(SyncTokenManager):
+    """SyncTokenManager that keeps its tokens in the store's database
+
+    `save` only stages the tokens; they are committed together with the data
+    they belong to by `TodoistSqliteDataStore.update`.
+    """
+
+    def __init__(self, connection: sqlite3.Connection, basedir=None):
+        self.connection = connection
+        self.basedir = CACHE_PATH if basedir is None else basedir
+        self.file = join(self.basedir, "sync_tokens.json")
+        timestamp = SyncToken.get_timestamp()
+        self.tokens = SyncTokenDict(
+            **{key: SyncToken("*", timestamp) for key in SyncTokenDict.__required_keys__}
+        )
+        self.load()
+
+    def load(self, file=None):
+        if file is not None:
+            return super().load(file)
+        rows = self.connection.execute(
+            "SELECT resource_type, token, timestamp FROM sync_tokens"
+        ).fetchall()
+        for resource_type, token, timestamp in rows:
+            self.tokens[resource_type] = SyncToken(token, timestamp)
+        return
+
+    def save(self, file=None):
+        if file is not None:
+            return super().save(file)
+        _save_tokens(self.connection, self.tokens)
+        return
+
+
+class TodoistSqliteDataStore:
+    """Todoist cache stored in a SQLite database (WAL mode)
+
+    Drop-in replacement for `TodoistSyncDataStore`: each resource type is a
+    table keyed by id, with a column and an index for every field declared in
+    `STORE_INDEXES`. `update` only upserts the rows in the sync delta and
+    commits them together with the new sync tokens, so the cache is never
+    ahead of (or behind) its tokens.
+
+    The JSON cache files in `basedir`, if any, are imported the first time
+    the database is created.
+    """
+
+    tokens: SqliteSyncTokenManager
+
+    def __init__(
+        self, basedir=None, file=SQLITE_FILE, compact_items=False, retention=None
+    ):
+        # Rows are decoded on demand, so `compact_items` has nothing to do here
+        self.retention = RetentionPolicy() if retention is None else retention
+        self.pruned = 0
+        self.basedir = CACHE_PATH if basedir is None else basedir
+        self.resource_types = ("items", "labels", "projects", "sections")
+        self.file = join(self.basedir, file)
+        self._lock = threading.RLock()
+        self.connection = sqlite3.connect(self.file, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            created = self._create_tables()
+            if created:
+                self._migrate()
+        self.tokens = SqliteSyncTokenManager(self.connection, basedir=self.basedir)
+        self.unreconciled = ReconcileState(basedir=self.basedir)
+        return
+
+    def __getattr__(self, name):
+        # Mirror the list attributes of TodoistSyncDataStore
+        if name in STORE_INDEXES:
+            return self.find_all(name)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in STORE_INDEXES:
+            with self._lock, self.connection:
+                self.connection.execute("DELETE FROM {}".format(name))
+                self._upsert(name, value)
+            return
+        super().__setattr__(name, value)
+        return
+
+    def save(self, resource_types=[]):
+        # Every change is committed by `update`
+        return
+
+    def load(self, resource_types=[]):
+        # Rows are read on demand
+        return
+
+    def close(self):
+        self.connection.close()
+        return
+
+    def update(self, data, resource_types=None):
+        if resource_types is None:
+            resource_types = self.resource_types
+        with self._lock, self.connection:
+            # Saved before the commit: a crash can only keep extra rows
+            for resource_type in resource_types:
+                self.unreconciled.add(
+                    resource_type, (x["id"] for x in data.get(resource_type, []))
+                )
+            self.unreconciled.save()
+            self.tokens.set(data["sync_token"], resource_types=resource_types)
+            self.tokens.save()
+            for resource_type in resource_types:
+                if resource_type in STORE_INDEXES:
+                    self._prune(resource_type)
+                    self._upsert(resource_type, data.get(resource_type, []))
+        return
+
+    def reconciled(self, resource_type, ids):
+        """Record that a pull applied these rows to Taskwarrior"""
+        with self._lock:
+            self.unreconciled.release(resource_type, ids)
+            self.unreconciled.save()
+        return
+
+    def find(self, key, **kwargs):
+        if key not in self.resource_types:
+            raise ValueError("'{}' is not a valid data type".format(key))
+        for element in self._select(key, kwargs):
+            return element
+        return
+
+    def find_all(self, key, **kwargs):
+        if key not in self.resource_types:
+            raise ValueError("'{}' is not a valid data type".format(key))
+        return list(self._select(key, kwargs))
+
+    def _select(self, key, kwargs):
+        """Yield matching elements, filtering on indexed columns in SQL"""
+        columns = _columns(key)
+        where = [x for x in kwargs if x == "id" or x in columns]
+        query = "SELECT data FROM {}".format(key)
+        if where:
+            query += " WHERE " + " AND ".join("{} IS ?".format(x) for x in where)
+        query += " ORDER BY rowid"
+        with self._lock:
+            rows = self.connection.execute(
+                query, [kwargs[x] for x in where]
+            ).fetchall()
+        for (row,) in rows:
+            element = json.loads(row)
+            if all(element.get(k) == v for k, v in kwargs.items()):
+                yield element
+        return
+
+    def _prune(self, resource_type):
+        # Rows a pull has not reconciled yet are kept (this includes the
+        # delta being applied), as in TodoistSyncDataStore
+        conditions = []
+        args = [json.dumps(sorted(self.unreconciled.get(resource_type), key=str))]
+        if self.retention.deleted:
+            conditions.append("json_extract(data, '$.is_deleted')")
+        if resource_type == "items" and (cutoff := self.retention.cutoff()):
+            conditions.append("substr(json_extract(data, '$.completed_at'), 1, 19) < ?")
+            args.append(cutoff)
+        if conditions:
+            cursor = self.connection.execute(
+                "DELETE FROM {} WHERE id NOT IN (SELECT value FROM json_each(?)) "
+                "AND ({})".format(resource_type, " OR ".join(conditions)),
+                args,
+            )
+            self.pruned += cursor.rowcount
+        return
+
+    def _upsert(self, resource_type, elements):
+        columns = _columns(resource_type)
+        existing = {}
+        ids = [x["id"] for x in elements]
+        # Sync deltas are merged into the stored element, as in the JSON store
+        for start in range(0, len(ids), 500):
+            chunk = ids[start : start + 500]
+            rows = self.connection.execute(
+                "SELECT id, data FROM {} WHERE id IN ({})".format(
+                    resource_type, ",".join("?" * len(chunk))
+                ),
+                chunk,
+            ).fetchall()
+            existing.update((id_, json.loads(data)) for id_, data in rows)
+        rows = []
+        for elem in elements:
+            if (merged := existing.get(elem["id"])) is not None:
+                merged.update(elem)
+            else:
+                merged = existing[elem["id"]] = dict(elem)
+            rows.append(
+                [merged["id"], *(merged.get(x) for x in columns), json.dumps(merged)]
+            )
+        names = ["id", *columns, "data"]
+        self.connection.executemany(
+            "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT (id) DO UPDATE SET {}".format(
+                resource_type,
+                ", ".join(names),
+                ", ".join("?" * len(names)),
+                ", ".join("{0} = excluded.{0}".format(x) for x in names[1:]),
+            ),
+            rows,
+        )
+        return
+
+    def _create_tables(self) -> bool:
+        """Create the schema; return True if the database was new"""
+        created = (
+            self.connection.execute(
+                "SELECT count(*) FROM sqlite_master WHERE name = 'sync_tokens'"
+            ).fetchone()[0]
+            == 0
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS sync_tokens "
+            "(resource_type TEXT PRIMARY KEY, token TEXT, timestamp INTEGER)"
+        )
+        for resource_type in STORE_INDEXES:
+            columns = _columns(resource_type)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS {} (id PRIMARY KEY, {}data TEXT)".format(
+                    resource_type, "".join("{}, ".format(x) for x in columns)
+                )
+            )
+            for fields in STORE_INDEXES[resource_type]:
+                self.connection.execute(
+                    "CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({2})".format(
+                        resource_type, "_".join(fields), ", ".join(fields)
+                    )
+                )
+        return created
+
+    def _migrate(self):
+        """Import an existing JSON cache into a new database"""
+        json_store = TodoistSyncDataStore(basedir=self.basedir)
+        for resource_type in STORE_INDEXES:
+            self._upsert(resource_type, getattr(json_store, resource_type))
+        if exists(json_store.tokens.file):
+            _save_tokens(self.connection, json_store.tokens.tokens)
+        return
+
+
+class TodoistLogDataStore(TodoistSyncDataStore):
+    """JSON store that appends each sync delta to a log instead of rewriting
+
+    The JSON files are a snapshot; every `update` appends the delta it was
+    given (with its sync token) as one fsynced line of `delta.log`, which is
+    the commit point, and `load` folds the log back into the snapshot. Once
+    the log grows past `compact_size` bytes, the changed snapshot files are
+    rewritten (as `TodoistSyncDataStore.save` does) and the log is emptied.
+    A pull of a few changed items therefore costs about the size of the delta.
+    """
+
+    def __init__(
+        self,
+        basedir=None,
+        compact_items=False,
+        retention=None,
+        compact_size=DELTA_LOG_COMPACT_SIZE,
+    ):
+        self.compact_size = compact_size
+        self.log_file = join(CACHE_PATH if basedir is None else basedir, DELTA_LOG_FILE)
+        self._log = None
+        super().__init__(
+            basedir=basedir, compact_items=compact_items, retention=retention
+        )
+        # Tokens are replayed now; data is replayed as each resource is loaded
+        self._records = self._read_log()
+        for record in self._records:
+            self._replay_tokens(record)
+        if len(self._records) > 0:
+            # The snapshot's token file is behind until the next compaction
+            self.dirty.add("tokens")
+        return
+
+    def load(self, resource_types=[]):
+        with self._lock:
+            super().load(resource_types=resource_types)
+            if len(resource_types) == 0:
+                resource_types = self.resource_types
+            # Only the data: tokens were replayed on open, and may have moved on
+            # since (e.g. when `update` loads a resource for the first time)
+            for record in self.__dict__.get("_records", []):
+                types = [x for x in record["resource_types"] if x in resource_types]
+                if types:
+                    self._merge(record["data"], types)
+        return
+
+    def update(self, data, resource_types=None):
+        if resource_types is None:
+            resource_types = self.resource_types
+        with self._lock:
+            self._apply(data, resource_types)
+            record = {
+                "resource_types": list(resource_types),
+                "sync_token": data["sync_token"],
+                "timestamp": self.tokens.get(resource_types).timestamp,
+                "data": {x: data[x] for x in resource_types if x in data},
+            }
+            if self._log is None:
+                self._log = open(self.log_file, "ab")
+            line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+            self._log.write(line)
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self.last_save = {
+                "written": len(line), "skipped": 0, "files": [self.log_file]
+            }
+            if self._log.tell() >= self.compact_size:
+                self.compact()
+        return
+
+    def save(self, resource_types=[], force=False):
+        # Anything written outside `update` has to go to the snapshot
+        self.compact(force=force)
+        return
+
+    def compact(self, force=False):
+        """Write the snapshot and empty the delta log"""
+        with self._lock:
+            # Deltas for resources that were never loaded only exist in the log
+            for record in self._records:
+                for resource_type in record["data"]:
+                    self._ensure_loaded(resource_type)
+            super().save(force=force)
+            stats = self.last_save
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            if exists(self.log_file):
+                stats["written"] += write_atomic(self.log_file, "")
+            self._records = []
+            self.last_save = stats
+        return
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        return
+
+    def _read_log(self) -> list:
+        records = []
+        if not exists(self.log_file):
+            return records
+        good = 0
+        with open(self.log_file, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line) if line.endswith(b"\n") else None
+                except ValueError:
+                    record = None
+                if record is None:
+                    # Torn final write: the update was never committed
+                    break
+                good += len(line)
+                records.append(record)
+        if good < os.path.getsize(self.log_file):
+            os.truncate(self.log_file, good)
+        return records
+
+    def _replay_tokens(self, record):
+        # Keep the time the token was received, not the time it was replayed
+        self.tokens.set(record["sync_token"], resource_types=record["resource_types"])
+        for resource_type in record["resource_types"]:
+            self.tokens.tokens[resource_type].timestamp = record["timestamp"]
+        return
+
+
+def _save_tokens(connection: sqlite3.Connection, tokens: dict):
+    connection.executemany(
+        "INSERT INTO sync_tokens (resource_type, token, timestamp) "
+        "VALUES (?, ?, ?) ON CONFLICT (resource_type) DO UPDATE SET "
+        "token = excluded.token, timestamp = excluded.timestamp",
+        [(k, v.token, v.timestamp) for k, v in tokens.items()],
+    )
+    return
+
+
+def _columns(resource_type) -> list:
+    """Columns (besides id and data) for the indexed fields of a resource"""
+    out = []
+    for fields in STORE_INDEXES.get(resource_type, []):
+        out += [x for x in fields if x not in out]
+    return out
+
+
+STORE_BACKENDS = {
+    "json": TodoistSyncDataStore,
+    "sqlite": TodoistSqliteDataStore,
+    "log": TodoistLogDataStore,
+}
+
+
+def open_store(
+    basedir=None, backend=STORE_BACKEND, compact_items=False, retention=None
+):
+    """Open the Todoist cache in `basedir` with the given storage backend
+
+    Parameters
+    ----------
+    basedir : str, optional
+        Cache directory (default: CACHE_PATH)
+    backend : str, optional
+        One of `STORE_BACKENDS`
+    compact_items : bool, optional
+        Hold cached items as compact `TodoistItemRecord`s
+    retention : RetentionPolicy, optional
+        Which deleted/completed elements to drop (default: deleted ones)
+    """
+    if backend not in STORE_BACKENDS:
+        raise ValueError("Unknown store backend '{}'".format(backend))
+    return STORE_BACKENDS[backend](
+        basedir=basedir, compact_items=compact_items, retention=retention
+    )
+
+
+@contextmanager
+def store_lock(basedir=None):
+    """Hold an exclusive lock on the Todoist cache in `basedir`
+
+    Serializes processes that write the same cache (e.g. `tasksync pull`
+    while the server is not running).
+    """
+    path = join(CACHE_PATH if basedir is None else basedir, STORE_LOCK_FILE)
+    with open(path, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)